@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the extraction of mdev hostdevs from libvirt domain XML.
+
+Compares parsing synthetic domain XML with minidom, as the remediation
+script used to, and with parse_mdev_hostdevs(), reporting the time per
+domain and the peak memory allocated while parsing.
+
+    python3 benchmarks/bench_hostdev_parsing.py [--domains 200] [--disks 32]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from xml.dom import minidom
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'unit_tests'))
+
+from remediation_utils import (  # noqa: E402
+    fake_domain_xml,
+    load_remediation_module,
+)
+
+
+def minidom_hostdevs(raw_xml):
+    return [hostdev.getElementsByTagName('source')[0]
+            .getElementsByTagName('address')[0].getAttribute('uuid')
+            for hostdev in minidom.parseString(raw_xml)
+            .getElementsByTagName('hostdev')]
+
+
+def measure(parse, domains):
+    start = time.perf_counter()
+    for raw_xml in domains:
+        parse(raw_xml)
+    duration = time.perf_counter() - start
+
+    tracemalloc.start()
+    parse(max(domains, key=len))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return duration, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--domains', type=int, default=200)
+    parser.add_argument('--disks', type=int, default=32)
+    parser.add_argument('--vcpus', type=int, default=64)
+    parser.add_argument('--hostdevs', type=int, default=2)
+    args = parser.parse_args()
+
+    remediation = load_remediation_module()
+    domains = [fake_domain_xml([str(uuid.uuid4())
+                                for _ in range(args.hostdevs)],
+                               args.disks, args.vcpus)
+               for _ in range(args.domains)]
+
+    print('{} domains of {} KiB XML, {} mdev hostdev(s) each'.format(
+        args.domains, len(domains[0]) // 1024, args.hostdevs))
+    for name, parse in (('minidom', minidom_hostdevs),
+                        ('elementtree', remediation.parse_mdev_hostdevs)):
+        duration, peak = measure(parse, domains)
+        print('{:12}: {:8.1f} us/domain, {:8.1f} KiB peak'.format(
+            name, duration / args.domains * 1e6, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the scan of libvirt domains for mdev hostdevs.
+
+Measures the time taken to fetch and parse the XML of all domains, and
+until the first domain with a vGPU is available, with a growing number of
+libvirt connections. Only a share of the domains have a vGPU.
+
+    python3 benchmarks/bench_libvirt_scan.py [--domains 300]
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'unit_tests'))
+
+from remediation_utils import (  # noqa: E402
+    fake_domain_xml,
+    fake_libvirt_module,
+    load_remediation_module,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--domains', type=int, default=300)
+    parser.add_argument('--vgpu-share', type=float, default=0.25)
+    parser.add_argument('--latency-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    vgpu_domains = int(args.domains * args.vgpu_share)
+    domain_xmls = {
+        str(uuid.uuid4()): fake_domain_xml(
+            [str(uuid.uuid4())] if i < vgpu_domains else [])
+        for i in range(args.domains)}
+
+    remediation = load_remediation_module()
+    print('{} domains, {} with a vGPU, {} ms libvirt latency'.format(
+        args.domains, vgpu_domains, args.latency_ms))
+    for workers in (1, 2, 4, 8):
+        remediation.libvirt = fake_libvirt_module(domain_xmls,
+                                                  args.latency_ms / 1000)
+        remediation.LIBVIRT_WORKERS = workers
+        start = time.perf_counter()
+        first = None
+        found = 0
+        for _, hostdevs in remediation.LibvirtHelper().iter_domain_hostdevs():
+            if first is None:
+                first = time.perf_counter() - start
+            found += len(hostdevs)
+        duration = time.perf_counter() - start
+
+        print('{} connection(s): {:8.1f} ms, first vGPU after {:6.1f} ms, '
+              '{} hostdevs'.format(workers, duration * 1000, first * 1000,
+                                   found))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark vGPU type discovery against a synthetic sysfs tree.
+
+Compares the former os.walk('/sys/devices') scan with the indexed
+/sys/bus/pci/devices enumerator used by nvidia_utils.list_vgpu_types().
+
+    python3 benchmarks/bench_list_vgpu_types.py [--gpus 8] [--vfs 32]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Insulates charmhelpers from the underlying platform, like in unit tests:
+import unit_tests  # noqa: E402,F401
+
+import nvidia_utils  # noqa: E402
+
+# Files and directories found under most PCI device directories in sysfs:
+DEVICE_FILES = ['vendor', 'device', 'class', 'subsystem_vendor', 'irq',
+                'numa_node', 'uevent', 'config', 'resource']
+DEVICE_SUBDIRS = ['power', 'msi_irqs', 'link', 'iommu', 'driver_override']
+
+
+def _write(path, content):
+    with open(path, 'w') as f:
+        f.write(content + '\n')
+
+
+def _make_device(bus_dir, parent, pci_addr, vendor, cls,
+                 vgpu_types=0):
+    device_dir = os.path.join(parent, pci_addr)
+    os.makedirs(device_dir)
+    for name in DEVICE_FILES:
+        _write(os.path.join(device_dir, name), '0x0')
+    _write(os.path.join(device_dir, 'vendor'), vendor)
+    _write(os.path.join(device_dir, 'class'), cls)
+    for name in DEVICE_SUBDIRS:
+        os.makedirs(os.path.join(device_dir, name, 'sub'))
+    for i in range(vgpu_types):
+        type_dir = os.path.join(device_dir, 'mdev_supported_types',
+                                'nvidia-{}'.format(500 + i))
+        os.makedirs(os.path.join(type_dir, 'devices'))
+        _write(os.path.join(type_dir, 'name'), 'NVIDIA A100-{}C'.format(i))
+        _write(os.path.join(type_dir, 'description'),
+               'num_heads=1, frl_config=60, framebuffer=4096M, '
+               'max_resolution=4096x2160, max_instance=10')
+    os.symlink(device_dir, os.path.join(bus_dir, pci_addr))
+    return device_dir
+
+
+def make_sysfs(root, gpus, vfs, other_devices):
+    devices_dir = os.path.join(root, 'devices')
+    bus_dir = os.path.join(root, 'bus', 'pci', 'devices')
+    os.makedirs(bus_dir)
+    for i in range(other_devices):
+        parent = os.path.join(devices_dir, 'pci0000:{:02x}'.format(i % 16))
+        _make_device(bus_dir, parent,
+                     '0000:{:02x}:{:02x}.{}'.format(i % 16, i // 16 % 32,
+                                                    i // 512 % 8),
+                     '0x8086', '0x060400')
+    for gpu in range(gpus):
+        bus = 0x80 + gpu
+        parent = os.path.join(devices_dir, 'pci0000:{:02x}'.format(bus),
+                              '0000:{:02x}:01.0'.format(bus))
+        _make_device(bus_dir, parent, '0000:{:02x}:00.0'.format(bus),
+                     '0x10de', '0x030200')
+        for vf in range(vfs):
+            _make_device(bus_dir, parent,
+                         '0000:{:02x}:{:02x}.{}'.format(bus, vf // 8 + 1,
+                                                        vf % 8),
+                         '0x10de', '0x030200', vgpu_types=20)
+    return devices_dir, bus_dir
+
+
+def legacy_vgpu_capable_device_dirs(devices_dir):
+    """The former implementation, walking the whole device tree."""
+    found_pci_addr_dirs = []
+    for root, dirs, files in os.walk(devices_dir):
+        if 'mdev_supported_types' in dirs:
+            device_class = (
+                Path(os.path.join(root, 'class')).read_text().rstrip()
+            )
+            if device_class != '0x030200':
+                continue
+            found_pci_addr_dirs.append(root)
+    return found_pci_addr_dirs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gpus', type=int, default=8)
+    parser.add_argument('--vfs', type=int, default=32)
+    parser.add_argument('--other-devices', type=int, default=400)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        devices_dir, bus_dir = make_sysfs(root, args.gpus, args.vfs,
+                                          args.other_devices)
+        nvidia_utils.PCI_DEVICES_DIR = bus_dir
+        num_dirs = sum(len(dirs) for _, dirs, _ in os.walk(devices_dir))
+
+        legacy = legacy_vgpu_capable_device_dirs(devices_dir)
+        indexed = nvidia_utils.vgpu_capable_device_dirs()
+        assert len(legacy) == len(indexed) == args.gpus * args.vfs
+
+        legacy_time = min(timeit.repeat(
+            lambda: legacy_vgpu_capable_device_dirs(devices_dir),
+            number=1, repeat=args.repeat))
+        indexed_time = min(timeit.repeat(
+            nvidia_utils.vgpu_capable_device_dirs,
+            number=1, repeat=args.repeat))
+
+        print('synthetic sysfs: {} directories, {} vGPU capable devices'
+              .format(num_dirs, len(indexed)))
+        print('os.walk scan:    {:8.2f} ms'.format(legacy_time * 1000))
+        print('indexed scan:    {:8.2f} ms'.format(indexed_time * 1000))
+        print('speedup:         {:8.1f}x'.format(legacy_time / indexed_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the creation of the missing mdevs of a host.
+
+Creates the mdevs of instances spread over the SR-IOV VFs of several
+GPUs, one at a time and concurrently across GPUs, against a fake sysfs
+where each creation takes a fixed time. Also checks that no GPU ever has
+two creations in flight.
+
+    python3 benchmarks/bench_mdev_creation.py [--gpus 8] [--mdevs 64]
+"""
+
+import argparse
+import collections
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'unit_tests'))
+
+from remediation_utils import load_remediation_module  # noqa: E402
+
+
+def fake_pci_devices(gpus, vfs):
+    """:returns: sysfs devices directory and the addresses of the VFs."""
+    devices_dir = tempfile.mkdtemp()
+    addresses = []
+    for gpu in range(gpus):
+        pf = '0000:{:02x}:00.0'.format(0x41 + gpu)
+        os.mkdir(os.path.join(devices_dir, pf))
+        for vf in range(vfs):
+            # VFs follow the 4 functions of the PF, as on A100 GPUs
+            address = '0000:{:02x}:{:02x}.{}'.format(0x41 + gpu,
+                                                     (4 + vf) // 8,
+                                                     (4 + vf) % 8)
+            os.mkdir(os.path.join(devices_dir, address))
+            os.symlink(os.path.join(devices_dir, pf),
+                       os.path.join(devices_dir, address, 'physfn'))
+            addresses.append(address)
+    return devices_dir, addresses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gpus', type=int, default=8)
+    parser.add_argument('--vfs', type=int, default=16)
+    parser.add_argument('--mdevs', type=int, default=64)
+    parser.add_argument('--create-ms', type=float, default=30.0)
+    args = parser.parse_args()
+
+    remediation = load_remediation_module()
+    remediation.PCI_DEVICES_DIR, addresses = fake_pci_devices(args.gpus,
+                                                              args.vfs)
+    # Spread instances over GPUs first, as the nova scheduler would
+    addresses.sort(key=lambda address: address.split(':')[2])
+    creates = [remediation.MdevCreate(addresses[i % len(addresses)],
+                                      'nvidia-610', str(uuid.uuid4()), None)
+               for i in range(args.mdevs)]
+
+    in_flight = collections.Counter()
+    max_in_flight = collections.Counter()
+    lock = threading.Lock()
+
+    def write_sysfs(path, value):
+        gpu = os.path.basename(os.path.realpath(os.path.join(
+            remediation.PCI_DEVICES_DIR, path.split(os.sep)[-4], 'physfn')))
+        with lock:
+            in_flight[gpu] += 1
+            max_in_flight[gpu] = max(max_in_flight[gpu], in_flight[gpu])
+        time.sleep(args.create_ms / 1000)
+        with lock:
+            in_flight[gpu] -= 1
+
+    remediation._write_sysfs = write_sysfs
+
+    print('{} mdevs on {} GPUs, {} ms per creation'.format(
+        args.mdevs, args.gpus, args.create_ms))
+    for workers in (1, remediation.MDEV_CREATE_WORKERS):
+        max_in_flight.clear()
+        remediation.MDEV_CREATE_WORKERS = workers
+        start = time.perf_counter()
+        failures = remediation.create_mdevs(creates)
+        duration = time.perf_counter() - start
+        print('{:2} worker(s): {:8.1f} ms, {} failures, at most {} creation(s)'
+              ' in flight per GPU'.format(workers, duration * 1000, failures,
+                                          max(max_in_flight.values())))
+
+
+if __name__ == '__main__':
+    main()
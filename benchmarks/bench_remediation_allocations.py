@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the lookup of the vGPU resource provider of each instance.
+
+Compares two Placement requests per instance (GET /allocations/{uuid} and
+GET /resource_providers/{uuid}) with one GET
+/resource_providers/{uuid}/allocations request per local vGPU resource
+provider, against a local fake Placement server.
+
+    python3 benchmarks/bench_remediation_allocations.py [--domains 256]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from remediation_helpers import FakePlacement, FakePlacementServer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'unit_tests'))
+
+from remediation_utils import load_remediation_module  # noqa: E402
+
+
+def new_placement_helper(remediation, server, fqdn):
+    pm = object.__new__(remediation.PlacementHelper)
+    pm.fqdn = fqdn
+    pm.client = server.client()
+    return pm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gpus', type=int, default=8)
+    parser.add_argument('--domains', type=int, default=256)
+    parser.add_argument('--latency-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    remediation = load_remediation_module()
+    fqdn = 'node-sparky.maas'
+    placement = FakePlacement(fqdn, args.gpus, args.domains)
+    server = FakePlacementServer(placement, args.latency_ms / 1000)
+
+    results = []
+    for name, lookup in (
+            ('per instance', lambda pm, consumer:
+                pm.get_vgpu_rp_from_allocations(consumer).name),
+            ('per provider', lambda pm, consumer:
+                pm.get_vgpu_rp(consumer).name)):
+        pm = new_placement_helper(remediation, server, fqdn)
+        placement.requests = 0
+        start = time.perf_counter()
+        for consumer, gpu in placement.domains:
+            assert lookup(pm, consumer) == gpu['name']
+        results.append((name, time.perf_counter() - start,
+                        placement.requests))
+    server.stop()
+
+    print('{} instances on {} vGPU resource providers, {} ms latency'.format(
+        args.domains, args.gpus, args.latency_ms))
+    for name, duration, requests in results:
+        print('{:14} {:10.1f} ms {:6} requests'.format(
+            name + ':', duration * 1000, requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the startup cost of the remediation Placement client modes.
+
+Measures, in fresh interpreters, the time taken and the number of modules
+loaded by the imports each client mode of the remediation script needs to
+build its Placement client. Modes whose modules aren't installed are
+skipped, so this is best run on a compute node.
+
+    python3 benchmarks/bench_remediation_import.py [--repeat 10]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+MODES = {
+    'baseline': 'import configparser, logging, socket',
+    'lean': ('import keystoneauth1.adapter, keystoneauth1.session, '
+             'keystoneauth1.identity.generic, keystoneauth1.identity.v3'),
+    'nova': 'import nova.conf, nova.utils',
+}
+COUNT_MODULES = '; import sys; print(len(sys.modules))'
+
+
+def run(statement):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', statement + COUNT_MODULES],
+                            capture_output=True, text=True)
+    duration = time.perf_counter() - start
+    if result.returncode != 0:
+        return None, None
+
+    return duration, int(result.stdout.split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    for mode, statement in MODES.items():
+        samples = [run(statement) for _ in range(args.repeat)]
+        if samples[0][0] is None:
+            print('{:8}: not installed'.format(mode))
+            continue
+
+        print('{:8}: {:8.1f} ms (best of {}), {} modules'.format(
+            mode, min(duration for duration, _ in samples) * 1000,
+            args.repeat, samples[0][1]))
+
+
+if __name__ == '__main__':
+    main()
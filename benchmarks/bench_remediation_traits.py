@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the reconciliation of resource provider traits.
+
+Compares updating the traits of all local vGPU resource providers one
+after another and through a thread pool, against a local fake Placement
+server injecting generation conflicts.
+
+    python3 benchmarks/bench_remediation_traits.py [--gpus 64]
+"""
+
+import argparse
+import collections
+import os
+import sys
+import time
+
+from remediation_helpers import FakePlacement, FakePlacementServer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'unit_tests'))
+
+from remediation_utils import load_remediation_module  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gpus', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=5.0)
+    parser.add_argument('--conflict-rate', type=float, default=0.1)
+    args = parser.parse_args()
+
+    fqdn = 'node-sparky.maas'
+    remediation = load_remediation_module(mdev_types={'nvidia-610': [
+        '0000:{:02x}:00.0'.format(0x41 + gpu) for gpu in range(args.gpus)]})
+
+    print('{} vGPU resource providers, {} ms latency, {:.0%} conflicts'
+          .format(args.gpus, args.latency_ms, args.conflict_rate))
+    for workers in (1, args.workers):
+        placement = FakePlacement(fqdn, args.gpus, 0,
+                                  conflict_rate=args.conflict_rate)
+        server = FakePlacementServer(placement, args.latency_ms / 1000)
+        pm = object.__new__(remediation.PlacementHelper)
+        pm.fqdn = fqdn
+        pm.client = server.client()
+        pm.local_rp_index
+
+        remediation.TRAITS_UPDATE_WORKERS = workers
+        start = time.perf_counter()
+        outcomes = pm.update_all_gpu_traits()
+        duration = time.perf_counter() - start
+        server.stop()
+
+        print('{:2} worker(s): {:10.1f} ms, {} conflicts retried, {}'.format(
+            workers, duration * 1000, placement.conflicts,
+            dict(collections.Counter(outcomes.values()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark hashing of the nvidia-vgpu-software charm resource.
+
+Compares charmhelpers' file_hash(), which reads the whole file in memory,
+with the streaming hash and the stat-fingerprint cache used by
+charm_utils._path_and_hash_nvidia_resource().
+
+    python3 benchmarks/bench_resource_hash.py [--size-mb 512]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Insulates charmhelpers from the underlying platform, like in unit tests:
+import unit_tests  # noqa: E402,F401
+
+from charmhelpers.core.host import file_hash  # noqa: E402
+
+import charm_utils  # noqa: E402
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size-mb', type=int, default=512)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.deb') as f:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(chunk)
+        f.flush()
+        stored = types.SimpleNamespace(nvidia_resource_fingerprint=None,
+                                       nvidia_resource_hash=None)
+
+        results = [
+            ('file_hash()', measure(file_hash, f.name)),
+            ('streaming hash', measure(charm_utils._file_hash, f.name)),
+            ('cache miss', measure(charm_utils._cached_file_hash, f.name,
+                                   stored)),
+            ('cache hit', measure(charm_utils._cached_file_hash, f.name,
+                                  stored)),
+        ]
+        assert len(set(result for _, (result, _, _) in results)) == 1
+
+        print('synthetic resource: {} MB'.format(args.size_mb))
+        for name, (_, duration, peak) in results:
+            print('{:16} {:10.2f} ms {:10.1f} MB peak'.format(
+                name + ':', duration * 1000, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark enabling SR-IOV on the GPUs of a host at boot.
+
+Enables SR-IOV against a fake sysfs with a fake sriov-manage taking a
+fixed time per GPU: on all GPUs one at a time, as `sriov-manage -e ALL`
+does, on the mapped GPUs only concurrently, and again once their VFs are
+already enabled.
+
+    python3 benchmarks/bench_sriov_enable.py [--gpus 8] [--mapped 4]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'unit_tests'))
+
+from remediation_utils import load_remediation_module  # noqa: E402
+
+FAKE_SRIOV_MANAGE = """#!/bin/sh
+sleep {seconds}
+cat {devices_dir}/$2/sriov_totalvfs > {devices_dir}/$2/sriov_numvfs
+"""
+
+
+def write(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def fake_pci_devices(gpus, vfs):
+    """:returns: sysfs devices directory and the addresses of the GPUs."""
+    devices_dir = tempfile.mkdtemp()
+    addresses = []
+    for gpu in range(gpus):
+        address = '0000:{:02x}:00.0'.format(0x41 + gpu)
+        os.mkdir(os.path.join(devices_dir, address))
+        write(os.path.join(devices_dir, address, 'vendor'), '0x10de\n')
+        write(os.path.join(devices_dir, address, 'sriov_totalvfs'),
+              '{}\n'.format(vfs))
+        addresses.append(address)
+    return devices_dir, addresses
+
+
+def disable_sriov(devices_dir, addresses):
+    for address in addresses:
+        write(os.path.join(devices_dir, address, 'sriov_numvfs'), '0\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gpus', type=int, default=8)
+    parser.add_argument('--mapped', type=int, default=4)
+    parser.add_argument('--vfs', type=int, default=16)
+    parser.add_argument('--enable-ms', type=float, default=500.0)
+    args = parser.parse_args()
+
+    remediation = load_remediation_module()
+    devices_dir, addresses = fake_pci_devices(args.gpus, args.vfs)
+    remediation.PCI_DEVICES_DIR = devices_dir
+    remediation.SRIOV_MANAGE = os.path.join(devices_dir, 'sriov-manage')
+    write(remediation.SRIOV_MANAGE, FAKE_SRIOV_MANAGE.format(
+        seconds=args.enable_ms / 1000, devices_dir=devices_dir))
+    os.chmod(remediation.SRIOV_MANAGE, 0o755)
+
+    runs = (
+        ('all, sequential', None, 1, True),
+        ('mapped, concurrent', addresses[:args.mapped],
+         remediation.SRIOV_WORKERS, True),
+        ('mapped, enabled', addresses[:args.mapped],
+         remediation.SRIOV_WORKERS, False),
+    )
+    print('{} GPUs, {} mapped, {} ms per sriov-manage'.format(
+        args.gpus, args.mapped, args.enable_ms))
+    for name, sriov_pfs, workers, reset in runs:
+        if reset:
+            disable_sriov(devices_dir, addresses)
+        remediation.SRIOV_PFS = sriov_pfs
+        remediation.SRIOV_WORKERS = workers
+        start = time.perf_counter()
+        failures = remediation.enable_sriov()
+        duration = time.perf_counter() - start
+        print('{:20}: {:8.1f} ms, {} failures'.format(name, duration * 1000,
+                                                      failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Placement fakes for benchmarking templates/remediate_nova_mdevs.py"""
+
+import http.client
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+
+
+class FakePlacement:
+    """In-memory Placement API with a compute host using vGPUs.
+
+    :param fqdn: Name of the local compute node.
+    :param gpus: Number of local vGPU resource providers.
+    :param domains: Number of instances with a vGPU on the local host.
+    :param other_hosts: Number of other compute hosts in the region, each
+                        with as many vGPU resource providers.
+    :param conflict_rate: Probability of a traits update to fail with a
+                          generation conflict, as if another client updated
+                          the resource provider concurrently.
+    """
+
+    def __init__(self, fqdn, gpus, domains, other_hosts=0, conflict_rate=0.0):
+        self.fqdn = fqdn
+        self.conflict_rate = conflict_rate
+        self.conflicts = 0
+        self.providers = {}
+        self.allocations = {}
+        self.traits = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        self.local_root = self._add_host(fqdn, gpus)
+        for i in range(other_hosts):
+            self._add_host('compute-{}.maas'.format(i), gpus)
+
+        local_gpus = [rp for rp in self.providers.values()
+                      if rp['name'].startswith(fqdn + '_pci_')]
+        self.domains = []
+        for i in range(domains):
+            consumer = str(uuid.uuid4())
+            gpu = local_gpus[i % len(local_gpus)]
+            self.allocations[consumer] = {
+                gpu['uuid']: {'resources': {'VGPU': 1}},
+                self.local_root: {'resources': {'VCPU': 4,
+                                                'MEMORY_MB': 8192}},
+            }
+            self.domains.append((consumer, gpu))
+
+    def _add_host(self, name, gpus):
+        root = self._add_provider(name, None)
+        for gpu in range(gpus):
+            self._add_provider('{}_pci_0000_{:02x}_00_0'.format(
+                name, 0x41 + gpu), root)
+        return root
+
+    def _add_provider(self, name, root):
+        rp_uuid = str(uuid.uuid4())
+        self.providers[rp_uuid] = {
+            'uuid': rp_uuid,
+            'name': name,
+            'generation': 1,
+            'root_provider_uuid': root or rp_uuid,
+            'parent_provider_uuid': root,
+        }
+        self.traits[rp_uuid] = []
+        return rp_uuid
+
+    def handle(self, method, path, query, body):
+        """:returns: Pair of HTTP status code and JSON response body."""
+        with self.lock:
+            self.requests += 1
+
+        match = re.match(r'^/resource_providers/([^/]+)(/\w+)?$', path)
+        if path == '/resource_providers':
+            rps = list(self.providers.values())
+            if 'name' in query:
+                rps = [rp for rp in rps if rp['name'] == query['name']]
+            if 'in_tree' in query:
+                tree = self.providers[query['in_tree']]['root_provider_uuid']
+                rps = [rp for rp in rps if rp['root_provider_uuid'] == tree]
+            return 200, {'resource_providers': rps}
+        if path == '/traits':
+            return 200, {'traits': ['CUSTOM_VGPU_PLACEMENT']}
+        if path.startswith('/allocations/'):
+            consumer = path.split('/')[-1]
+            return 200, {'allocations': self.allocations.get(consumer, {})}
+        if match and match.group(1) in self.providers:
+            rp = self.providers[match.group(1)]
+            if match.group(2) is None:
+                return 200, rp
+            if match.group(2) == '/allocations':
+                return 200, {
+                    'resource_provider_generation': rp['generation'],
+                    'allocations': {
+                        consumer: allocations[rp['uuid']]
+                        for consumer, allocations in self.allocations.items()
+                        if rp['uuid'] in allocations},
+                }
+            if match.group(2) == '/traits' and method == 'GET':
+                return 200, {'resource_provider_generation': rp['generation'],
+                             'traits': self.traits[rp['uuid']]}
+            if match.group(2) == '/traits' and method == 'PUT':
+                with self.lock:
+                    if random.random() < self.conflict_rate:
+                        rp['generation'] += 1
+                    if body['resource_provider_generation'] != (
+                            rp['generation']):
+                        self.conflicts += 1
+                        return 409, {'errors': [{'code': 'conflict'}]}
+                    rp['generation'] += 1
+                    self.traits[rp['uuid']] = body['traits']
+                return 200, {'resource_provider_generation': rp['generation'],
+                             'traits': body['traits']}
+        return 404, {'errors': [{'code': 'not_found'}]}
+
+
+class FakePlacementServer:
+    """HTTP server for a FakePlacement, adding a latency to each request."""
+
+    def __init__(self, placement, latency=0.0):
+        self.placement = placement
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                time.sleep(latency)
+                status, data = server.placement.handle(self.command,
+                                                       url.path, query, body)
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_PUT = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def client(self):
+        return PlacementClient('127.0.0.1', self.port)
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+class Response:
+
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self._data = data
+
+    def json(self):
+        return self._data
+
+    def __repr__(self):
+        return f'<Response [{self.status_code}]>'
+
+
+class PlacementClient:
+    """Minimal keystoneauth1 Adapter lookalike, keeping connections alive."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._local = threading.local()
+
+    def _request(self, method, url, json_body=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host,
+                                                                 self.port)
+        body = json.dumps(json_body) if json_body is not None else None
+        conn.request(method, url, body=body,
+                     headers={'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        return Response(resp.status, json.loads(resp.read()))
+
+    def get(self, url, microversion=None, **kwargs):
+        return self._request('GET', url)
+
+    def put(self, url, json=None, microversion=None, **kwargs):
+        return self._request('PUT', url, json)
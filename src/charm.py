@@ -15,6 +15,8 @@
 # limitations under the License.
 
 
+import logging
+
 import ops_openstack.plugins.classes
 
 from ops.main import main
@@ -26,7 +28,12 @@ from charm_utils import (
     set_principal_unit_relation_data,
     install_mdev_init_workaround,
 )
-from nvidia_utils import list_vgpu_types
+from nvidia_utils import (
+    gpu_inventory,
+    gpu_inventory_fingerprint,
+    list_vgpu_types,
+    parse_size_mb,
+)
 
 
 class NovaComputeNvidiaVgpuCharm(ops_openstack.core.OSBaseCharm):
@@ -44,6 +51,7 @@ class NovaComputeNvidiaVgpuCharm(ops_openstack.core.OSBaseCharm):
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.upgrade_charm, self._on_upgrade)
         self.framework.observe(self.on.start, self._on_start)
+        self.framework.observe(self.on.update_status, self._on_update_status)
         self.framework.observe(self.on.nova_vgpu_relation_joined,
                                self._on_nova_vgpu_relation_joined_or_changed)
         self.framework.observe(self.on.nova_vgpu_relation_changed,
@@ -51,10 +59,23 @@ class NovaComputeNvidiaVgpuCharm(ops_openstack.core.OSBaseCharm):
 
         self.framework.observe(self.on.list_vgpu_types_action,
                                self._list_vgpu_types_action)
+        self.framework.observe(self.on.refresh_gpu_inventory_action,
+                               self._refresh_gpu_inventory_action)
 
         # hash of the last successfully installed NVIDIA vGPU software passed
         # as resource to the charm:
         self._stored.set_default(last_installed_resource_hash=None)
+        # fingerprint (path, size, mtime, inode) and hash of the NVIDIA vGPU
+        # software passed as resource to the charm, saving from re-hashing it
+        # in every hook:
+        self._stored.set_default(nvidia_resource_fingerprint=None,
+                                 nvidia_resource_hash=None)
+        # last unit status and fingerprint of its inputs, saving from
+        # re-computing it in every update-status hook:
+        self._stored.set_default(status_fingerprint=None, last_status=None)
+        # fingerprint of the GPU inventory the relation data and the mdev
+        # initialisation workaround were last rendered from:
+        self._stored.set_default(gpu_inventory_fingerprint=None)
 
     def _on_config_changed(self, _):
         """config-changed hook."""
@@ -62,15 +83,14 @@ class NovaComputeNvidiaVgpuCharm(ops_openstack.core.OSBaseCharm):
         # version has just been provided as a charm resource.
         install_nvidia_software_if_needed(self._stored, self.config,
                                           self.framework.model.resources)
-
-        for relation in self.framework.model.relations.get('nova-vgpu'):
-            set_principal_unit_relation_data(relation.data[self.unit],
-                                             self.config, self.services())
-
+        self._render_gpu_config()
         self.update_status()
 
     def _on_upgrade(self, _):
         """ upgrade-charm hook."""
+        # The status check itself may have changed, which the fingerprint of
+        # its inputs doesn't capture:
+        self._stored.status_fingerprint = None
         install_mdev_init_workaround(self.config)
         self.update_status()
 
@@ -85,13 +105,51 @@ class NovaComputeNvidiaVgpuCharm(ops_openstack.core.OSBaseCharm):
 
         # NOTE(lourot): this is used by OSBaseCharm.update_status():
         self._stored.is_started = True
-        install_mdev_init_workaround(self.config)
+        self._render_gpu_config()
         self.update_status()
 
+    def _on_update_status(self, _):
+        """update-status hook."""
+        # NOTE: OSBaseCharm has already updated the status by now.
+        if self._refresh_gpu_config():
+            self.update_status()
+
     def _on_nova_vgpu_relation_joined_or_changed(self, event):
         set_principal_unit_relation_data(event.relation.data[self.unit],
                                          self.config, self.services())
 
+    def _render_gpu_config(self):
+        """Render the config derived from the GPUs of this unit.
+
+        The vGPU device mappings are expanded against the GPU inventory
+        into the nova.conf bits passed to the principal unit and into the
+        mdev initialisation workaround.
+        """
+        for relation in self.framework.model.relations.get('nova-vgpu'):
+            set_principal_unit_relation_data(relation.data[self.unit],
+                                             self.config, self.services())
+
+        install_mdev_init_workaround(self.config)
+        self._stored.gpu_inventory_fingerprint = gpu_inventory_fingerprint()
+
+    def _refresh_gpu_config(self):
+        """Re-render the config derived from the GPUs if they changed.
+
+        Virtual functions only appear once SR-IOV is enabled on boot, and
+        vGPU types once the NVIDIA driver is loaded, possibly after the
+        config was rendered.
+
+        :returns: Whether the config was re-rendered.
+        :rtype: bool
+        """
+        if gpu_inventory_fingerprint() == (
+                self._stored.gpu_inventory_fingerprint):
+            return False
+
+        logging.info('GPU inventory changed, re-rendering config.')
+        self._render_gpu_config()
+        return True
+
     def services(self):
         """Determine the list of services that should be running.
 
@@ -110,14 +168,35 @@ class NovaComputeNvidiaVgpuCharm(ops_openstack.core.OSBaseCharm):
 
         :rtype: ops.model.StatusBase
         """
-        return check_status(self.config, self.services())
+        return check_status(self.config, self.services(), self._stored)
 
     def _list_vgpu_types_action(self, event):
         """List all vGPU types registered by the NVIDIA driver.
 
         :type event: ops.charm.ActionEvent
         """
-        event.set_results({'output': list_vgpu_types()})
+        min_framebuffer = event.params.get('min-framebuffer')
+        if min_framebuffer and parse_size_mb(min_framebuffer) is None:
+            event.fail("Invalid framebuffer size '{}'".format(
+                min_framebuffer))
+            return
+
+        event.set_results({'output': list_vgpu_types(
+            output_format=event.params.get('format', 'text'),
+            pci_address=event.params.get('pci-address'),
+            type_name=event.params.get('type-name'),
+            min_framebuffer=parse_size_mb(min_framebuffer))})
+
+    def _refresh_gpu_inventory_action(self, event):
+        """Re-scan the NVIDIA GPU hardware.
+
+        :type event: ops.charm.ActionEvent
+        """
+        inventory = gpu_inventory(refresh=True)
+        event.set_results({'output': '\n'.join(
+            device['address'] for device in inventory['devices'])})
+        self._refresh_gpu_config()
+        self.update_status()
 
 
 if __name__ == '__main__':
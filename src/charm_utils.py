@@ -15,10 +15,12 @@
 # limitations under the License.
 
 
+import hashlib
 import logging
 import json
 import os
 import shutil
+import subprocess
 
 from ruamel.yaml import YAML
 
@@ -28,7 +30,7 @@ from charmhelpers.contrib.openstack.utils import (
     ows_check_services_running,
 )
 from charmhelpers.core.hookenv import cached
-from charmhelpers.core.host import file_hash, service
+from charmhelpers.core.host import service
 from charmhelpers.core.templating import render
 from charmhelpers.fetch import apt_install
 
@@ -36,10 +38,18 @@ from ops.model import (
     ActiveStatus,
     BlockedStatus,
     ModelError,
+    StatusBase,
+    WaitingStatus,
 )
 
 import nvidia_utils
 
+# Result of the last mdev remediation and of the last vGPU traits update
+# after it, written on boot by templates/remediate_nova_mdevs.py:
+REMEDIATION_RESULT_FILE = (
+    '/var/lib/nova-compute-nvidia-vgpu/remediation-result.json')
+TRAITS_RESULT_FILE = '/var/lib/nova-compute-nvidia-vgpu/traits-result.json'
+
 
 class UnsupportedOpenStackRelease(Exception):
     def __init__(self, release_name):
@@ -78,7 +88,7 @@ def install_nvidia_software_if_needed(stored, config, resources):
     """
     if is_nvidia_software_to_be_installed(config):
         nvidia_software_path, nvidia_software_hash = (
-            _path_and_hash_nvidia_resource(resources))
+            _path_and_hash_nvidia_resource(resources, stored))
 
         if nvidia_software_path is None:
             # No software has been provided as charm resource. We can't
@@ -105,15 +115,98 @@ def install_nvidia_software_if_needed(stored, config, resources):
         nvidia_utils.disable_nouveau_driver()
 
 
-def check_status(config, services):
+def check_status(config, services, stored=None):
     """Determine the unit status to be set.
 
+    The status is only re-computed if one of its inputs has changed since the
+    last time, see _status_fingerprint().
+
     :param config: Juju application config.
     :type config: ops.model.ConfigData
     :param services: List of services expected to be running.
     :type services: List[str]
+    :param stored: Unit's stored state, caching the last status. If None,
+                   the status is always computed.
+    :type stored: Optional[ops.framework.StoredState]
     :rtype: ops.model.StatusBase
     """
+    if stored is None:
+        return check_status_notcached(config, services)
+
+    try:
+        fingerprint = _status_fingerprint(config, services)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning('Failed to check status inputs: {}'.format(e))
+        return check_status_notcached(config, services)
+
+    last_fingerprint = stored.status_fingerprint
+    if last_fingerprint is not None and stored.last_status is not None:
+        changed_inputs = sorted(
+            key for key in set(fingerprint) | set(last_fingerprint)
+            if fingerprint.get(key) != last_fingerprint.get(key))
+        if not changed_inputs:
+            logging.debug('Status inputs unchanged, skipping status check')
+            return StatusBase.from_name(*stored.last_status)
+
+        logging.info('Status inputs changed: {}'.format(
+            ', '.join(changed_inputs)))
+
+    status = check_status_notcached(config, services)
+    stored.status_fingerprint = fingerprint
+    stored.last_status = [status.name, status.message]
+    return status
+
+
+def _status_fingerprint(config, services):
+    """Get a cheap fingerprint of everything the unit status depends on.
+
+    :param config: Juju application config.
+    :type config: ops.model.ConfigData
+    :param services: List of services expected to be running.
+    :type services: List[str]
+    :returns: Map of input name to a value changing whenever the input
+              changes.
+    :rtype: Dict[str, Union[str, int, None]]
+    """
+    return {
+        'boot_id': nvidia_utils.current_boot_id(),
+        'config': hashlib.md5(json.dumps(
+            dict(config), sort_keys=True).encode()).hexdigest(),
+        'dpkg_status': _mtime_ns(nvidia_utils.DPKG_STATUS_FILE),
+        'gpu_inventory': _mtime_ns(nvidia_utils.GPU_INVENTORY_FILE),
+        'remediation_result': _mtime_ns(REMEDIATION_RESULT_FILE),
+        'traits_result': _mtime_ns(TRAITS_RESULT_FILE),
+        'services': _services_state(services),
+    }
+
+
+def _mtime_ns(path):
+    """Get the modification time of a file, or None if it doesn't exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _services_state(services):
+    """Get the state of some services and when they last became active.
+
+    :param services: List of services.
+    :type services: List[str]
+    :returns: Output of `systemctl show`.
+    :rtype: str
+    :raises: subprocess.CalledProcessError
+    """
+    if not services:
+        return ''
+
+    return subprocess.check_output(
+        ['systemctl', 'show',
+         '--property=Id,ActiveState,ActiveEnterTimestamp'] + list(services),
+        universal_newlines=True)
+
+
+def check_status_notcached(config, services):
     installed_versions = nvidia_utils.installed_nvidia_software_versions()
     software_is_installed = len(installed_versions) > 0
 
@@ -128,12 +221,128 @@ def check_status(config, services):
     if software_is_installed and not software_is_running:
         return BlockedStatus("manual reboot required")
 
+    mappings_status = _vgpu_device_mappings_status(config)
+    if mappings_status is not None:
+        return mappings_status
+
     nvidia_gpu_hardware, num_gpus = nvidia_utils.has_nvidia_gpu_hardware()
     unit_status_msg = "{} GPU".format(num_gpus)
 
+    for status_msg in (_remediation_status(), _traits_status()):
+        if status_msg:
+            unit_status_msg += ", {}".format(status_msg)
+
     return ActiveStatus('Unit is ready ({})'.format(unit_status_msg))
 
 
+def _vgpu_device_mappings_status(config):
+    """Check that the PCI address patterns of the mappings match GPUs.
+
+    A pattern matching no GPU is expanded to nothing, which would silently
+    leave GPUs unused. As vGPU types only appear once the NVIDIA driver is
+    loaded, and virtual functions once SR-IOV is enabled on boot, the unit
+    is only waiting as long as no GPU presents any vGPU type.
+
+    :param config: Juju application config.
+    :type config: ops.model.ConfigData
+    :returns: Blocked or waiting status if a pattern matches no GPU or if
+              no GPU presents vGPU types to generate the mappings from, None
+              otherwise.
+    :rtype: Optional[ops.model.StatusBase]
+    """
+    vgpu_device_mappings_str = (config or {}).get('vgpu-device-mappings')
+    if not vgpu_device_mappings_str:
+        return None
+
+    vgpu_types_presented = any(
+        device['vgpu_types']
+        for device in nvidia_utils.gpu_inventory()['devices'])
+
+    if nvidia_utils.is_auto_vgpu_device_mappings(vgpu_device_mappings_str):
+        # Generated from the vGPU types presented, nothing to match:
+        if not vgpu_types_presented:
+            return WaitingStatus('waiting for GPUs to present vGPU types')
+        return None
+
+    vgpu_device_mappings = YAML().load(vgpu_device_mappings_str) or {}
+    try:
+        unmatched_patterns = nvidia_utils.unmatched_pci_address_patterns(
+            [pci_addr for pci_addresses in vgpu_device_mappings.values()
+             for pci_addr in pci_addresses])
+    except ValueError as e:
+        return BlockedStatus('invalid vgpu-device-mappings: {}'.format(e))
+
+    if not unmatched_patterns:
+        return None
+
+    if not vgpu_types_presented:
+        return WaitingStatus('waiting for GPUs to present vGPU types')
+
+    return BlockedStatus('vgpu-device-mappings match no GPU: {}'.format(
+        ', '.join(unmatched_patterns)))
+
+
+def _remediation_status():
+    """Summarise the mdev remediation run on boot for the unit status.
+
+    Reads the result written by the remediation script, see
+    templates/remediate_nova_mdevs.py.
+
+    :returns: Short message if the remediation failed or went over its time
+              budget during the current boot, None otherwise.
+    :rtype: Optional[str]
+    """
+    result = _load_boot_result(REMEDIATION_RESULT_FILE)
+    if result is None:
+        return None
+
+    if result.get('status') == 'failed':
+        return 'mdev remediation failed'
+
+    if result.get('status') == 'deferred' or result.get('continuation'):
+        duration = result.get('timings', {}).get('total', {}).get('total')
+        if duration is None:
+            return 'mdev remediation slow'
+        return 'mdev remediation slow ({:.0f}s)'.format(duration)
+
+    return None
+
+
+def _traits_status():
+    """Summarise the vGPU traits update run on boot for the unit status.
+
+    :returns: Short message if the update failed during the current boot,
+              None otherwise.
+    :rtype: Optional[str]
+    """
+    result = _load_boot_result(TRAITS_RESULT_FILE)
+    if result is not None and result.get('status') == 'failed':
+        return 'vGPU traits update failed'
+
+    return None
+
+
+def _load_boot_result(path):
+    """Load a result written by the remediation script during this boot.
+
+    :param path: Path of the result.
+    :type path: str
+    :returns: The result, or None if missing or from a previous boot.
+    :rtype: Optional[Dict]
+    """
+    try:
+        with open(path) as f:
+            result = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.debug('No remediation result {}: {}'.format(path, e))
+        return None
+
+    if result.get('boot_id') != nvidia_utils.current_boot_id():
+        return None
+
+    return result
+
+
 def set_principal_unit_relation_data(relation_data_to_be_set, config,
                                      services):
     """Pass configuration to a principal unit.
@@ -146,37 +355,84 @@ def set_principal_unit_relation_data(relation_data_to_be_set, config,
     :type services: List[str]
     :raises: UnsupportedOpenStackRelease
     """
-    vgpu_device_mappings_str = config.get('vgpu-device-mappings')
-    if vgpu_device_mappings_str is not None:
-        vgpu_device_mappings = YAML().load(vgpu_device_mappings_str)
-
-        if vgpu_device_mappings is None:  # happens when passing an empty str
-            vgpu_device_mappings = {}
-
+    if config.get('vgpu-device-mappings') is not None:
+        vgpu_device_mappings = _vgpu_device_mappings(config)
         logging.debug('vgpu-device-mappings={}'.format(vgpu_device_mappings))
 
+        # NOTE: the payload is serialized canonically so that it can be
+        # compared with what has been set previously.
         nova_conf = json.dumps({
             'nova': {
                 '/etc/nova/nova.conf': {
                     'sections': _nova_conf_sections(vgpu_device_mappings)
                 }
             }
+        }, sort_keys=True)
+        _update_relation_data(relation_data_to_be_set, {
+            'subordinate_configuration': nova_conf,
+            'services': json.dumps(services),
+            'releases-packages-map': json.dumps(_releases_packages_map(),
+                                                sort_keys=True),
         })
-        relation_data_to_be_set['subordinate_configuration'] = nova_conf
-        logging.debug(
-            'relation data to principal unit set to '
-            'subordinate_configuration={}'.format(nova_conf))
 
-        relation_data_to_be_set['services'] = json.dumps(services)
-        relation_data_to_be_set['releases-packages-map'] = json.dumps(
-            _releases_packages_map(), sort_keys=True)
 
+def _vgpu_device_mappings(config):
+    """Load the vGPU device mappings from the charm config.
+
+    PCI address patterns are expanded against the GPU inventory, see
+    nvidia_utils.expand_pci_addresses(). The mappings can also be generated
+    from the detected hardware, see nvidia_utils.auto_vgpu_device_mappings().
+
+    :param config: Juju application config.
+    :type config: ops.model.ConfigData
+    :returns: Map of vGPU types to PCI addresses.
+    :rtype: Dict[str, List[str]]
+    """
+    vgpu_device_mappings_str = config.get('vgpu-device-mappings') or ''
+    if nvidia_utils.is_auto_vgpu_device_mappings(vgpu_device_mappings_str):
+        return nvidia_utils.auto_vgpu_device_mappings(
+            vgpu_device_mappings_str)
+
+    vgpu_device_mappings = YAML().load(vgpu_device_mappings_str)
+
+    if vgpu_device_mappings is None:  # happens when passing an empty str
+        return {}
+
+    return {
+        vgpu_type: nvidia_utils.expand_pci_addresses(pci_addresses)
+        for vgpu_type, pci_addresses in vgpu_device_mappings.items()
+    }
+
+
+def _update_relation_data(relation_data_to_be_set, relation_data):
+    """Set relation data, skipping the keys whose value didn't change.
+
+    Every write to the relation data bag costs a relation-set call and may
+    wake up the principal unit's relation-changed hook, re-rendering
+    nova.conf and restarting nova-compute.
 
-def _path_and_hash_nvidia_resource(resources):
+    :param relation_data_to_be_set: Relation data bag to principal unit.
+    :type relation_data_to_be_set: ops.model.RelationData
+    :param relation_data: Map of keys to values to be set.
+    :type relation_data: Dict[str, str]
+    """
+    for key, value in relation_data.items():
+        if relation_data_to_be_set.get(key) == value:
+            logging.debug('relation data {} unchanged'.format(key))
+            continue
+
+        relation_data_to_be_set[key] = value
+        logging.debug(
+            'relation data to principal unit set to {}={}'.format(key, value))
+
+
+def _path_and_hash_nvidia_resource(resources, stored):
     """Get path to and hash of software provided as charm resource.
 
     :param resources: Juju application resources.
     :type resources: ops.model.Resources
+    :param stored: Unit's stored state, caching the hash.
+    :type stored: ops.framework.StoredState
     :returns: Pair of path and hash. (None, None) if no charm resource has
               been provided.
     :rtype: Tuple[PosixPath, str]
@@ -186,7 +442,58 @@ def _path_and_hash_nvidia_resource(resources):
     except ModelError:
         return None, None
 
-    return nvidia_vgpu_software_path, file_hash(nvidia_vgpu_software_path)
+    return nvidia_vgpu_software_path, _cached_file_hash(
+        nvidia_vgpu_software_path, stored)
+
+
+def _cached_file_hash(path, stored):
+    """Get the hash of a file, re-computing it only if the file changed.
+
+    The NVIDIA software is hundreds of MB large. Instead of hashing it in
+    every hook, the hash is cached alongside a fingerprint of the file made
+    of its path, size, modification time and inode.
+
+    :param path: Path to the file.
+    :type path: PosixPath
+    :param stored: Unit's stored state.
+    :type stored: ops.framework.StoredState
+    :returns: MD5 hash of the file, as computed by
+              charmhelpers.core.host.file_hash()
+    :rtype: str
+    """
+    stat = os.stat(path)
+    fingerprint = [str(path), stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    if (stored.nvidia_resource_fingerprint == fingerprint and
+            stored.nvidia_resource_hash):
+        return stored.nvidia_resource_hash
+
+    logging.debug('Computing hash of {}'.format(path))
+    stored.nvidia_resource_hash = _file_hash(path)
+    stored.nvidia_resource_fingerprint = fingerprint
+    return stored.nvidia_resource_hash
+
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def _file_hash(path):
+    """Compute the MD5 hash of a file without loading it in memory.
+
+    :param path: Path to the file.
+    :type path: PosixPath
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            md5.update(view[:size])
+
+    return md5.hexdigest()
 
 
 def _nova_conf_sections(vgpu_device_mappings):
@@ -283,18 +590,33 @@ def install_mdev_init_workaround(config):
                 '/opt/initialise_nova_mdevs.sh')
     os.chmod('/opt/initialise_nova_mdevs.sh', 0o755)
 
-    vgpu_device_mappings = YAML().load(config.get('vgpu-device-mappings') or
-                                       "")
+    vgpu_device_mappings = _vgpu_device_mappings(config)
+    pci_driver_types = nvidia_utils.pci_driver_type_index(
+        vgpu_device_mappings)
     render(
         'remediate_nova_mdevs.py',
         '/opt/remediate-nova-mdevs',
-        {'mdev_types': vgpu_device_mappings},
+        {'pci_driver_types': pci_driver_types,
+         'sriov_pfs': nvidia_utils.sriov_physical_functions(
+             pci_driver_types)},
         perms=0o755)
 
     render(
         'systemd-mdev-workaround.service',
         '/etc/systemd/system/systemd-mdev-workaround.service',
-        {},
+        {'remediation_timeout': config.get('mdev-remediation-timeout') or 0},
         perms=0o644)
     service('enable', 'systemd-mdev-workaround')
     # enable but not start since this needs to be done once on boot
+
+    # The mdev ledger is snapshotted periodically and on shutdown by units
+    # of their own, so that it is kept up to date even if the remediation
+    # failed on boot.
+    for unit in ('systemd-mdev-ledger-snapshot.service',
+                 'systemd-mdev-ledger-snapshot.timer',
+                 'systemd-mdev-ledger-shutdown.service'):
+        render(unit, '/etc/systemd/system/{}'.format(unit), {}, perms=0o644)
+    for unit in ('systemd-mdev-ledger-snapshot.timer',
+                 'systemd-mdev-ledger-shutdown.service'):
+        service('enable', unit)
+        service('start', unit)
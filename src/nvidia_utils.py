@@ -15,18 +15,26 @@
 # limitations under the License.
 
 
+import collections
+import fnmatch
+import hashlib
+import io
+import json
 import logging
 import os
+import re
 from pathlib import Path
 
 from charmhelpers.core.hookenv import cached
 from charmhelpers.core.kernel import update_initramfs
 from charmhelpers.core.templating import render
-from charmhelpers.fetch import (
-    apt_cache,
-)
+from ruamel.yaml import YAML
 
-from pylspci.parsers import SimpleParser
+try:
+    from pylspci.parsers import SimpleParser
+except ImportError:
+    # NOTE: lspci is only used as a fallback when sysfs can't be read.
+    SimpleParser = None
 
 
 def installed_nvidia_software_versions():
@@ -60,53 +68,239 @@ def disable_nouveau_driver():
     update_initramfs()
 
 
-GPU_DEVICE_CLASS = '0x030200'
+PCI_DEVICES_DIR = '/sys/bus/pci/devices'
+NVIDIA_VENDOR_ID = 0x10de
+# 3D controller class, regardless of the programming interface:
+PCI_CLASS_3D_CONTROLLER = 0x0302
+VGPU_TYPES_DIRNAME = 'mdev_supported_types'
 
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+GPU_INVENTORY_FILE = '/var/lib/nova-compute-nvidia-vgpu/gpu-inventory.json'
 
-def list_vgpu_types():
-    """Human-readable list of all vGPU types registered by the NVIDIA driver.
+# A PCI device as detected on the host. Numeric fields are None when unknown.
+PciDevice = collections.namedtuple(
+    'PciDevice',
+    ['address', 'vendor', 'device', 'subsystem_vendor', 'device_class'])
 
+
+def _read_sysfs_attribute(device_dir, attribute):
+    """Read a sysfs attribute file of a device.
+
+    :param device_dir: Path to the sysfs directory of the device.
+    :type device_dir: str
+    :param attribute: Name of the attribute file, e.g. 'vendor'.
+    :type attribute: str
+    :returns: Content of the attribute file, or None if it can't be read.
+    :rtype: Optional[str]
+    """
+    try:
+        return Path(device_dir, attribute).read_text().rstrip()
+    except OSError:
+        return None
+
+
+def _read_sysfs_hex_attribute(device_dir, attribute):
+    """Read a sysfs attribute file holding a hexadecimal number, e.g. 0x10de.
+
+    :returns: Value of the attribute, or None if it can't be read.
+    :rtype: Optional[int]
+    """
+    value = _read_sysfs_attribute(device_dir, attribute)
+    try:
+        return int(value, 16)
+    except (TypeError, ValueError):
+        return None
+
+
+def _pci_addresses():
+    """List the addresses of all PCI devices known to sysfs.
+
+    :returns: Sorted PCI addresses, e.g. ['0000:00:00.0', '0000:41:00.0']
+    :rtype: List[str]
+    """
+    try:
+        return sorted(os.listdir(PCI_DEVICES_DIR))
+    except FileNotFoundError:
+        logging.debug('{} not found.'.format(PCI_DEVICES_DIR))
+        return []
+
+
+def _scan_nvidia_gpus():
+    """Scan sysfs for NVIDIA GPUs.
+
+    A GPU is a 3D controller, whatever its programming interface, made by
+    NVIDIA or sold by another vendor with an NVIDIA subsystem. Other types of
+    device can present mediated devices, hence the class check.
+
+    Only the flat list of PCI devices is scanned, and devices are filtered on
+    class and vendor before anything else is read. This is much cheaper than
+    walking /sys/devices, which contains tens of thousands of directories on
+    SR-IOV hosts.
+
+    :returns: NVIDIA GPUs found, sorted by PCI address.
+    :rtype: List[PciDevice]
+    """
+    devices = []
+    for pci_addr in _pci_addresses():
+        device_dir = os.path.join(PCI_DEVICES_DIR, pci_addr)
+        device_class = _read_sysfs_hex_attribute(device_dir, 'class')
+        if (device_class is None or
+                device_class >> 8 != PCI_CLASS_3D_CONTROLLER):
+            continue
+
+        vendor = _read_sysfs_hex_attribute(device_dir, 'vendor')
+        subsystem_vendor = _read_sysfs_hex_attribute(device_dir,
+                                                     'subsystem_vendor')
+        if NVIDIA_VENDOR_ID not in (vendor, subsystem_vendor):
+            continue
+
+        devices.append(PciDevice(
+            address=pci_addr,
+            vendor=vendor,
+            device=_read_sysfs_hex_attribute(device_dir, 'device'),
+            subsystem_vendor=subsystem_vendor,
+            device_class=device_class))
+
+    return devices
+
+
+def nvidia_gpu_device_dirs():
+    """List the sysfs directories of all NVIDIA GPUs.
+
+    See _scan_nvidia_gpus() for what is considered a GPU.
+
+    :returns: Paths like /sys/bus/pci/devices/0000:41:00.0, sorted by PCI
+              address.
+    :rtype: List[str]
+    """
+    return [os.path.join(PCI_DEVICES_DIR, device.address)
+            for device in _scan_nvidia_gpus()]
+
+
+def vgpu_capable_device_dirs():
+    """List the sysfs directories of all NVIDIA GPUs presenting vGPU types.
+
+    :returns: Paths like /sys/bus/pci/devices/0000:41:00.0, sorted by PCI
+              address.
+    :rtype: List[str]
+    """
+    return [device_dir for device_dir in nvidia_gpu_device_dirs()
+            if os.path.isdir(os.path.join(device_dir, VGPU_TYPES_DIRNAME))]
+
+
+def list_vgpu_types(output_format='text', pci_address=None, type_name=None,
+                    min_framebuffer=None):
+    """List the vGPU types registered by the NVIDIA driver.
+
+    :param output_format: 'text' for a human-readable list, 'json' or
+                          'yaml'.
+    :type output_format: str
+    :param pci_address: See vgpu_types().
+    :param type_name: See vgpu_types().
+    :param min_framebuffer: See vgpu_types().
     :rtype: str
+    :raises: ValueError if the output format is unknown.
+    """
+    records = vgpu_types(pci_address=pci_address, type_name=type_name,
+                         min_framebuffer=min_framebuffer)
+
+    if output_format == 'json':
+        return json.dumps(records, indent=2)
+
+    if output_format == 'yaml':
+        stream = io.StringIO()
+        yaml = YAML()
+        yaml.default_flow_style = False
+        yaml.dump(records, stream)
+        return stream.getvalue()
+
+    if output_format != 'text':
+        raise ValueError("Unknown output format '{}'".format(output_format))
+
+    # At this point each output line looks like
+    # nvidia-256, 0000:41:00.0, GRID RTX6000-1Q, num_heads=4,
+    #   frl_config=60, framebuffer=1024M, max_resolution=5120x2880,
+    #   max_instance=24
+    return '\n'.join(
+        ', '.join((record['type'], record['pci_address'], record['name'],
+                   record['description']))
+        for record in records)
+
+
+# Fields of vGPU type descriptions holding numbers:
+VGPU_TYPE_INT_FIELDS = ('num_heads', 'frl_config', 'max_instance')
+
+
+def vgpu_types(pci_address=None, type_name=None, min_framebuffer=None):
+    """Get all vGPU types registered by the NVIDIA driver.
+
+    :param pci_address: Only list the vGPU types of GPUs whose PCI address
+                        matches this shell-style wildcard pattern.
+    :type pci_address: Optional[str]
+    :param type_name: Only list the vGPU types whose type, e.g. nvidia-256,
+                      or name, e.g. GRID RTX6000-1Q, matches this
+                      shell-style wildcard pattern.
+    :type type_name: Optional[str]
+    :param min_framebuffer: Only list the vGPU types with at least this
+                            framebuffer size, in MB.
+    :type min_framebuffer: Optional[int]
+    :returns: One record per vGPU type and GPU, with the 'type', the
+              'pci_address' of the GPU, the 'parent' physical GPU if it is a
+              virtual function, the 'name', 'description',
+              'available_instances', 'device_api' and the fields of the
+              description, e.g. 'framebuffer' in MB or 'max_instance'.
+    :rtype: List[Dict[str, any]]
     """
     # NOTE(lourot): we are reinventing `mdevctl types` here. Unfortunately
     # `mdevctl` is not available on Bionic.
 
-    vgpu_types_dirname = 'mdev_supported_types'
-    found_pci_addr_dirs = []
-    for root, dirs, files in os.walk('/sys/devices'):
-        if vgpu_types_dirname in dirs:
-            # Other types of device can present mediated devices
-            # so ensure that only 3D controller class devices
-            # are listed
-            device_class = (
-                Path(os.path.join(root, 'class')).read_text().rstrip()
-            )
-            if device_class != GPU_DEVICE_CLASS:
+    records = []
+    for pci_addr_dir in vgpu_capable_device_dirs():
+        pci_addr = os.path.basename(pci_addr_dir)
+        if pci_address and not fnmatch.fnmatch(pci_addr,
+                                               pci_address.lower()):
+            continue
+
+        physfn_link = os.path.join(pci_addr_dir, 'physfn')
+        parent = (os.path.basename(os.path.realpath(physfn_link))
+                  if os.path.islink(physfn_link) else None)
+        root = os.path.join(pci_addr_dir, VGPU_TYPES_DIRNAME)
+        for vgpu_type in sorted(os.listdir(root)):
+            vgpu_type_dir = os.path.join(root, vgpu_type)
+            name = _read_sysfs_attribute(vgpu_type_dir, 'name') or ''
+            if type_name and not (fnmatch.fnmatch(vgpu_type, type_name) or
+                                  fnmatch.fnmatch(name, type_name)):
                 continue
-            # At this point root looks like
-            # /sys/devices/pci0000:40/0000:40:03.1/0000:41:00.0
-            found_pci_addr_dirs.append(root)
 
-    output_lines = []
-    for pci_addr_dir in found_pci_addr_dirs:
-        root = os.path.join(pci_addr_dir, vgpu_types_dirname)
-        for vgpu_type in sorted(os.listdir(root)):
-            output_line = vgpu_type
-            output_line += ', ' + os.path.basename(pci_addr_dir)
-            output_line += (
-                ', ' + Path(os.path.join(root, vgpu_type, 'name')
-                            ).read_text().rstrip())
-            output_line += (
-                ', ' + Path(os.path.join(root, vgpu_type, 'description')
-                            ).read_text().rstrip())
+            description = _read_sysfs_attribute(vgpu_type_dir,
+                                                'description') or ''
+            record = {
+                'type': vgpu_type,
+                'pci_address': pci_addr,
+                'parent': parent,
+                'name': name,
+                'description': description,
+            }
+            for key, value in parse_vgpu_type_description(
+                    description).items():
+                if key == 'framebuffer':
+                    value = parse_size_mb(value)
+                elif key in VGPU_TYPE_INT_FIELDS and value.isdigit():
+                    value = int(value)
+                record[key] = value
+            if (min_framebuffer and
+                    (record.get('framebuffer') or 0) < min_framebuffer):
+                continue
 
-            # At this point output_line looks like
-            # nvidia-256, 0000:41:00.0, GRID RTX6000-1Q, num_heads=4,
-            #   frl_config=60, framebuffer=1024M, max_resolution=5120x2880,
-            #   max_instance=24
-            output_lines.append(output_line)
+            available_instances = _read_sysfs_attribute(
+                vgpu_type_dir, 'available_instances')
+            record['available_instances'] = (
+                int(available_instances) if available_instances else None)
+            record['device_api'] = _read_sysfs_attribute(vgpu_type_dir,
+                                                         'device_api')
+            records.append(record)
 
-    return '\n'.join(output_lines)
+    return records
 
 
 @cached
@@ -121,26 +315,554 @@ def has_nvidia_gpu_hardware():
 
 
 def _has_nvidia_gpu_hardware_notcached():
-    num_nvidia_devices = 0
+    devices = gpu_inventory()['devices']
+    return len(devices) > 0, len(devices)
+
+
+def gpu_inventory(refresh=False):
+    """Get the inventory of NVIDIA GPUs on this host.
+
+    GPUs can't change without a reboot, so the inventory is persisted across
+    hooks and only re-scanned when the boot ID changes, when virtual functions
+    or vGPU types have appeared since the last scan, or when a refresh is
+    forced.
+
+    :param refresh: Re-scan the hardware even if the inventory is current.
+    :type refresh: bool
+    :returns: Dictionary with the 'boot_id' it is valid for and the list of
+              'devices'. Each device is a dictionary with the PciDevice
+              fields, 'physfn' (PCI address of the physical function if the
+              device is a virtual function), 'sriov_numvfs',
+              'sriov_totalvfs' and 'vgpu_types' (map of vGPU type to its
+              'name' and 'description').
+    :rtype: Dict[str, any]
+    """
+    boot_id = current_boot_id()
+    if not refresh:
+        inventory = _load_gpu_inventory()
+        if _is_gpu_inventory_current(inventory, boot_id):
+            return inventory
+
+    logging.info('Scanning NVIDIA GPU hardware.')
+    inventory = {
+        'boot_id': boot_id,
+        'devices': [_describe_gpu(device) for device in detect_nvidia_gpus()],
+    }
+    _save_gpu_inventory(inventory)
+    return inventory
+
+
+def gpu_inventory_fingerprint():
+    """Get a digest of the GPU inventory.
+
+    It changes whenever GPUs, their virtual functions or their vGPU types
+    change, e.g. once SR-IOV is enabled on boot, and with them the PCI
+    addresses the vGPU device mappings expand to.
+
+    :rtype: str
+    """
+    return hashlib.md5(json.dumps(gpu_inventory()['devices'],
+                                  sort_keys=True).encode()).hexdigest()
+
+
+def current_boot_id():
+    """Get the ID of the current boot, which changes on every reboot.
+
+    :returns: The boot ID, or None if it can't be read.
+    :rtype: Optional[str]
+    """
+    try:
+        return Path(BOOT_ID_FILE).read_text().strip()
+    except OSError:
+        return None
+
+
+def _describe_gpu(device):
+    """Gather the inventory details of a GPU.
+
+    :type device: PciDevice
+    :rtype: Dict[str, any]
+    """
+    device_dir = os.path.join(PCI_DEVICES_DIR, device.address)
+    physfn_link = os.path.join(device_dir, 'physfn')
+    sriov_numvfs = _read_sysfs_attribute(device_dir, 'sriov_numvfs')
+    sriov_totalvfs = _read_sysfs_attribute(device_dir, 'sriov_totalvfs')
+
+    vgpu_types = {}
+    vgpu_types_dir = os.path.join(device_dir, VGPU_TYPES_DIRNAME)
+    if os.path.isdir(vgpu_types_dir):
+        for vgpu_type in sorted(os.listdir(vgpu_types_dir)):
+            vgpu_type_dir = os.path.join(vgpu_types_dir, vgpu_type)
+            vgpu_types[vgpu_type] = {
+                'name': _read_sysfs_attribute(vgpu_type_dir, 'name'),
+                'description': _read_sysfs_attribute(vgpu_type_dir,
+                                                     'description'),
+            }
+
+    result = device._asdict()
+    result.update({
+        'physfn': (os.path.basename(os.path.realpath(physfn_link))
+                   if os.path.islink(physfn_link) else None),
+        'sriov_numvfs': int(sriov_numvfs) if sriov_numvfs else None,
+        'sriov_totalvfs': int(sriov_totalvfs) if sriov_totalvfs else None,
+        'vgpu_types': vgpu_types,
+    })
+    return result
+
+
+def _is_gpu_inventory_current(inventory, boot_id):
+    """Check cheaply whether a persisted GPU inventory is still valid.
+
+    :type inventory: Optional[Dict[str, any]]
+    :param boot_id: Current boot ID.
+    :type boot_id: str
+    :rtype: bool
+    """
+    if inventory is None:
+        return False
+
+    if boot_id is None or inventory.get('boot_id') != boot_id:
+        logging.debug('Boot ID changed, GPU inventory is stale.')
+        return False
+
+    for device in inventory['devices']:
+        device_dir = os.path.join(PCI_DEVICES_DIR, device['address'])
+        if device['sriov_totalvfs']:
+            sriov_numvfs = _read_sysfs_attribute(device_dir, 'sriov_numvfs')
+            if str(device['sriov_numvfs']) != sriov_numvfs:
+                logging.debug('Virtual functions of {} changed, GPU '
+                              'inventory is stale.'.format(device['address']))
+                return False
+        # NOTE: vGPU types only appear once the NVIDIA driver is loaded,
+        # which may happen after the inventory has been taken.
+        if not device['vgpu_types'] and os.path.isdir(
+                os.path.join(device_dir, VGPU_TYPES_DIRNAME)):
+            logging.debug('vGPU types of {} appeared, GPU inventory is '
+                          'stale.'.format(device['address']))
+            return False
+
+    return True
+
+
+def _load_gpu_inventory():
+    """Load the persisted GPU inventory.
+
+    :returns: The inventory, or None if none could be loaded.
+    :rtype: Optional[Dict[str, any]]
+    """
+    try:
+        with open(GPU_INVENTORY_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning('Failed to load GPU inventory from {}: {}'.format(
+            GPU_INVENTORY_FILE, e))
+        return None
+
+
+def _save_gpu_inventory(inventory):
+    """Persist the GPU inventory atomically.
+
+    :type inventory: Dict[str, any]
+    """
+    try:
+        os.makedirs(os.path.dirname(GPU_INVENTORY_FILE), exist_ok=True)
+        tmp_file = GPU_INVENTORY_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(inventory, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, GPU_INVENTORY_FILE)
+    except OSError as e:
+        logging.warning('Failed to save GPU inventory to {}: {}'.format(
+            GPU_INVENTORY_FILE, e))
+
+
+def detect_nvidia_gpus():
+    """Detect NVIDIA GPU hardware.
+
+    PCI device attributes are read from sysfs and matched numerically, see
+    _scan_nvidia_gpus(). lspci is only used as a fallback when sysfs isn't
+    available.
+
+    :returns: NVIDIA GPUs found, sorted by PCI address.
+    :rtype: List[PciDevice]
+    """
+    if not os.path.isdir(PCI_DEVICES_DIR) and SimpleParser is not None:
+        logging.debug('{} not found, falling back to lspci.'.format(
+            PCI_DEVICES_DIR))
+        return _detect_nvidia_gpus_with_lspci()
+
+    devices = _scan_nvidia_gpus()
+    # NOTE(lourot): it's interesting for debugging purposes to print them
+    # all.
+    for device in devices:
+        logging.debug('NVIDIA GPU found: {}'.format(device))
+
+    if not devices:
+        logging.debug('No NVIDIA GPU found.')
+
+    return devices
+
+
+def _detect_nvidia_gpus_with_lspci():
+    """Detect NVIDIA GPU hardware by parsing the output of lspci.
+
+    :rtype: List[PciDevice]
+    """
+    devices = []
     for device in SimpleParser().run():
         device_class = device.cls.name
         device_vendor = device.vendor.name
-        try:
-            device_subsystem_vendor = device.subsystem_vendor.name
-        except AttributeError:
-            device_subsystem_vendor = ''
+        subsystem_vendor = getattr(device, 'subsystem_vendor', None)
+        device_subsystem_vendor = getattr(subsystem_vendor, 'name', None) or ''
         logging.debug(device_class)
         if '3D' in device_class and ('NVIDIA' in device_vendor or
                                      'NVIDIA' in device_subsystem_vendor):
             logging.debug('NVIDIA GPU found: {}'.format(device))
-            # NOTE(lourot): we could `break` out here but it's interesting
-            # for debugging purposes to print them all.
-            num_nvidia_devices += 1
-
-    if num_nvidia_devices == 0:
+            devices.append(PciDevice(
+                address=str(device.slot),
+                vendor=device.vendor.id,
+                device=device.device.id,
+                subsystem_vendor=getattr(subsystem_vendor, 'id', None),
+                device_class=device.cls.id))
+
+    if not devices:
         logging.debug('No NVIDIA GPU found.')
 
-    return num_nvidia_devices > 0, num_nvidia_devices
+    return devices
+
+
+PCI_ADDRESS_REGEX = re.compile(
+    r'^([0-9a-f]{4}):([0-9a-f]{2}):([0-9a-f]{2})\.([0-7])$')
+VFS_PATTERN_PREFIX = 'vfs:'
+
+
+def _parse_pci_address(pci_addr):
+    """Parse a full PCI address like 0000:41:00.4
+
+    :returns: Domain, bus, slot and function numbers.
+    :rtype: Tuple[int, int, int, int]
+    :raises: ValueError
+    """
+    match = PCI_ADDRESS_REGEX.match(pci_addr.lower())
+    if not match:
+        raise ValueError("Invalid PCI address '{}'".format(pci_addr))
+    return tuple(int(part, 16) for part in match.groups())
+
+
+def _is_pci_address_pattern(pci_addr):
+    return (pci_addr.startswith(VFS_PATTERN_PREFIX) or '-' in pci_addr or
+            any(char in pci_addr for char in '*?['))
+
+
+def expand_pci_addresses(patterns):
+    """Expand compact PCI address patterns against the GPU inventory.
+
+    Besides plain PCI addresses, which are kept as they are, the following
+    patterns are supported, only matching GPUs which present vGPU types, e.g.
+    not the physical functions of SR-IOV GPUs:
+
+    * 0000:41:00.4-0000:41:03.7 - all GPUs in this range, both ends included.
+    * 0000:41:*.* - all GPUs matching this shell-style wildcard pattern.
+    * vfs:0000:41:00.0 - all virtual functions of this physical GPU.
+
+    :param patterns: PCI addresses and patterns.
+    :type patterns: List[str]
+    :returns: PCI addresses, without duplicates.
+    :rtype: List[str]
+    :raises: ValueError if a pattern is invalid.
+    """
+    if not any(_is_pci_address_pattern(str(pattern))
+               for pattern in patterns):
+        return list(patterns)
+
+    devices = _vgpu_capable_devices()
+    result = []
+    for pattern in patterns:
+        matches = _match_pci_address_pattern(str(pattern).strip(), devices)
+        if not matches:
+            logging.warning("PCI address pattern '{}' doesn't match any "
+                            "GPU".format(pattern))
+        for pci_addr in matches:
+            if pci_addr not in result:
+                result.append(pci_addr)
+
+    return result
+
+
+def unmatched_pci_address_patterns(patterns):
+    """Find the PCI address patterns which don't match any GPU.
+
+    :param patterns: PCI addresses and patterns, see expand_pci_addresses().
+    :type patterns: List[str]
+    :returns: The patterns expanding to no PCI address.
+    :rtype: List[str]
+    :raises: ValueError if a pattern is invalid.
+    """
+    patterns = [str(pattern).strip() for pattern in patterns
+                if _is_pci_address_pattern(str(pattern))]
+    if not patterns:
+        return []
+
+    devices = _vgpu_capable_devices()
+    return [pattern for pattern in patterns
+            if not _match_pci_address_pattern(pattern, devices)]
+
+
+def _vgpu_capable_devices():
+    """Get the devices of the GPU inventory presenting vGPU types.
+
+    :rtype: List[Dict[str, any]]
+    """
+    return [device for device in gpu_inventory()['devices']
+            if device['vgpu_types']]
+
+
+def _match_pci_address_pattern(pattern, devices):
+    """Expand a PCI address pattern against some devices.
+
+    :param pattern: PCI address or pattern, see expand_pci_addresses().
+    :type pattern: str
+    :param devices: Devices from the GPU inventory.
+    :type devices: List[Dict[str, any]]
+    :returns: Matching PCI addresses, or the PCI address itself if it isn't
+              a pattern.
+    :rtype: List[str]
+    :raises: ValueError if the pattern is invalid.
+    """
+    if not _is_pci_address_pattern(pattern):
+        return [pattern]
+
+    if pattern.startswith(VFS_PATTERN_PREFIX):
+        physfn = pattern[len(VFS_PATTERN_PREFIX):].lower()
+        _parse_pci_address(physfn)
+        return [device['address'] for device in devices
+                if device['physfn'] == physfn]
+
+    if '-' in pattern:
+        first, last = (_parse_pci_address(pci_addr.strip())
+                       for pci_addr in pattern.split('-', 1))
+        return [device['address'] for device in devices
+                if first <= _parse_pci_address(device['address']) <= last]
+
+    return [device['address'] for device in devices
+            if fnmatch.fnmatch(device['address'], pattern.lower())]
+
+
+def normalise_pci_address(pci_addr):
+    """Normalise a PCI address the way nova and sysfs format them.
+
+    E.g. 84:00.0 and 0000:84:00.0 both become 0000:84:00.0, and hex digits
+    are lowercased. Addresses which can't be parsed are only lowercased.
+
+    :rtype: str
+    """
+    pci_addr = str(pci_addr).strip().lower()
+    if PCI_ADDRESS_REGEX.match('0000:' + pci_addr):
+        return '0000:' + pci_addr
+    return pci_addr
+
+
+def pci_driver_type_index(vgpu_device_mappings):
+    """Index vGPU device mappings by normalised PCI address.
+
+    If a PCI address is mapped to several vGPU types, the first one wins,
+    as it did when the mappings were searched in order.
+
+    :param vgpu_device_mappings: Map of vGPU types to PCI addresses.
+    :type vgpu_device_mappings: Dict[str, List[str]]
+    :returns: Map of PCI addresses to vGPU types.
+    :rtype: Dict[str, str]
+    """
+    index = {}
+    for vgpu_type, pci_addresses in vgpu_device_mappings.items():
+        for pci_addr in pci_addresses:
+            pci_addr = normalise_pci_address(pci_addr)
+            if index.setdefault(pci_addr, vgpu_type) != vgpu_type:
+                logging.warning("PCI address {} is mapped to both {} and {}, "
+                                "using {}".format(pci_addr, index[pci_addr],
+                                                  vgpu_type,
+                                                  index[pci_addr]))
+    return index
+
+
+def sriov_physical_functions(pci_addresses):
+    """Find the SR-IOV physical functions of some GPUs.
+
+    :param pci_addresses: PCI addresses of the GPUs, e.g. virtual functions.
+    :type pci_addresses: Iterable[str]
+    :returns: Sorted PCI addresses of the physical functions whose virtual
+              functions are among the GPUs, or None if some of the GPUs
+              aren't known, e.g. because their virtual functions aren't
+              enabled yet.
+    :rtype: Optional[List[str]]
+    """
+    pci_addresses = {normalise_pci_address(a) for a in pci_addresses}
+    if not pci_addresses:
+        return None
+
+    devices = {device['address']: device
+               for device in gpu_inventory()['devices']}
+    physfns = set()
+    for pci_addr in pci_addresses:
+        device = devices.get(pci_addr)
+        if device is None:
+            return None
+        if device['physfn']:
+            physfns.add(device['physfn'])
+    return sorted(physfns)
+
+
+AUTO_MAPPINGS_PREFIX = 'auto:'
+SIZE_REGEX = re.compile(r'^(\d+)\s*([MG]?)B?$', re.IGNORECASE)
+
+
+def parse_vgpu_type_description(description):
+    """Parse the description of a vGPU type as registered by the driver.
+
+    :param description: Description like 'num_heads=4, frl_config=60,
+                        framebuffer=1024M, max_resolution=5120x2880,
+                        max_instance=24'
+    :type description: str
+    :returns: Map of field names to values.
+    :rtype: Dict[str, str]
+    """
+    result = {}
+    for field in (description or '').split(','):
+        key, separator, value = field.partition('=')
+        if separator:
+            result[key.strip()] = value.strip()
+    return result
+
+
+def parse_size_mb(size):
+    """Parse a size like 1024M or 16G into MB.
+
+    :rtype: Optional[int]
+    """
+    match = SIZE_REGEX.match((size or '').strip())
+    if not match:
+        return None
+    value, unit = int(match.group(1)), match.group(2).upper()
+    return value * 1024 if unit == 'G' else value
+
+
+def is_auto_vgpu_device_mappings(vgpu_device_mappings_str):
+    """Whether vGPU device mappings are to be generated, e.g. 'auto:...'"""
+    return (vgpu_device_mappings_str or '').strip().startswith(
+        AUTO_MAPPINGS_PREFIX)
+
+
+def auto_vgpu_device_mappings(vgpu_device_mappings_str):
+    """Generate vGPU device mappings from the detected hardware.
+
+    One vGPU type is selected per physical GPU, among the types presented by
+    the GPU or by its virtual functions, according to a policy:
+
+    * auto:max-instances - the type allowing the most vGPUs per GPU, i.e.
+      the highest max_instance. Ties are broken with the largest
+      framebuffer.
+    * auto:framebuffer=4096M - the type with the smallest framebuffer of at
+      least the given size, 4096 MB here. Ties are broken with the highest
+      max_instance.
+
+    The policy can be followed by a suffix restricting the vGPU type names,
+    e.g. auto:max-instances:Q only considers Q-series types like
+    'GRID RTX6000-1Q'. GPUs on which vGPUs already exist keep their current
+    type.
+
+    :param vgpu_device_mappings_str: Value of the vgpu-device-mappings
+                                     config option.
+    :type vgpu_device_mappings_str: str
+    :returns: Map of vGPU types to PCI addresses.
+    :rtype: Dict[str, List[str]]
+    :raises: ValueError if the policy is invalid.
+    """
+    policy, _, name_suffix = vgpu_device_mappings_str.strip()[
+        len(AUTO_MAPPINGS_PREFIX):].partition(':')
+    policy_name, _, policy_arg = policy.partition('=')
+    if policy_name == 'max-instances' and not policy_arg:
+        def sort_key(vgpu_type):
+            return (vgpu_type['max_instance'], vgpu_type['framebuffer'])
+        min_framebuffer = 0
+    elif policy_name == 'framebuffer' and parse_size_mb(policy_arg):
+        def sort_key(vgpu_type):
+            return (-vgpu_type['framebuffer'], vgpu_type['max_instance'])
+        min_framebuffer = parse_size_mb(policy_arg)
+    else:
+        raise ValueError("Invalid vGPU device mappings policy '{}'".format(
+            policy))
+
+    # Group the devices presenting vGPU types by physical GPU:
+    gpus = collections.OrderedDict()
+    for device in gpu_inventory()['devices']:
+        if device['vgpu_types']:
+            gpus.setdefault(device['physfn'] or device['address'],
+                            []).append(device)
+
+    result = {}
+    for physical_gpu, devices in gpus.items():
+        vgpu_type = _vgpu_type_in_use(devices)
+        if vgpu_type is not None:
+            logging.info('Keeping vGPU type {} already in use on {}'.format(
+                vgpu_type, physical_gpu))
+        else:
+            candidates = []
+            for name, details in devices[0]['vgpu_types'].items():
+                fields = parse_vgpu_type_description(details['description'])
+                try:
+                    max_instance = int(fields.get('max_instance', 0))
+                except ValueError:
+                    logging.warning(
+                        'Skipping vGPU type {} of {} with malformed '
+                        'description: {}'.format(name, physical_gpu,
+                                                 details['description']))
+                    continue
+                candidate = {
+                    'type': name,
+                    'framebuffer': parse_size_mb(fields.get('framebuffer')),
+                    'max_instance': max_instance,
+                }
+                if (candidate['framebuffer'] is not None and
+                        candidate['framebuffer'] >= min_framebuffer and
+                        (details['name'] or '').endswith(name_suffix)):
+                    candidates.append(candidate)
+            if not candidates:
+                logging.warning('No vGPU type of {} matches {}'.format(
+                    physical_gpu, vgpu_device_mappings_str))
+                continue
+            vgpu_type = max(candidates, key=sort_key)['type']
+            logging.info('Selected vGPU type {} for {}'.format(
+                vgpu_type, physical_gpu))
+
+        result.setdefault(vgpu_type, []).extend(
+            device['address'] for device in devices
+            if vgpu_type in device['vgpu_types'])
+
+    return result
+
+
+def _vgpu_type_in_use(devices):
+    """Find the vGPU type of the vGPUs already existing on some devices.
+
+    :param devices: Devices from the GPU inventory.
+    :type devices: List[Dict[str, any]]
+    :rtype: Optional[str]
+    """
+    for device in devices:
+        for vgpu_type in device['vgpu_types']:
+            mdevs_dir = os.path.join(PCI_DEVICES_DIR, device['address'],
+                                     VGPU_TYPES_DIRNAME, vgpu_type, 'devices')
+            try:
+                if os.listdir(mdevs_dir):
+                    return vgpu_type
+            except OSError:
+                continue
+    return None
+
+
+NVIDIA_SOFTWARE_PACKAGES = 'nvidia-vgpu-ubuntu-*'
+DPKG_STATUS_FILE = '/var/lib/dpkg/status'
 
 
 def _installed_nvidia_software_packages():
@@ -149,4 +871,113 @@ def _installed_nvidia_software_packages():
     :returns: List of packages
     :rtype: List[Dict[str, str]]
     """
-    return apt_cache().dpkg_list(['nvidia-vgpu-ubuntu-*']).values()
+    return dpkg_inventory().packages(NVIDIA_SOFTWARE_PACKAGES)
+
+
+class DpkgInventory:
+    """Installed Debian packages, as recorded in the dpkg status file."""
+
+    def __init__(self, packages, mtime_ns):
+        """
+        :param packages: Map of package name to package details.
+        :type packages: Dict[str, Dict[str, str]]
+        :param mtime_ns: Modification time of the dpkg status file the
+                         packages have been read from.
+        :type mtime_ns: int
+        """
+        self._packages = packages
+        self.mtime_ns = mtime_ns
+
+    @classmethod
+    def load(cls, path):
+        """Parse the dpkg status file in a single streaming pass.
+
+        Only packages in the same states as reported by
+        `apt_cache().dpkg_list()` are kept, i.e. installed packages whose
+        desired state is install or hold.
+
+        :param path: Path to the dpkg status file.
+        :type path: str
+        :rtype: DpkgInventory
+        """
+        packages = {}
+        with open(path, encoding='utf-8', errors='replace') as f:
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            fields = {}
+            for line in f:
+                if not line.strip():
+                    cls._add_package(packages, fields)
+                    fields = {}
+                elif not line[0].isspace():
+                    # NOTE: continuation lines, e.g. the long description,
+                    # start with a space and are skipped.
+                    key, _, value = line.partition(':')
+                    fields[key] = value.strip()
+            cls._add_package(packages, fields)
+
+        return cls(packages, mtime_ns)
+
+    @staticmethod
+    def _add_package(packages, fields):
+        status = fields.get('Status', '').split()
+        if (len(status) != 3 or status[0] not in ('install', 'hold') or
+                status[2] != 'installed'):
+            return
+
+        name = fields['Package']
+        packages[name] = {
+            'name': name,
+            'version': fields.get('Version'),
+            'architecture': fields.get('Architecture'),
+            'description': fields.get('Description'),
+        }
+
+    def packages(self, pattern='*'):
+        """Get the installed packages whose name matches a pattern.
+
+        :param pattern: Shell-style wildcard pattern, e.g. 'nvidia-*'
+        :type pattern: str
+        :returns: Package details, sorted by name.
+        :rtype: List[Dict[str, str]]
+        """
+        return [self._packages[name] for name in sorted(self._packages)
+                if fnmatch.fnmatchcase(name, pattern)]
+
+    def names(self, pattern='*'):
+        """Get the names of the installed packages matching a pattern.
+
+        :rtype: List[str]
+        """
+        return [package['name'] for package in self.packages(pattern)]
+
+    def versions(self, pattern='*'):
+        """Get the versions of the installed packages matching a pattern.
+
+        :rtype: List[str]
+        """
+        return [package['version'] for package in self.packages(pattern)]
+
+    def architectures(self, pattern='*'):
+        """Get the architectures of the installed packages matching a pattern.
+
+        :rtype: List[str]
+        """
+        return [package['architecture'] for package in self.packages(pattern)]
+
+
+_dpkg_inventory = None
+
+
+def dpkg_inventory():
+    """Get the installed Debian packages.
+
+    The dpkg status file is parsed at most once per hook, and again only if
+    it has been modified since, e.g. by installing the NVIDIA software.
+
+    :rtype: DpkgInventory
+    """
+    global _dpkg_inventory
+    mtime_ns = os.stat(DPKG_STATUS_FILE).st_mtime_ns
+    if _dpkg_inventory is None or _dpkg_inventory.mtime_ns != mtime_ns:
+        _dpkg_inventory = DpkgInventory.load(DPKG_STATUS_FILE)
+    return _dpkg_inventory
@@ -13,39 +13,465 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import argparse
+import configparser
+import json
 import logging
 import os
+import random
+import re
 import socket
-from functools import cached_property
-from time import sleep
-from xml.dom import minidom
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+    as_completed,
+)
+from contextlib import contextmanager
+from functools import cache, cached_property
+from time import monotonic, sleep
+from urllib.parse import quote
+from xml.etree import ElementTree
 
 import libvirt
-import nova.conf
-from nova.utils import get_sdk_adapter
-from nova.pci.utils import get_pci_address
 
 LOG = logging.getLogger(__name__)
-CONF = nova.conf.CONF
 
 NOVA_CONF = '/etc/nova/nova.conf'
-# Dictionary of mdev types and and address mappings
-MDEV_TYPES = {{ mdev_types }}  # noqa pylint: disable=unhashable-member,undefined-variable
+# How the Placement client is built: 'lean' reads the [placement] section of
+# nova.conf and only imports keystoneauth1, 'nova' loads the whole nova
+# config through the nova package, which is much slower to import. Lean mode
+# falls back to nova mode for options it doesn't handle.
+CLIENT_MODE = os.environ.get('MDEV_INIT_CLIENT_MODE', 'lean')
+# [placement] auth types handled in lean mode, with the password plugin
+LEAN_AUTH_TYPES = ('password', 'v3password')
+LEAN_AUTH_OPTIONS = ('auth_url', 'username', 'user_id', 'password',
+                     'project_name', 'project_id', 'user_domain_name',
+                     'user_domain_id', 'project_domain_name',
+                     'project_domain_id')
+# Other [placement] options handled in lean mode, any option not listed here
+# makes it fall back to nova mode. Retries are handled by the script and
+# timing collection isn't needed, so these options are ignored.
+LEAN_OPTIONS = frozenset(LEAN_AUTH_OPTIONS + (
+    'auth_type', 'cafile', 'certfile', 'keyfile', 'insecure', 'timeout',
+    'endpoint_override', 'valid_interfaces', 'region_name', 'os_region_name',
+    'connect_retries', 'connect_retry_delay', 'status_code_retries',
+    'status_code_retry_delay', 'collect_timing', 'split_loggers'))
+# Timeout of each Placement and Keystone request in lean mode, unless set by
+# the timeout option of the [placement] section
+PLACEMENT_TIMEOUT = float(os.environ.get('MDEV_INIT_PLACEMENT_TIMEOUT', 30))
+# Retry policy of Placement calls, see RetryPolicy. The deadline applies to
+# each call, retries of transient failures stop once it is reached.
+RETRY_DEADLINE = float(os.environ.get('MDEV_INIT_RETRY_DEADLINE', 120))
+RETRY_BASE_DELAY = float(os.environ.get('MDEV_INIT_RETRY_BASE_DELAY', 0.5))
+RETRY_MAX_DELAY = float(os.environ.get('MDEV_INIT_RETRY_MAX_DELAY', 10))
+# Responses and exceptions (by class name, as they may come from
+# keystoneauth1, requests or openstacksdk) worth retrying. OSError covers
+# refused connections and DNS resolution failures.
+TRANSIENT_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+TRANSIENT_ERRORS = frozenset(['ConnectFailure', 'ConnectionError', 'Timeout',
+                              'RetriableConnectionFailure'])
+PERMANENT_ERRORS = frozenset(['SSLError'])
+LIBVIRT_URI = 'qemu:///system'
+# Number of read-only libvirt connections domain XMLs are fetched over
+LIBVIRT_WORKERS = int(os.environ.get('MDEV_INIT_LIBVIRT_WORKERS', 4))
+# Time budget of a remediation run in seconds, 0 for none. Each phase has to
+# complete by its share of the budget, cumulated with the shares of the
+# phases before it. Work which doesn't complete in time is handed off to a
+# background continuation, so that nova-compute can start.
+REMEDIATION_TIMEOUT = float(os.environ.get('MDEV_INIT_TIMEOUT', 0))
+PHASE_BUDGETS = (('scan', 0.4), ('placement', 0.3), ('create', 0.3))
+CONTINUATION_UNIT = 'mdev-workaround-continuation'
+CONTINUATION = os.environ.get('MDEV_INIT_CONTINUATION') == '1'
+# The traits of the local resource providers aren't needed for nova-compute
+# to start, so the boot-time run reconciles them in the background, in a
+# transient unit only doing that.
+TRAITS_UNIT = 'mdev-workaround-traits'
+TRAITS_ONLY = os.environ.get('MDEV_INIT_TRAITS_ONLY') == '1'
+# Timings and counts of the last remediation and traits runs, see Report
+REMEDIATION_RESULT_FILE = ('/var/lib/nova-compute-nvidia-vgpu/'
+                           'remediation-result.json')
+TRAITS_RESULT_FILE = '/var/lib/nova-compute-nvidia-vgpu/traits-result.json'
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+UUID_REGEX = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+# Record of the parent GPU and type of the mdevs of each domain, see MdevLedger
+MDEV_LEDGER_FILE = '/var/lib/nova-compute-nvidia-vgpu/mdev-ledger.json'
+PCI_DEVICES_DIR = '/sys/bus/pci/devices'
+MDEV_DEVICES_DIR = '/sys/bus/mdev/devices'
+# Maximum number of physical GPUs whose mdevs are created concurrently, and
+# time after which an mdev creation is considered stuck
+MDEV_CREATE_WORKERS = int(os.environ.get('MDEV_INIT_CREATE_WORKERS', 16))
+MDEV_CREATE_TIMEOUT = float(os.environ.get('MDEV_INIT_CREATE_TIMEOUT', 30))
+SRIOV_MANAGE = '/usr/lib/nvidia/sriov-manage'
+NVIDIA_VENDOR_ID = '0x10de'
+# Maximum number of physical GPUs on which SR-IOV is enabled concurrently,
+# and time after which enabling it is considered failed
+SRIOV_WORKERS = int(os.environ.get('MDEV_INIT_SRIOV_WORKERS', 8))
+SRIOV_ENABLE_TIMEOUT = float(os.environ.get('MDEV_INIT_SRIOV_TIMEOUT', 120))
+# Number of resource providers whose traits are updated concurrently
+TRAITS_UPDATE_WORKERS = int(os.environ.get('MDEV_INIT_TRAITS_WORKERS', 8))
+TRAITS_UPDATE_ATTEMPTS = 3
+# Dictionary of normalised PCI addresses and their mdev type, indexing the
+# vgpu-device-mappings config option
+PCI_DRIVER_TYPES = {{ pci_driver_types }}  # noqa pylint: disable=unhashable-member,undefined-variable
+# List of the SR-IOV physical functions whose VFs are mapped, or None
+# if unknown, in which case SR-IOV is enabled on all NVIDIA GPUs
+SRIOV_PFS = {{ sriov_pfs }}  # noqa pylint: disable=undefined-variable
+
+
+# Resource provider with the PCI address of its GPU and the driver (mdev)
+# type mapped to it, if any.
+ResourceProvider = namedtuple('ResourceProvider',
+                              ['uuid', 'name', 'pci_address', 'driver_type'])
+
+Domain = namedtuple('Domain', ['uuid', 'name'])
+
+# Mediated device assigned to a domain, with the model and the guest PCI
+# address of its hostdev. error describes why the hostdev can't be
+# remediated, e.g. if its mdev uuid is missing.
+MdevHostdev = namedtuple('MdevHostdev', ['uuid', 'model', 'address', 'error'])
+
+# mdev to create, planned from the vGPU allocation of its domain
+MdevCreate = namedtuple('MdevCreate', ['pci_address', 'driver_type', 'uuid',
+                                       'domain_uuid'])
 
 
 class PlacementError(Exception):
     """ Raised when as error occurs in the PlacementHelper. """
 
 
+class PlacementConflictError(PlacementError):
+    """ Raised when a resource provider generation conflict occurs. """
+
+
 class RemediationFailedError(Exception):
     """ Raised when as error occurs during mdev remediation. """
 
 
+class DeadlineExceededError(Exception):
+    """ Raised when a remediation phase doesn't complete in time. """
+
+
+class MdevCreateTimeoutError(RemediationFailedError):
+    """ Raised when creating an mdev doesn't complete in time. """
+
+
+class Report():
+    """
+    Wall-clock timings and counts of a remediation run.
+
+    Timings are aggregated by name, e.g. all the requests to the same
+    Placement route, into their count, total and maximum duration.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counts = Counter()
+
+    @contextmanager
+    def timed(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add_timing(name, monotonic() - start)
+
+    def add_timing(self, name, duration):
+        with self.lock:
+            timing = self.timings.setdefault(
+                name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            timing['count'] += 1
+            timing['total'] += duration
+            timing['max'] = max(timing['max'], duration)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    def save(self, status, error=None, dry_run=False, path=None):
+        """ Write the report to path, REMEDIATION_RESULT_FILE by default. """
+        path = path or REMEDIATION_RESULT_FILE
+        try:
+            with open(BOOT_ID_FILE, encoding='utf-8') as f:
+                boot_id = f.read().strip()
+        except OSError:
+            boot_id = None
+
+        with self.lock:
+            result = {
+                'status': status,
+                'error': error,
+                'boot_id': boot_id,
+                'finished_at': time.time(),
+                'dry_run': dry_run,
+                'timeout': REMEDIATION_TIMEOUT,
+                'continuation': CONTINUATION,
+                'counts': dict(self.counts),
+                'timings': {
+                    name: {'count': timing['count'],
+                           'total': round(timing['total'], 6),
+                           'max': round(timing['max'], 6)}
+                    for name, timing in self.timings.items()},
+            }
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_file = path + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, path)
+        except OSError as exc:
+            LOG.warning("failed to save remediation result %s: %s", path,
+                        exc)
+
+
+REPORT = Report()
+
+
+def _exception_chain(exc):
+    """ Yield exc and the exceptions it was raised from or while handling. """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        yield exc
+        exc = exc.__cause__ or exc.__context__
+
+
+def is_transient_error(exc):
+    """
+    Whether an exception raised talking to Placement or Keystone is worth
+    retrying, e.g. connection refused or a 503 while Keystone starts, as
+    opposed to bad credentials or a bad certificate.
+
+    Exceptions are classified along with the exceptions they were raised
+    from, e.g. keystoneauth1 raises DiscoveryFailure over a ConnectFailure
+    when the auth_url has no version and Keystone is unreachable.
+    """
+    chain = list(_exception_chain(exc))
+    for link in chain:
+        status = (getattr(link, 'http_status', None) or
+                  getattr(link, 'status_code', None))
+        if status is not None:
+            return status in TRANSIENT_STATUS_CODES
+
+    names = {cls.__name__ for link in chain for cls in type(link).__mro__}
+    if names & PERMANENT_ERRORS:
+        return False
+
+    return (any(isinstance(link, OSError) for link in chain) or
+            bool(names & TRANSIENT_ERRORS))
+
+
+class RetryPolicy():
+    """
+    Retry transient failures with exponential backoff and jitter, until a
+    deadline.
+    """
+
+    def __init__(self, deadline=None, base_delay=None, max_delay=None):
+        self.deadline = RETRY_DEADLINE if deadline is None else deadline
+        self.base_delay = (RETRY_BASE_DELAY if base_delay is None
+                           else base_delay)
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+
+    def delays(self):
+        """
+        Yield the delays to sleep between attempts, until the deadline.
+
+        Delays double from base_delay up to max_delay, half of each being
+        random so that compute nodes rebooted together don't retry in step.
+        """
+        end = monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = end - monotonic()
+            if remaining <= 0:
+                return
+
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+            yield min(remaining, delay / 2 + random.uniform(0, delay / 2))
+            attempt += 1
+
+    def call(self, description, func, *args, **kwargs):
+        """
+        Call func until it neither raises a transient error nor returns a
+        response with a transient status code.
+
+        Once the deadline is reached the last transient error is raised, or
+        the last response returned.
+        """
+        delays = self.delays()
+        attempt = 1
+        while True:
+            error = response = None
+            try:
+                response = func(*args, **kwargs)
+            except Exception as exc:  # pylint: disable=broad-except
+                if not is_transient_error(exc):
+                    raise
+
+                error, reason = exc, exc
+            else:
+                status = getattr(response, 'status_code', None)
+                if status not in TRANSIENT_STATUS_CODES:
+                    return response
+
+                reason = f"status {status}"
+
+            delay = next(delays, None)
+            if delay is None:
+                LOG.error("%s failed after %s attempt(s): %s", description,
+                          attempt, reason)
+                if error is not None:
+                    raise error
+
+                return response
+
+            LOG.warning("%s failed (attempt=%s): %s - retrying in %.2fs",
+                        description, attempt, reason, delay)
+            sleep(delay)
+            attempt += 1
+
+
+def get_pci_address(domain, bus, slot, func):
+    """ Format a PCI address the way nova.pci.utils.get_pci_address does. """
+    return f'{domain}:{bus}:{slot}.{func}'
+
+
+def _load_placement_options():
+    """
+    Read the [placement] section of nova.conf.
+
+    Returns None if the section can't be read, e.g. if nova.conf uses
+    syntax only supported by oslo.config. As with oslo.config, options of
+    the [DEFAULT] section don't apply to [placement].
+    """
+    parser = configparser.RawConfigParser(strict=False,
+                                          default_section='lean:DEFAULT')
+    try:
+        if not parser.read(NOVA_CONF, encoding='utf-8'):
+            return None
+    except configparser.Error as exc:
+        LOG.warning("failed to parse %s: %s", NOVA_CONF, exc)
+        return None
+
+    if not parser.has_section('placement'):
+        return None
+
+    return dict(parser.items('placement'))
+
+
+def get_lean_adapter(service_type):
+    """
+    Build a keystoneauth1 adapter from the [placement] section of nova.conf
+    without importing nova.
+
+    Returns None if the options aren't supported in lean mode.
+    """
+    opts = _load_placement_options()
+    if opts is None:
+        LOG.info("no [placement] section found in %s", NOVA_CONF)
+        return None
+
+    auth_type = opts.get('auth_type', 'password')
+    if auth_type not in LEAN_AUTH_TYPES:
+        LOG.info("auth_type %s not supported in lean mode", auth_type)
+        return None
+
+    if not opts.get('auth_url'):
+        LOG.info("no auth_url found in the [placement] section of %s",
+                 NOVA_CONF)
+        return None
+
+    unsupported = sorted(opt for opt, value in opts.items()
+                         if value and opt not in LEAN_OPTIONS)
+    if unsupported:
+        LOG.info("[placement] options %s not supported in lean mode",
+                 ", ".join(unsupported))
+        return None
+
+    try:
+        timeout = float(opts.get('timeout') or PLACEMENT_TIMEOUT)
+    except ValueError:
+        LOG.info("invalid [placement] timeout %s", opts['timeout'])
+        return None
+
+    try:
+        # pylint: disable=import-outside-toplevel
+        from keystoneauth1 import adapter, session
+        from keystoneauth1.identity import generic, v3
+    except ImportError as exc:
+        LOG.info("keystoneauth1 not available: %s", exc)
+        return None
+
+    plugin = v3.Password if auth_type == 'v3password' else generic.Password
+    auth = plugin(**{opt: opts[opt] for opt in LEAN_AUTH_OPTIONS
+                     if opts.get(opt)})
+    verify = opts.get('cafile') or True
+    if opts.get('insecure', '').lower() == 'true':
+        verify = False
+
+    cert = opts.get('certfile') or None
+    if cert and opts.get('keyfile'):
+        cert = (cert, opts['keyfile'])
+
+    interfaces = opts.get('valid_interfaces', 'internal,public')
+    return adapter.Adapter(
+        session=session.Session(auth=auth, verify=verify, cert=cert,
+                                timeout=timeout),
+        service_type=service_type,
+        interface=[i.strip() for i in interfaces.split(',') if i.strip()],
+        region_name=opts.get('region_name') or opts.get('os_region_name'),
+        endpoint_override=opts.get('endpoint_override') or None,
+        raise_exc=False)
+
+
+@cache
+def _load_nova_conf():
+    # pylint: disable=import-outside-toplevel
+    import nova.conf
+
+    LOG.info("loading Nova config from %s", NOVA_CONF)
+    nova.conf.CONF(default_config_files=[NOVA_CONF])
+
+
+def get_nova_adapter(service_type):
+    """ Build an openstacksdk adapter from the nova config. """
+    # pylint: disable=import-outside-toplevel
+    from nova.utils import get_sdk_adapter
+
+    _load_nova_conf()
+    return get_sdk_adapter(service_type)
+
+
+def get_adapter(service_type):
+    if CLIENT_MODE == 'lean':
+        adapter = get_lean_adapter(service_type)
+        if adapter is not None:
+            return adapter
+
+        LOG.info("falling back to nova mode for the %s client", service_type)
+
+    return get_nova_adapter(service_type)
+
+
 class PlacementHelper():
     """
     Helper for Placement operations.
     """
     DRIVER_TRAIT_MAPPING = {'nvidia-610': 'CUSTOM_VGPU_PLACEMENT'}
+    # First microversion supporting the in_tree filter and returning
+    # root_provider_uuid:
+    IN_TREE_MICROVERSION = '1.14'
+
+    retry_policy = RetryPolicy()
 
     def __init__(self):
         self.fqdn = socket.getfqdn()
@@ -53,35 +479,46 @@ class PlacementHelper():
         if self.client is None:
             raise PlacementError("failed to get placement client")
 
-    @staticmethod
-    def _get_sdk_adapter_helper(service_type):
-        count = 1
-        while True:
-            LOG.info("fetching %s sdk adapter (attempt=%s)", service_type,
-                     count)
-            try:
-                return get_sdk_adapter(service_type)
-            except Exception as e:
-                count += 1
-                if count > 30:
-                    LOG.error(e)
-                    return None
-
-                LOG.warning("failed to get %s sdk adapter - trying again",
-                            service_type)
-                sleep(0.5)
+    @classmethod
+    def _get_sdk_adapter_helper(cls, service_type):
+        LOG.info("fetching %s sdk adapter", service_type)
+        try:
+            with REPORT.timed('adapter'):
+                return cls.retry_policy.call(
+                    f"fetching {service_type} adapter", get_adapter,
+                    service_type)
+        except Exception as e:  # pylint: disable=broad-except
+            LOG.error(e)
+            return None
+
+    def _request(self, method, url, **kwargs):
+        """
+        Send a request to Placement, retrying transient failures.
+
+        Errors which aren't transient, or still occurring at the deadline,
+        are raised as PlacementError.
+        """
+        description = f"{method.upper()} {url}"
+        route = UUID_REGEX.sub('{uuid}', url.split('?')[0])
+        try:
+            with REPORT.timed(f"placement {method.upper()} {route}"):
+                return self.retry_policy.call(description,
+                                              getattr(self.client, method),
+                                              url, **kwargs)
+        except Exception as exc:  # pylint: disable=broad-except
+            raise PlacementError(f"{description} failed: {exc}") from exc
 
     @cached_property
     def local_compute_rps(self):
         LOG.info("fetching resources providers for host %s", self.fqdn)
-        rps = self.client.get("/resource_providers")
-        if rps.status_code != 200:
-            raise PlacementError(f"failed to get rps: {rps}")
+        rps = self._get_local_tree_rps()
+        if rps is None:
+            LOG.info("falling back to fetching all resource providers")
+            rps = self._get_rps("/resource_providers")
 
         prefix = f'{self.fqdn}_pci_'
-        data = rps.json()
         result = []
-        for rp in data['resource_providers']:
+        for rp in rps:
             if rp['name'].startswith(prefix):
                 result.append(rp)
 
@@ -89,9 +526,44 @@ class PlacementHelper():
                  self.fqdn)
         return result
 
+    def _get_rps(self, url, microversion=None):
+        resp = self._request('get', url, microversion=microversion)
+        if resp.status_code != 200:
+            raise PlacementError(f"failed to get rps: {resp}")
+
+        return resp.json()['resource_providers']
+
+    def _get_local_tree_rps(self):
+        """
+        Get the resource providers in the tree of the local compute node,
+        rather than all resource providers of the region.
+
+        Returns None if this isn't supported by the Placement API or if the
+        compute node resource provider can't be found.
+        """
+        resp = self._request(
+            'get', f"/resource_providers?name={quote(self.fqdn)}",
+            microversion=self.IN_TREE_MICROVERSION)
+        if resp.status_code == 406:
+            LOG.info("placement api doesn't support microversion %s",
+                     self.IN_TREE_MICROVERSION)
+            return None
+
+        if resp.status_code != 200:
+            raise PlacementError(f"failed to get rp {self.fqdn}: {resp}")
+
+        roots = resp.json()['resource_providers']
+        if not roots:
+            LOG.warning("no resource provider found with name %s", self.fqdn)
+            return None
+
+        root_uuid = roots[0]['root_provider_uuid']
+        return self._get_rps(f"/resource_providers?in_tree={root_uuid}",
+                             microversion=self.IN_TREE_MICROVERSION)
+
     @cached_property
     def traits(self):
-        resp = self.client.get("/traits", microversion='1.6')
+        resp = self._request('get', "/traits", microversion='1.6')
         if resp.status_code != 200:
             raise PlacementError(f"failed to get traits: {resp}")
 
@@ -107,8 +579,8 @@ class PlacementHelper():
         return _traits
 
     def get_traits_for_rp(self, uuid):
-        resp = self.client.get(f"/resource_providers/{uuid}/traits",
-                               microversion='1.6')
+        resp = self._request('get', f"/resource_providers/{uuid}/traits",
+                             microversion='1.6')
         if resp.status_code != 200:
             raise PlacementError(f"failed to traits for rp {uuid}: {resp}")
 
@@ -119,16 +591,81 @@ class PlacementHelper():
             'resource_provider_generation': generation,
             'traits': new_traits,
         }
-        resp = self.client.put(f"/resource_providers/{uuid}/traits",
-                               json=data, microversion='1.6')
+        resp = self._request('put', f"/resource_providers/{uuid}/traits",
+                             json=data, microversion='1.6')
+        if resp.status_code == 409:
+            raise PlacementConflictError("generation conflict updating traits "
+                                         f"for rp {uuid}: {resp}")
+
         if resp.status_code != 200:
             raise PlacementError(f"failed to update traits for rp {uuid}: "
                                  f"{resp}")
 
         LOG.info("updated traits on RP %s to %s", uuid, new_traits)
 
-    def get_vgpu_rp_name(self, uuid):
-        allocations = self.client.get(f"/allocations/{uuid}")
+    @cached_property
+    def local_rp_index(self):
+        """
+        Map of uuids to ResourceProvider for all local resource providers.
+
+        This is built once per remediation run and shared by the hostdev
+        remediation and the traits update.
+        """
+        return {rp['uuid']: self._new_rp(rp['uuid'], rp['name'])
+                for rp in self.local_compute_rps}
+
+    @classmethod
+    def _new_rp(cls, uuid, name):
+        pci_address = driver_type = None
+        if '_pci_' in name:
+            pci_address = cls.get_pci_addr_from_rp_name(name)
+            driver_type = find_driver_type_from_pci_address(pci_address)
+
+        return ResourceProvider(uuid, name, pci_address, driver_type)
+
+    @cached_property
+    def vgpu_consumers(self):
+        """
+        Map of consumer (instance) uuids to the local ResourceProvider their
+        vGPU is allocated from.
+
+        This is loaded with one request per local resource provider, rather
+        than two requests per instance.
+        """
+        result = {}
+        for rp in self.local_rp_index.values():
+            try:
+                resp = self._request(
+                    'get', f"/resource_providers/{rp.uuid}/allocations")
+            except PlacementError as exc:
+                LOG.warning(exc)
+                continue
+
+            if resp.status_code != 200:
+                LOG.warning("failed to get allocations for rp %s: %s "
+                            "(return_code=%s)", rp.uuid, resp,
+                            resp.status_code)
+                continue
+
+            for consumer, data in resp.json().get('allocations', {}).items():
+                if (data.get('resources') or {}).get('VGPU') == 1:
+                    result[consumer] = rp
+
+        LOG.info("found %s vgpu allocations on %s resource providers for "
+                 "host %s", len(result), len(self.local_rp_index), self.fqdn)
+        return result
+
+    def get_vgpu_rp(self, uuid):
+        rp = self.vgpu_consumers.get(uuid)
+        if rp is not None:
+            return rp
+
+        LOG.info("no vgpu allocation found for uuid %s on local resource "
+                 "providers - querying its allocations", uuid)
+        return self.get_vgpu_rp_from_allocations(uuid)
+
+    def get_vgpu_rp_from_allocations(self, uuid):
+        allocations = self._request('get', f"/allocations/{uuid}")
         if allocations.status_code != 200:
             raise PlacementError(f"failed to get allocation for uuid {uuid}: "
                                  f"{allocations} "
@@ -147,12 +684,19 @@ class PlacementHelper():
                 if r != 'VGPU' or v != 1:
                     continue
 
-                return self.get_rp_name(rp)
+                return self.get_rp(rp)
 
         raise PlacementError(f"no resource provider found for domain {uuid}")
 
+    def get_rp(self, uuid):
+        rp = self.local_rp_index.get(uuid)
+        if rp is not None:
+            return rp
+
+        return self._new_rp(uuid, self.get_rp_name(uuid))
+
     def get_rp_name(self, uuid):
-        rp = self.client.get(f"/resource_providers/{uuid}")
+        rp = self._request('get', f"/resource_providers/{uuid}")
         if rp.status_code != 200:
             raise PlacementError(f"failed to get rp for uuid {uuid} "
                                  f"(return_code={rp.status_code})")
@@ -170,41 +714,92 @@ class PlacementHelper():
         pci_id_parts = addr.split('_')
         return get_pci_address(*pci_id_parts)
 
-    def update_gpu_traits(self, rpname, rpuuid, dry_run=False):
+    def update_all_gpu_traits(self, dry_run=False):
+        """
+        Update the traits of all local resource providers concurrently.
+
+        Returns a map of resource provider uuids to the outcome of their
+        update, see update_gpu_traits(), or 'failed'.
+        """
+        outcomes = {}
+        with ThreadPoolExecutor(max_workers=TRAITS_UPDATE_WORKERS) as pool:
+            futures = {pool.submit(self.update_gpu_traits, rp, dry_run): rp
+                       for rp in self.local_rp_index.values()}
+            for future in as_completed(futures):
+                rp = futures[future]
+                try:
+                    outcomes[rp.uuid] = future.result()
+                except PlacementError as exc:
+                    LOG.error("failed to update traits for rp %s: %s",
+                              rp.uuid, exc)
+                    outcomes[rp.uuid] = 'failed'
+
+        summary = Counter(outcomes.values())
+        LOG.info("traits update outcomes: %s", ", ".join(
+            f"{outcome}={count}"
+            for outcome, count in sorted(summary.items())))
+        for outcome, count in summary.items():
+            REPORT.count(f'traits_{outcome}', count)
+        REPORT.count('failed', summary['failed'])
+        return outcomes
+
+    def update_gpu_traits(self, rp, dry_run=False):
+        """
+        Update the traits of a resource provider to match its driver type.
+
+        Generation conflicts, e.g. with nova-compute updating the resource
+        provider at the same time, are retried with the traits re-read.
+
+        Returns 'updated', 'unchanged' or 'skipped'.
+        """
+        for attempt in range(1, TRAITS_UPDATE_ATTEMPTS + 1):
+            try:
+                with REPORT.timed('trait_update'):
+                    return self._update_gpu_traits(rp, dry_run)
+            except PlacementConflictError as exc:
+                if attempt == TRAITS_UPDATE_ATTEMPTS:
+                    raise
+
+                LOG.warning("%s - re-reading traits (attempt=%s)", exc,
+                            attempt)
+
+    def _update_gpu_traits(self, rp, dry_run=False):
+        rpuuid, pci_address, driver = rp.uuid, rp.pci_address, rp.driver_type
         LOG.info("updating gpu traits for resource provider %s", rpuuid)
         traits = self.get_traits_for_rp(rpuuid)
         if traits is None:
             LOG.info("no traits found for resource provider %s "
                      "- skipping update", rpuuid)
-            return
+            return 'skipped'
 
-        pci_address = self.get_pci_addr_from_rp_name(rpname)
-        driver = find_driver_type_from_pci_address(pci_address)
         if driver is None:
             if len(traits['traits']) > 0:
                 LOG.warning("rp %s for %s has traits %s but should be empty",
                             rpuuid, pci_address, traits['traits'])
 
-            return
+            return 'skipped'
 
         if driver not in self.DRIVER_TRAIT_MAPPING:
             LOG.error("failed to map driver '%s' to a trait for PCI "
                       "address %s", driver, pci_address)
-            return
+            return 'skipped'
 
         expected_traits = [self.DRIVER_TRAIT_MAPPING[driver]]
-        if expected_traits != traits['traits']:
-            if dry_run:
-                LOG.warning("rp %s for %s is mapped to driver %s but "
-                            "traits is %s not %s - skipping update since "
-                            "dry_run is True",
-                            rpuuid, pci_address, driver,
-                            traits['traits'], expected_traits)
-                return
+        if expected_traits == traits['traits']:
+            return 'unchanged'
+
+        if dry_run:
+            LOG.warning("rp %s for %s is mapped to driver %s but "
+                        "traits is %s not %s - skipping update since "
+                        "dry_run is True",
+                        rpuuid, pci_address, driver,
+                        traits['traits'], expected_traits)
+            return 'skipped'
 
-            self.update_traits_on_rp(rpuuid,
-                                     traits['resource_provider_generation'],
-                                     expected_traits)
+        self.update_traits_on_rp(rpuuid,
+                                 traits['resource_provider_generation'],
+                                 expected_traits)
+        return 'updated'
 
 
 class LibvirtHelper():
@@ -212,39 +807,262 @@ class LibvirtHelper():
     Helper for Libvirt operations.
     """
 
+    def __init__(self, inactive_only=True):
+        self.inactive_only = inactive_only
+        # Domains whose XML failed to be fetched or parsed in the last scan
+        self.failed_domains = []
+
     @cached_property
     def domains(self):
+        """
+        Persistent domains, as nova only defines persistent domains.
+
+        Unless inactive_only is False, only domains which are shut off are
+        listed: running or paused domains already have their mdevs.
+        """
+        with REPORT.timed('domain_listing'):
+            return self._list_domains()
+
+    def _list_domains(self):
+        conn = libvirt.openReadOnly(LIBVIRT_URI)
         try:
-            conn = libvirt.openReadOnly('qemu:///system')
-            return conn.listAllDomains(0)
+            flags = libvirt.VIR_CONNECT_LIST_DOMAINS_PERSISTENT
+            if self.inactive_only:
+                flags |= libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE
+            return [Domain(domain.UUIDString(), domain.name())
+                    for domain in conn.listAllDomains(flags)]
         finally:
             conn.close()
 
+    def iter_domain_hostdevs(self):
+        """
+        Yield (Domain, hostdevs) for the domains with mdev hostdevs, see
+        parse_mdev_hostdevs(), as soon as each domain XML is fetched.
+
+        The XMLs are fetched in parallel, each worker thread using its own
+        read-only connection. Domains whose XML fails to be fetched, e.g.
+        if undefined since being listed, or parsed are logged and added to
+        failed_domains, without stopping the scan.
+        """
+        local = threading.local()
+        conns = []
+
+        def _get_hostdevs(domain):
+            if not hasattr(local, 'conn'):
+                local.conn = libvirt.openReadOnly(LIBVIRT_URI)
+                conns.append(local.conn)
+
+            with REPORT.timed('xml_fetch'):
+                raw_xml = local.conn.lookupByUUIDString(
+                    domain.uuid).XMLDesc(0)
+            # Skip parsing the XML of domains without any mdev
+            if 'mdev' not in raw_xml:
+                return []
+
+            with REPORT.timed('xml_parse'):
+                return parse_mdev_hostdevs(raw_xml)
+
+        self.failed_domains = []
+        try:
+            with ThreadPoolExecutor(max_workers=LIBVIRT_WORKERS) as pool:
+                futures = {pool.submit(_get_hostdevs, domain): domain
+                           for domain in self.domains}
+                for future in as_completed(futures):
+                    domain = futures[future]
+                    try:
+                        hostdevs = future.result()
+                    except (libvirt.libvirtError,
+                            ElementTree.ParseError) as exc:
+                        LOG.error("failed to get the hostdevs of domain %s "
+                                  "(%s): %s", domain.uuid, domain.name, exc)
+                        self.failed_domains.append(domain)
+                        continue
+
+                    if hostdevs:
+                        yield domain, hostdevs
+        finally:
+            for conn in conns:
+                conn.close()
+
+
+def parse_mdev_hostdevs(raw_xml):
+    """
+    Extract the mdev hostdevs of a domain XML as MdevHostdev records.
+
+    Hostdevs of other types, e.g. PCI passthrough, are ignored.
+    """
+    return [_parse_mdev_hostdev(hostdev)
+            for hostdev in ElementTree.fromstring(raw_xml).iter('hostdev')
+            if hostdev.get('type') == 'mdev']
+
+
+def _parse_mdev_hostdev(hostdev):
+    uuid = error = None
+    sources = hostdev.findall('source')
+    if len(sources) != 1:
+        error = f"expected one source element, found {len(sources)}"
+    else:
+        addresses = sources[0].findall('address')
+        if len(addresses) != 1:
+            error = ("expected one address in source, found "
+                     f"{len(addresses)}")
+        else:
+            uuid = addresses[0].get('uuid')
+            if not uuid:
+                error = "no uuid found in source address"
+
+    if error:
+        error += (" in hostdev: "
+                  f"{ElementTree.tostring(hostdev, encoding='unicode')}")
+
+    return MdevHostdev(uuid, hostdev.get('model'),
+                       _guest_pci_address(hostdev.find('address')), error)
+
+
+def _guest_pci_address(address):
+    if address is None or address.get('type') != 'pci':
         return None
 
-    @staticmethod
-    def get_domain_hostdevs(domain):
-        raw_xml = domain.XMLDesc()
-        xml = minidom.parseString(raw_xml)
-        return xml.getElementsByTagName("hostdev")
+    try:
+        return get_pci_address(*(
+            f"{int(address.get(attr), 16):0{width}x}" for attr, width in
+            (('domain', 4), ('bus', 2), ('slot', 2), ('function', 1))))
+    except (TypeError, ValueError):
+        return None
 
 
 def _mdev_exists(uuid):
-    path = os.path.join("/sys/bus/mdev/devices", uuid)
+    path = os.path.join(MDEV_DEVICES_DIR, uuid)
     return os.path.exists(path)
 
 
-def _create_mdev(pci_addr, driver_type, uuid, dry_run=False):
-    path = os.path.join('/sys/bus/pci/devices', pci_addr,
+def _describe_mdev(uuid):
+    """ Parent PCI address and type of an existing mdev, or None. """
+    path = os.path.join(MDEV_DEVICES_DIR, uuid)
+    if not os.path.exists(path):
+        return None
+
+    parent = os.path.basename(os.path.dirname(os.path.realpath(path)))
+    mdev_type = os.path.basename(
+        os.path.realpath(os.path.join(path, 'mdev_type')))
+    return parent, mdev_type
+
+
+class MdevLedger():
+    """
+    Local record of the parent GPU, type and domain of mdevs.
+
+    mdevs don't survive a reboot, this allows recreating them without
+    asking Placement which GPU their vGPU was allocated from. The ledger is
+    updated with the mdevs seen at each remediation, and snapshotted
+    periodically and when the host shuts down.
+    """
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls):
+        try:
+            with open(MDEV_LEDGER_FILE, encoding='utf-8') as f:
+                return cls(dict(json.load(f)['mdevs']))
+        except FileNotFoundError:
+            return cls()
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            LOG.warning("ignoring unreadable mdev ledger %s: %s",
+                        MDEV_LEDGER_FILE, exc)
+            return cls()
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(MDEV_LEDGER_FILE), exist_ok=True)
+            tmp_file = MDEV_LEDGER_FILE + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'mdevs': self.entries}, f, indent=2,
+                          sort_keys=True)
+            os.replace(tmp_file, MDEV_LEDGER_FILE)
+        except OSError as exc:
+            LOG.warning("failed to save mdev ledger %s: %s", MDEV_LEDGER_FILE,
+                        exc)
+            return
+
+        LOG.info("saved %s mdev(s) to ledger %s", len(self.entries),
+                 MDEV_LEDGER_FILE)
+
+    def record(self, domain_uuid, uuid):
+        """ Record an existing mdev, returns False if it doesn't exist. """
+        mdev = _describe_mdev(uuid)
+        if mdev is None:
+            return False
+
+        self.entries[uuid] = {'parent': mdev[0], 'type': mdev[1],
+                              'domain': domain_uuid}
+        return True
+
+    def plan_mdev_create(self, domain_uuid, uuid):
+        """
+        MdevCreate for a missing mdev from its entry, or None if it has no
+        entry or the entry is stale, i.e. the mdev belonged to another
+        domain, its GPU is now mapped to another type, or doesn't support
+        the type anymore.
+        """
+        entry = self.entries.get(uuid)
+        if entry is None:
+            return None
+
+        parent, mdev_type = entry.get('parent'), entry.get('type')
+        if (entry.get('domain') != domain_uuid or
+                find_driver_type_from_pci_address(parent) != mdev_type or
+                not os.path.isdir(os.path.join(
+                    PCI_DEVICES_DIR, parent, 'mdev_supported_types',
+                    mdev_type))):
+            LOG.info("mdev ledger entry of %s is stale: %s", uuid, entry)
+            return None
+
+        return MdevCreate(parent, mdev_type, uuid, domain_uuid)
+
+    def plan_mdev_creates(self, missing):
+        """
+        Plan the creation of the missing mdevs with an entry.
+
+        Returns a list of MdevCreate, and the (domain uuid, mdev uuid)
+        tuples left to plan from Placement.
+        """
+        creates = []
+        unresolved = []
+        for domain_uuid, uuid in missing:
+            create = self.plan_mdev_create(domain_uuid, uuid)
+            if create is None:
+                unresolved.append((domain_uuid, uuid))
+            else:
+                creates.append(create)
+
+        return creates, unresolved
+
+
+def _write_sysfs(path, value):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(value)
+
+
+def _create_mdev(pci_addr, driver_type, uuid, dry_run=False, timeout=None):
+    path = os.path.join(PCI_DEVICES_DIR, pci_addr,
                         'mdev_supported_types', driver_type, 'create')
     LOG.info("creating mdev entry at path: %s", path)
     if dry_run:
         LOG.info("skipping since dry_run is True")
         return
 
+    # The write blocks until the vGPU manager has set up the mdev, so it is
+    # done in a separate thread to be able to give up on it.
+    future = run_in_background(lambda: _write_sysfs(path, uuid))
     try:
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(uuid)
+        with REPORT.timed('mdev_create'):
+            future.result(timeout=timeout)
+    except FutureTimeoutError:
+        raise MdevCreateTimeoutError(f"timed out after {timeout}s creating "  # noqa pylint: disable=raise-missing-from
+                                     f"mdev {uuid} at {pci_addr} with type "
+                                     f"{driver_type}")
     except Exception as e:
         raise RemediationFailedError(f"failed to create mdev {uuid} at "  # noqa pylint: disable=raise-missing-from
                                      f"{pci_addr} with type {driver_type}: "
@@ -253,96 +1071,556 @@ def _create_mdev(pci_addr, driver_type, uuid, dry_run=False):
     LOG.info("created mdev %s at %s with type %s", uuid, pci_addr, driver_type)
 
 
+def _parent_gpu(pci_addr):
+    """ PCI address of the physical GPU of a device, which may be a VF. """
+    physfn = os.path.join(PCI_DEVICES_DIR, pci_addr, 'physfn')
+    if os.path.exists(physfn):
+        return os.path.basename(os.path.realpath(physfn))
+
+    return pci_addr
+
+
+class CreateTracker():
+    """
+    Tracks the create_mdevs() calls in flight, which carry on in the
+    background when the create phase misses its deadline.
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self._cond = threading.Condition()
+        self._in_flight = 0
+
+    @contextmanager
+    def track(self):
+        with self._cond:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def cancel(self, timeout):
+        """
+        Give up on the mdevs not being created yet, and wait for the ones
+        being created. Returns whether all calls returned within timeout.
+        """
+        self.cancelled.set()
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._in_flight, timeout)
+
+
+CREATES = CreateTracker()
+
+
+def _create_gpu_mdevs(gpu, creates, dry_run=False):
+    """
+    Create the mdevs of a physical GPU one after another.
+
+    Returns the number of mdevs which failed to be created and the number
+    of mdevs given up on because the creates were cancelled. A creation
+    timing out leaves the GPU busy, so its remaining mdevs are given up.
+    """
+    failures = 0
+    for i, create in enumerate(creates):
+        if CREATES.cancelled.is_set():
+            LOG.warning("creates cancelled - leaving the %d remaining "
+                        "mdev(s) of gpu %s", len(creates) - i, gpu)
+            return failures, len(creates) - i
+
+        try:
+            _create_mdev(create.pci_address, create.driver_type, create.uuid,
+                         dry_run, MDEV_CREATE_TIMEOUT)
+        except MdevCreateTimeoutError as exc:
+            LOG.error("%s - giving up on the %d remaining mdev(s) of gpu %s",
+                      exc, len(creates) - i - 1, gpu)
+            return failures + len(creates) - i, 0
+        except RemediationFailedError as exc:
+            LOG.error(exc)
+            failures += 1
+
+    return failures, 0
+
+
+def create_mdevs(creates, dry_run=False):
+    """
+    Create mdevs, concurrently across physical GPUs but one at a time on
+    each GPU.
+
+    Returns the number of mdevs which failed to be created.
+    """
+    by_gpu = {}
+    for create in creates:
+        by_gpu.setdefault(_parent_gpu(create.pci_address), []).append(create)
+
+    if not by_gpu:
+        return 0
+
+    LOG.info("creating %d mdev(s) on %d gpu(s)", len(creates), len(by_gpu))
+    workers = min(MDEV_CREATE_WORKERS, len(by_gpu))
+    with CREATES.track(), ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+            lambda item: _create_gpu_mdevs(*item, dry_run=dry_run),
+            by_gpu.items()))
+
+    failures = sum(failed for failed, _ in results)
+    cancelled = sum(cancelled for _, cancelled in results)
+    REPORT.count('failed', failures)
+    REPORT.count('cancelled', cancelled)
+    if not dry_run:
+        REPORT.count('remediated', len(creates) - failures - cancelled)
+    return failures
+
+
+def _read_sysfs(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read().strip()
+
+
+def sriov_capable_gpus():
+    """ PCI addresses of the NVIDIA physical functions supporting SR-IOV. """
+    result = []
+    for pci_addr in sorted(os.listdir(PCI_DEVICES_DIR)):
+        device_dir = os.path.join(PCI_DEVICES_DIR, pci_addr)
+        try:
+            if (_read_sysfs(os.path.join(device_dir, 'vendor')) !=
+                    NVIDIA_VENDOR_ID or
+                    int(_read_sysfs(os.path.join(device_dir,
+                                                 'sriov_totalvfs'))) <= 0):
+                continue
+        except (OSError, ValueError):
+            continue
+
+        result.append(pci_addr)
+
+    return result
+
+
+def _enable_sriov(pf):
+    """
+    Enable the VFs of a physical GPU with sriov-manage, unless they all are
+    already.
+
+    Returns 'enabled' or 'skipped'.
+    """
+    device_dir = os.path.join(PCI_DEVICES_DIR, pf)
+    try:
+        numvfs = int(_read_sysfs(os.path.join(device_dir, 'sriov_numvfs')))
+        totalvfs = int(_read_sysfs(os.path.join(device_dir,
+                                                'sriov_totalvfs')))
+    except (OSError, ValueError) as e:
+        raise RemediationFailedError(f"failed to read SR-IOV state of gpu "  # noqa pylint: disable=raise-missing-from
+                                     f"{pf}: {e}")
+
+    if numvfs == totalvfs:
+        LOG.info("SR-IOV already enabled on gpu %s (%s VFs) - skipping", pf,
+                 numvfs)
+        return 'skipped'
+
+    LOG.info("enabling SR-IOV on gpu %s (%s/%s VFs)", pf, numvfs, totalvfs)
+    try:
+        with REPORT.timed('sriov_enable'):
+            subprocess.run([SRIOV_MANAGE, '-e', pf], check=True,
+                           capture_output=True, text=True,
+                           timeout=SRIOV_ENABLE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise RemediationFailedError(f"timed out after "  # noqa pylint: disable=raise-missing-from
+                                     f"{SRIOV_ENABLE_TIMEOUT}s enabling "
+                                     f"SR-IOV on gpu {pf}")
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RemediationFailedError(f"failed to enable SR-IOV on gpu {pf}: "  # noqa pylint: disable=raise-missing-from
+                                     f"{e} {getattr(e, 'stderr', '') or ''}")
+
+    LOG.info("enabled SR-IOV on gpu %s", pf)
+    return 'enabled'
+
+
+def enable_sriov():
+    """
+    Enable SR-IOV on the physical GPUs in SRIOV_PFS, or on all NVIDIA GPUs
+    supporting it if unknown, concurrently.
+
+    Returns the number of GPUs on which it failed.
+    """
+    with REPORT.timed('sriov'):
+        pfs = SRIOV_PFS if SRIOV_PFS is not None else sriov_capable_gpus()  # noqa pylint: disable=undefined-variable
+        if not pfs:
+            LOG.info("no gpu to enable SR-IOV on")
+            return 0
+
+        LOG.info("enabling SR-IOV on %d gpu(s)", len(pfs))
+        failures = 0
+        workers = min(SRIOV_WORKERS, len(pfs))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_enable_sriov, pf) for pf in pfs]
+            for future in as_completed(futures):
+                try:
+                    REPORT.count(f'sriov_{future.result()}')
+                except RemediationFailedError as exc:
+                    LOG.error(exc)
+                    failures += 1
+
+    REPORT.count('failed', failures)
+    return failures
+
+
 def find_driver_type_from_pci_address(pci_addr):
-    for driver_type, addresses in MDEV_TYPES.items():  # noqa pylint: disable=no-member,undefined-variable
-        if pci_addr in addresses:
-            return driver_type
-
-    return None
-
-
-def _remediate_hostdev(pm, domain_uuid, hostdev, dry_run=False):
-    sources = hostdev.getElementsByTagName("source")
-    if len(sources) <= 0:
-        raise RemediationFailedError("found no source elements in hostdev: "
-                                     f"{hostdev.toxml()}")
-
-    if len(sources) > 1:
-        raise RemediationFailedError(f"found more than one ({len(sources)}) "
-                                     "source elements in hostdev: "
-                                     f"{hostdev.toxml()}")
-
-    source = sources[0]
-    addresses = source.getElementsByTagName("address")
-    if len(addresses) != 1:
-        raise RemediationFailedError(f"expected to find only one address "
-                                     f"(({len(addresses)})) in source for "
-                                     f"hostdev: {hostdev.toxml()}")
-
-    mdev_uuid = addresses[0].getAttribute("uuid")
-    if _mdev_exists(mdev_uuid):
-        LOG.info("hostdev mdev device %s already exists - no action needed",
-                 mdev_uuid)
-        return
+    return PCI_DRIVER_TYPES.get(pci_addr)  # noqa pylint: disable=no-member,undefined-variable
+
 
+def _plan_mdev_create(pm, domain_uuid, mdev_uuid):
     try:
-        rp_name = pm.get_vgpu_rp_name(domain_uuid)
+        rp = pm.get_vgpu_rp(domain_uuid)
     except PlacementError as exc:
         raise RemediationFailedError from exc
 
-    if '_pci_' not in rp_name:
+    if rp.pci_address is None:
         raise RemediationFailedError("failed to find _pci_ in provider name "
-                                     f"'{rp_name}'")
+                                     f"'{rp.name}'")
 
-    pci_address = pm.get_pci_addr_from_rp_name(rp_name)
-    driver_type = find_driver_type_from_pci_address(pci_address)
+    pci_address, driver_type = rp.pci_address, rp.driver_type
     if not driver_type:
         raise RemediationFailedError("failed to find driver type for "
                                      f"pci_address {pci_address}")
 
-    _create_mdev(pci_address, driver_type, mdev_uuid, dry_run)
+    return MdevCreate(pci_address, driver_type, mdev_uuid, domain_uuid)
 
 
-def main(dry_run=False):
-    logging.basicConfig(level=logging.INFO)
-    LOG.info("starting Nova mdev remediation (dry_run=%s)", dry_run)
-    LOG.info("loading Nova config from %s", NOVA_CONF)
-    CONF(default_config_files=[NOVA_CONF])
+def plan_mdev_creates(pm, missing):
+    """
+    Resolve where and with which type each missing mdev is to be created.
 
-    lm = LibvirtHelper()
+    Returns a list of MdevCreate and whether any mdev failed to be
+    resolved.
+    """
+    creates = []
+    failed = False
+    for domain_uuid, mdev_uuid in missing:
+        try:
+            creates.append(_plan_mdev_create(pm, domain_uuid, mdev_uuid))
+        except RemediationFailedError as exc:
+            LOG.error("failed to plan mdev %s of domain %s: %s", mdev_uuid,
+                      domain_uuid, exc.__cause__ or exc)
+            REPORT.count('failed')
+            failed = True
+
+    return creates, failed
+
+
+def run_in_background(func):
+    """
+    Run func in a daemon thread, returning a Future of its result.
+
+    Unlike with an executor, the process doesn't wait for func on exit if
+    its result turns out not to be needed.
+    """
+    future = Future()
+
+    def _run():
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            future.set_result(func())
+        except BaseException as exc:  # pylint: disable=broad-except
+            future.set_exception(exc)
+
+    threading.Thread(target=_run, daemon=True).start()
+    return future
+
+
+class Budget():
+    """
+    Time budget of a remediation run, see REMEDIATION_TIMEOUT.
+    """
+
+    def __init__(self, timeout=None):
+        timeout = REMEDIATION_TIMEOUT if timeout is None else timeout
+        self.deadlines = {}
+        if timeout > 0:
+            start, share = monotonic(), 0
+            for phase, phase_share in PHASE_BUDGETS:
+                share += phase_share
+                self.deadlines[phase] = start + share * timeout
+
+    def run(self, phase, func, *args, **kwargs):
+        """
+        Call func, raising DeadlineExceededError if it doesn't return by the
+        deadline of the phase. func then carries on in the background.
+        """
+        deadline = self.deadlines.get(phase)
+        with REPORT.timed(f'phase_{phase}'):
+            if deadline is None:
+                return func(*args, **kwargs)
+
+            future = run_in_background(lambda: func(*args, **kwargs))
+            return self._wait(phase, future, deadline)
+
+    @staticmethod
+    def _wait(phase, future, deadline):
+        try:
+            return future.result(timeout=max(0, deadline - monotonic()))
+        except FutureTimeoutError:
+            raise DeadlineExceededError(f"{phase} phase didn't complete in "  # noqa pylint: disable=raise-missing-from
+                                        "time")
+
+
+def start_continuation(traits_only=False):
+    """
+    Start the remediation again as a transient systemd service without time
+    budget, returning whether it could be started. With traits_only, the
+    service only reconciles the traits of the local resource providers.
+    """
+    unit, mode_env, what = (CONTINUATION_UNIT, 'MDEV_INIT_CONTINUATION',
+                            'continuation')
+    if traits_only:
+        unit, mode_env, what = TRAITS_UNIT, 'MDEV_INIT_TRAITS_ONLY', 'traits'
+    cmd = ['systemd-run', '--no-block', '--collect', f'--unit={unit}',
+           f'--description=GPU MDev Initialisation Workaround {what}']
+    cmd.extend(f'--setenv={name}={value}'
+               for name, value in sorted(os.environ.items())
+               if name.startswith('MDEV_INIT_') and
+               name not in ('MDEV_INIT_TIMEOUT', 'MDEV_INIT_CONTINUATION',
+                            'MDEV_INIT_TRAITS_ONLY'))
+    cmd.extend(['--setenv=MDEV_INIT_TIMEOUT=0', f'--setenv={mode_env}=1',
+                sys.executable, os.path.abspath(__file__)])
+    try:
+        subprocess.run(cmd, check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError) as exc:
+        LOG.error("failed to start %s: %s %s", unit, exc,
+                  getattr(exc, 'stderr', '') or '')
+        return False
+
+    if traits_only:
+        LOG.info("traits are reconciled in the background in %s", unit)
+    else:
+        LOG.warning("remediation continues in the background in %s", unit)
+    return True
+
+
+def _start_placement_helper():
+    """
+    Create the PlacementHelper and load the local resource providers.
+
+    This runs in the background while libvirt is scanned, so that the
+    Placement client is ready, or keystone never waited on, by the time it
+    is needed.
+    """
     pm = PlacementHelper()
+    LOG.info("placement client ready with %s local resource providers",
+             len(pm.local_rp_index))
+    return pm
 
-    if len(lm.domains) == 0:
-        LOG.info("no domains found in libvirt - exiting")
-        return
 
-    LOG.info("%s domains found in libvirt", len(lm.domains))
-    failed = False
-    for domain in lm.domains:
-        uuid, name = domain.UUIDString(), domain.name()
-        hostdevs = lm.get_domain_hostdevs(domain)
-        if len(hostdevs) <= 0:
-            LOG.info("domain %s (%s) has no hostdevs - skipping", uuid, name)
-            continue
+def find_missing_mdevs(lm, ledger=None):
+    """
+    Scan libvirt for hostdevs whose mdev doesn't exist.
+
+    The mdevs which exist are recorded in the ledger, if any.
 
-        LOG.info("domain %s (%s) has %d hostdev(s) - starting remediation",
-                 uuid, name, len(hostdevs))
+    Returns a list of (domain uuid, mdev uuid) tuples and whether any
+    domain or hostdev failed to be parsed.
+    """
+    missing = []
+    failed = False
+    for domain, hostdevs in lm.iter_domain_hostdevs():
+        LOG.info("domain %s (%s) has %d mdev hostdev(s) - checking mdevs",
+                 domain.uuid, domain.name, len(hostdevs))
+        REPORT.count('hostdevs', len(hostdevs))
         for hostdev in hostdevs:
+            if hostdev.error:
+                LOG.error("domain %s: %s", domain.uuid, hostdev.error)
+                REPORT.count('failed')
+                failed = True
+                continue
+
+            if _mdev_exists(hostdev.uuid):
+                LOG.info("hostdev mdev device %s already exists - no action "
+                         "needed", hostdev.uuid)
+                if ledger is not None:
+                    ledger.record(domain.uuid, hostdev.uuid)
+                continue
+
+            missing.append((domain.uuid, hostdev.uuid))
+
+    if lm.failed_domains:
+        REPORT.count('failed', len(lm.failed_domains))
+        failed = True
+
+    return missing, failed
+
+
+def main(dry_run=False):
+    """
+    Remediate the mdevs of the domains and the traits of the local resource
+    providers.
+
+    Returns True if the remediation was handed off to a continuation for
+    going over its time budget.
+    """
+    logging.basicConfig(level=logging.INFO)
+    LOG.info("starting Nova mdev remediation (dry_run=%s, client_mode=%s, "
+             "timeout=%ss, traits_only=%s)", dry_run, CLIENT_MODE,
+             REMEDIATION_TIMEOUT, TRAITS_ONLY)
+
+    budget = Budget()
+    status, error = 'ok', None
+    try:
+        with REPORT.timed('total'):
             try:
-                _remediate_hostdev(pm, uuid, hostdev, dry_run)
-            except RemediationFailedError as exc:
-                LOG.error(exc)
+                if TRAITS_ONLY:
+                    _reconcile_traits(budget, _start_placement_helper(),
+                                      dry_run)
+                    deferred = False
+                else:
+                    deferred = _remediate(budget, dry_run)
+            except DeadlineExceededError as exc:
+                LOG.warning("%s", exc)
+                # The continuation must not create the same mdevs
+                # concurrently, so the creates still in flight are stopped
+                # first. Each one is over within MDEV_CREATE_TIMEOUT.
+                if not CREATES.cancel(MDEV_CREATE_TIMEOUT):
+                    LOG.warning("mdev creates still in flight after %ss",
+                                MDEV_CREATE_TIMEOUT)
+                if not start_continuation():
+                    raise PlacementError("failed to hand off remediation")  # noqa pylint: disable=raise-missing-from
+
+                deferred = True
+
+        if deferred:
+            status, error = 'deferred', "time budget exceeded"
+        return deferred
+    except Exception as exc:
+        status, error = 'failed', str(exc)
+        raise
+    finally:
+        REPORT.save(status, error, dry_run,
+                    TRAITS_RESULT_FILE if TRAITS_ONLY else None)
+
+
+def _remediate(budget, dry_run=False):
+    # The VFs and their mdev types only appear once SR-IOV is enabled, which
+    # is done while libvirt is scanned.
+    sriov_future = run_in_background(enable_sriov)
+    pm_future = run_in_background(_start_placement_helper)
+    lm = LibvirtHelper()
+    ledger = None
+    missing, failed = [], False
+    try:
+        if budget.run('scan', lambda: lm.domains):
+            ledger = MdevLedger.load()
+            missing, failed = budget.run('scan', find_missing_mdevs, lm,
+                                         ledger)
+    finally:
+        # SR-IOV enablement isn't part of the time budget, even if the
+        # remediation is handed off: nova-compute needs the VFs, and the
+        # continuation must not enable them while sriov-manage still runs.
+        with REPORT.timed('sriov_wait'):
+            sriov_failed = sriov_future.result() > 0
+
+    if ledger is None:
+        LOG.info("no shut off domains found in libvirt - exiting")
+        if sriov_failed:
+            raise RemediationFailedError("failed to enable SR-IOV on one or "
+                                         "more gpus")
+        return False
+
+    LOG.info("%s shut off domains found in libvirt", len(lm.domains))
+    REPORT.count('domains', len(lm.domains))
+    if sriov_failed:
+        failed = True
+
+    creates, unresolved = ledger.plan_mdev_creates(missing)
+    REPORT.count('missing', len(missing))
+    REPORT.count('ledger_hits', len(creates))
+    LOG.info("%s mdev(s) missing, %s of which found in the mdev ledger",
+             len(missing), len(creates))
+    # mdevs found in the ledger are created without waiting for Placement
+    if budget.run('create', create_mdevs, creates, dry_run):
+        failed = True
+
+    try:
+        # Placement is only waited for if some mdevs are missing from the
+        # ledger, a host with nothing to fix never blocks on keystone.
+        if unresolved:
+            if not pm_future.done():
+                LOG.info("waiting for placement client")
+
+            pm = budget.run('placement', pm_future.result)
+            placement_creates, plan_failed = budget.run(
+                'placement', plan_mdev_creates, pm, unresolved)
+            creates.extend(placement_creates)
+            if budget.run('create', create_mdevs, placement_creates,
+                          dry_run) or plan_failed:
                 failed = True
+    finally:
+        if not dry_run:
+            for create in creates:
+                ledger.record(create.domain_uuid, create.uuid)
+            ledger.save()
+
+    # A continuation is already in the background, otherwise the traits are
+    # reconciled by another one so that nova-compute can start.
+    if CONTINUATION:
+        _reconcile_traits(budget, pm_future.result(), dry_run)
+    elif not start_continuation(traits_only=True):
+        raise PlacementError("failed to hand off placement traits update")
+
+    if failed:
+        raise RemediationFailedError("failed to remediate one or more mdevs")
+
+    return False
+
 
+def _reconcile_traits(budget, pm, dry_run=False):
     if not pm.local_compute_rps:
         return
 
-    for rp in pm.local_compute_rps:
-        pm.update_gpu_traits(rp['name'], rp['uuid'], dry_run)
-
-    if failed:
+    outcomes = budget.run('traits', pm.update_all_gpu_traits, dry_run)
+    if 'failed' in outcomes.values():
         raise PlacementError("failed to update one or more placement traits")
 
 
+def snapshot():
+    """
+    Record the mdevs of all domains in the mdev ledger, e.g. before the host
+    shuts down. Entries of mdevs which don't exist are kept as long as their
+    domain still uses them, and so are the entries of the domains whose XML
+    couldn't be read.
+    """
+    logging.basicConfig(level=logging.INFO)
+    LOG.info("snapshotting mdevs to %s", MDEV_LEDGER_FILE)
+    previous = MdevLedger.load()
+    ledger = MdevLedger()
+    lm = LibvirtHelper(inactive_only=False)
+    for domain, hostdevs in lm.iter_domain_hostdevs():
+        for hostdev in hostdevs:
+            if hostdev.error or ledger.record(domain.uuid, hostdev.uuid):
+                continue
+
+            if hostdev.uuid in previous.entries:
+                ledger.entries[hostdev.uuid] = previous.entries[hostdev.uuid]
+
+    failed_uuids = {domain.uuid for domain in lm.failed_domains}
+    for uuid, entry in previous.entries.items():
+        if entry.get('domain') in failed_uuids:
+            ledger.entries.setdefault(uuid, entry)
+
+    ledger.save()
+
+
 if __name__ == '__main__':
-    main(os.environ.get('MDEV_INIT_DRY_RUN') == 'True')
+    parser = argparse.ArgumentParser(description="Nova mdev remediation")
+    parser.add_argument('--snapshot', action='store_true',
+                        help="record the mdevs of all domains in the mdev "
+                             "ledger instead of remediating them")
+    if parser.parse_args().snapshot:
+        snapshot()
+    else:
+        main(os.environ.get('MDEV_INIT_DRY_RUN') == 'True')
+        # Don't wait for the threads of the work handed off or no longer
+        # needed, e.g. the Placement client if nothing had to be resolved
+        logging.shutdown()
+        os._exit(0)  # pylint: disable=protected-access
@@ -0,0 +1,159 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers rendering templates/remediate_nova_mdevs.py and faking libvirt,
+shared by its unit tests and benchmarks."""
+
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+import uuid
+
+import jinja2
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'templates',
+                        'remediate_nova_mdevs.py')
+
+
+def load_remediation_module(mdev_types=None, **context):
+    """Render the remediation script and import it as a module.
+
+    No libvirt daemon is needed to render the script, so libvirt is
+    replaced by an empty module when it is not installed, e.g. outside of a
+    compute node. fake_libvirt_module() provides a working one.
+
+    :param mdev_types: vGPU device mappings, indexed into pci_driver_types
+                       unless given.
+    """
+    try:
+        importlib.import_module('libvirt')
+    except ImportError:
+        sys.modules['libvirt'] = types.ModuleType('libvirt')
+
+    context.setdefault('pci_driver_types', {
+        pci_addr: driver_type
+        for driver_type, pci_addresses in reversed(
+            list((mdev_types or {}).items()))
+        for pci_addr in pci_addresses})
+    context.setdefault('sriov_pfs', None)
+    with open(TEMPLATE) as f:
+        source = jinja2.Template(f.read()).render(**context)
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'remediate_nova_mdevs.py')
+    with open(path, 'w') as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location('remediate_nova_mdevs',
+                                                  path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def fake_domain_xml(mdev_uuids, disks=32, vcpus=64):
+    """Build the XML of a domain with vGPUs and a realistic amount of noise.
+
+    :param mdev_uuids: Uuids of the mdev hostdevs of the domain.
+    :param disks: Number of RBD disks.
+    :param vcpus: Number of pinned vCPUs.
+    """
+    parts = ["<domain type='kvm'><name>instance-{}</name><uuid>{}</uuid>"
+             "<memory unit='KiB'>8388608</memory><cputune>".format(
+                 random.randint(0, 0xffff), uuid.uuid4())]
+    parts.extend("<vcpupin vcpu='{0}' cpuset='{0}'/>".format(vcpu)
+                 for vcpu in range(vcpus))
+    parts.append("</cputune><numatune><memory mode='strict' nodeset='0-1'/>"
+                 "</numatune><devices>")
+    for disk in range(disks):
+        parts.append(
+            "<disk type='network' device='disk'>"
+            "<driver name='qemu' type='raw' cache='none' discard='unmap'/>"
+            "<source protocol='rbd' name='cinder-ceph/volume-{0}'>"
+            "<host name='10.0.0.1' port='6789'/>"
+            "<host name='10.0.0.2' port='6789'/></source>"
+            "<target dev='vd{1}' bus='virtio'/><serial>{0}</serial>"
+            "<alias name='virtio-disk{1}'/>"
+            "<address type='pci' domain='0x0000' bus='0x00' slot='0x{2:02x}'"
+            " function='0x0'/></disk>".format(uuid.uuid4(), disk,
+                                              disk % 32))
+    for i, mdev_uuid in enumerate(mdev_uuids):
+        parts.append(
+            "<hostdev mode='subsystem' type='mdev' managed='no' "
+            "model='vfio-pci' display='off'>"
+            "<source><address uuid='{}'/></source>"
+            "<alias name='hostdev{}'/>"
+            "<address type='pci' domain='0x0000' bus='0x06' slot='0x{:02x}'"
+            " function='0x0'/></hostdev>".format(mdev_uuid, i, i))
+    parts.append("<hostdev mode='subsystem' type='pci' managed='yes'>"
+                 "<source><address domain='0x0000' bus='0x81' slot='0x00' "
+                 "function='0x1'/></source></hostdev></devices></domain>")
+    return ''.join(parts)
+
+
+def fake_libvirt_module(domain_xmls, latency=0.0):
+    """Build a libvirt module serving the given domains.
+
+    :param domain_xmls: Map of domain uuids to their XML. Looking up other
+                        domains raises libvirtError, as if undefined.
+    :param latency: Time taken by each call to the libvirt daemon.
+    """
+    libvirt = types.ModuleType('libvirt')
+    libvirt.VIR_CONNECT_LIST_DOMAINS_PERSISTENT = 4
+    libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE = 2
+    libvirt.connections = 0
+
+    class libvirtError(Exception):
+        pass
+
+    libvirt.libvirtError = libvirtError
+
+    class Domain:
+        def __init__(self, domain_uuid):
+            self.domain_uuid = domain_uuid
+
+        def UUIDString(self):
+            return self.domain_uuid
+
+        def name(self):
+            return 'instance-' + self.domain_uuid[:8]
+
+        def XMLDesc(self, flags=0):
+            time.sleep(latency)
+            return domain_xmls[self.domain_uuid]
+
+    class Connection:
+        def listAllDomains(self, flags=0):
+            time.sleep(latency)
+            return [Domain(domain_uuid) for domain_uuid in domain_xmls]
+
+        def lookupByUUIDString(self, domain_uuid):
+            time.sleep(latency)
+            if domain_uuid not in domain_xmls:
+                raise libvirtError("Domain not found: no domain with "
+                                   "matching uuid '{}'".format(domain_uuid))
+            return Domain(domain_uuid)
+
+        def close(self):
+            pass
+
+    def openReadOnly(uri):
+        libvirt.connections += 1
+        return Connection()
+
+    libvirt.openReadOnly = openReadOnly
+    return libvirt
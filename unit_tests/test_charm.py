@@ -48,6 +48,8 @@ class TestNovaComputeNvidiaVgpuCharm(CharmTestCase):
 
     _PATCHES = [
         'check_status',
+        'gpu_inventory_fingerprint',
+        'install_mdev_init_workaround',
         'install_nvidia_software_if_needed',
         'is_nvidia_software_to_be_installed',
         'set_principal_unit_relation_data',
@@ -55,6 +57,7 @@ class TestNovaComputeNvidiaVgpuCharm(CharmTestCase):
 
     def setUp(self):
         super().setUp(charm, self._PATCHES)
+        self.gpu_inventory_fingerprint.return_value = 'inventory-1'
         self.harness = Harness(charm.NovaComputeNvidiaVgpuCharm)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
@@ -66,6 +69,7 @@ class TestNovaComputeNvidiaVgpuCharm(CharmTestCase):
         self.assertFalse(self.harness.charm._stored.is_started)
         self.assertIsNone(
             self.harness.charm._stored.last_installed_resource_hash)
+        self.assertIsNone(self.harness.charm._stored.nvidia_resource_hash)
 
     def test_nova_vgpu_relation_joined(self):
         # NOTE(lourot): these functions get called by the update-status hook,
@@ -83,3 +87,40 @@ class TestNovaComputeNvidiaVgpuCharm(CharmTestCase):
         # Verify that nova-compute-vgpu-charm sets relation data to its
         # principal nova-compute.
         self.assertTrue(self.set_principal_unit_relation_data.called)
+        # The remediation script is rendered from the config:
+        self.install_mdev_init_workaround.assert_called_with(
+            self.harness.charm.config)
+
+    def test_upgrade_charm(self):
+        self.check_status.return_value = ActiveStatus('Unit is ready')
+        self.harness.charm._stored.status_fingerprint = {'boot_id': 'abc'}
+
+        self.harness.charm.on.upgrade_charm.emit()
+
+        # The new charm code may compute the status differently:
+        self.assertIsNone(self.harness.charm._stored.status_fingerprint)
+        self.assertTrue(self.install_mdev_init_workaround.called)
+
+    def test_update_status_gpu_inventory_changed(self):
+        self.check_status.return_value = ActiveStatus('Unit is ready')
+        self.is_nvidia_software_to_be_installed.return_value = False
+        relation_id = self.harness.add_relation('nova-vgpu', 'nova-compute')
+        self.harness.add_relation_unit(relation_id, 'nova-compute/0')
+        self.harness.charm.on.start.emit()
+        self.set_principal_unit_relation_data.reset_mock()
+        self.install_mdev_init_workaround.reset_mock()
+
+        # Nothing changed:
+        self.harness.charm.on.update_status.emit()
+        self.assertFalse(self.set_principal_unit_relation_data.called)
+        self.assertFalse(self.install_mdev_init_workaround.called)
+
+        # e.g. virtual functions appeared once SR-IOV got enabled on boot:
+        self.gpu_inventory_fingerprint.return_value = 'inventory-2'
+        self.harness.charm.on.update_status.emit()
+        self.assertTrue(self.set_principal_unit_relation_data.called)
+        self.install_mdev_init_workaround.assert_called_once_with(
+            self.harness.charm.config)
+        self.assertEqual(
+            self.harness.charm._stored.gpu_inventory_fingerprint,
+            'inventory-2')
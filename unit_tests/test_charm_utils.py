@@ -12,7 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
+import os
 import sys
+import tempfile
+import types
 import unittest
 
 from mock import ANY, MagicMock, patch, call
@@ -22,6 +27,7 @@ sys.path.append('src')  # noqa
 from ops.model import (
     ActiveStatus,
     BlockedStatus,
+    WaitingStatus,
 )
 
 import charm_utils
@@ -142,6 +148,167 @@ class TestCharmUtils(unittest.TestCase):
             BlockedStatus('manual reboot required')
         )
 
+    @patch('charm_utils.ows_check_services_running')
+    @patch('charm_utils.is_nvidia_software_to_be_installed')
+    @patch('nvidia_utils.installed_nvidia_software_versions')
+    @patch('nvidia_utils.has_nvidia_gpu_hardware')
+    @patch('nvidia_utils.current_boot_id')
+    def test_check_status_remediation(
+            self, boot_id_mock, has_hw_mock, installed_sw_mock,
+            is_sw_to_be_installed_mock, check_services_running_mock):
+        boot_id_mock.return_value = 'boot-1'
+        has_hw_mock.return_value = True, 1
+        installed_sw_mock.return_value = ['42']
+        is_sw_to_be_installed_mock.return_value = True
+        check_services_running_mock.return_value = (None, None)
+        result_file = os.path.join(tempfile.mkdtemp(), 'result.json')
+        traits_result_file = os.path.join(tempfile.mkdtemp(), 'traits.json')
+
+        def check_status_with_result(result_file=result_file, **result):
+            with open(result_file, 'w') as f:
+                json.dump(dict({'boot_id': 'boot-1', 'status': 'ok',
+                                'continuation': False,
+                                'timings': {'total': {'total': 95.2}}},
+                               **result), f)
+            return charm_utils.check_status(None, None)
+
+        with patch.object(charm_utils, 'REMEDIATION_RESULT_FILE',
+                          result_file), \
+                patch.object(charm_utils, 'TRAITS_RESULT_FILE',
+                             traits_result_file):
+            self.assertEqual(charm_utils.check_status(None, None),
+                             ActiveStatus('Unit is ready (1 GPU)'))
+            self.assertEqual(check_status_with_result(),
+                             ActiveStatus('Unit is ready (1 GPU)'))
+            self.assertEqual(
+                check_status_with_result(status='failed'),
+                ActiveStatus('Unit is ready (1 GPU, mdev remediation '
+                             'failed)'))
+            self.assertEqual(
+                check_status_with_result(status='deferred'),
+                ActiveStatus('Unit is ready (1 GPU, mdev remediation slow '
+                             '(95s))'))
+            self.assertEqual(
+                check_status_with_result(continuation=True),
+                ActiveStatus('Unit is ready (1 GPU, mdev remediation slow '
+                             '(95s))'))
+            # Results of previous boots are ignored:
+            self.assertEqual(
+                check_status_with_result(status='failed', boot_id='boot-0'),
+                ActiveStatus('Unit is ready (1 GPU)'))
+            # The traits are updated after nova-compute starts:
+            self.assertEqual(
+                check_status_with_result(traits_result_file,
+                                         status='failed'),
+                ActiveStatus('Unit is ready (1 GPU, vGPU traits update '
+                             'failed)'))
+
+    @patch('charm_utils.ows_check_services_running')
+    @patch('charm_utils.is_nvidia_software_to_be_installed')
+    @patch('nvidia_utils.installed_nvidia_software_versions')
+    @patch('nvidia_utils.has_nvidia_gpu_hardware')
+    @patch('nvidia_utils.gpu_inventory')
+    def test_check_status_unmatched_patterns(
+            self, gpu_inventory_mock, has_hw_mock, installed_sw_mock,
+            is_sw_to_be_installed_mock, check_services_running_mock):
+        has_hw_mock.return_value = True, 2
+        installed_sw_mock.return_value = ['42']
+        is_sw_to_be_installed_mock.return_value = True
+        check_services_running_mock.return_value = (None, None)
+        gpu_inventory_mock.return_value = {'devices': [
+            {'address': '0000:41:00.0', 'physfn': None, 'vgpu_types': {}},
+        ]}
+        config = {'vgpu-device-mappings': (
+            "{'nvidia-471': ['vfs:0000:41:00.0', '0000:84:00.0']}")}
+
+        # Virtual functions aren't enabled yet:
+        self.assertEqual(charm_utils.check_status(config, None),
+                         WaitingStatus('waiting for GPUs to present vGPU '
+                                       'types'))
+
+        gpu_inventory_mock.return_value = {'devices': [
+            {'address': '0000:41:00.0', 'physfn': None, 'vgpu_types': {}},
+            {'address': '0000:41:00.4', 'physfn': '0000:41:00.0',
+             'vgpu_types': {'nvidia-471': {}}},
+        ]}
+        self.assertEqual(charm_utils.check_status(config, None),
+                         ActiveStatus('Unit is ready (2 GPU)'))
+
+        config = {'vgpu-device-mappings': (
+            "{'nvidia-471': ['vfs:0000:42:00.0', '0000:43:*']}")}
+        self.assertEqual(charm_utils.check_status(config, None),
+                         BlockedStatus('vgpu-device-mappings match no GPU: '
+                                       'vfs:0000:42:00.0, 0000:43:*'))
+
+        config = {'vgpu-device-mappings': "{'nvidia-471': ['vfs:0000:42']}"}
+        self.assertEqual(charm_utils.check_status(config, None),
+                         BlockedStatus("invalid vgpu-device-mappings: "
+                                       "Invalid PCI address '0000:42'"))
+
+        config = {'vgpu-device-mappings': 'auto:max-instances'}
+        self.assertEqual(charm_utils.check_status(config, None),
+                         ActiveStatus('Unit is ready (2 GPU)'))
+        gpu_inventory_mock.return_value = {'devices': [
+            {'address': '0000:41:00.0', 'physfn': None, 'vgpu_types': {}},
+        ]}
+        self.assertEqual(charm_utils.check_status(config, None),
+                         WaitingStatus('waiting for GPUs to present vGPU '
+                                       'types'))
+
+    @patch('charm_utils.subprocess.check_output')
+    @patch('charm_utils._mtime_ns')
+    @patch('nvidia_utils.current_boot_id')
+    @patch('charm_utils.check_status_notcached')
+    def test_check_status_cached(self, check_status_notcached_mock,
+                                 boot_id_mock, mtime_ns_mock,
+                                 check_output_mock):
+        check_status_notcached_mock.return_value = ActiveStatus(
+            'Unit is ready (1 GPU)')
+        boot_id_mock.return_value = 'boot-1'
+        mtime_ns_mock.return_value = 42
+        check_output_mock.return_value = 'ActiveState=active'
+        unit_stored_state = types.SimpleNamespace(status_fingerprint=None,
+                                                  last_status=None)
+        config = {'force-install-nvidia-vgpu': False}
+        services = ['nvidia-vgpu-mgr']
+
+        self.assertEqual(
+            charm_utils.check_status(config, services, unit_stored_state),
+            ActiveStatus('Unit is ready (1 GPU)'))
+        self.assertEqual(check_status_notcached_mock.call_count, 1)
+        check_output_mock.assert_called_once_with(
+            ['systemctl', 'show',
+             '--property=Id,ActiveState,ActiveEnterTimestamp',
+             'nvidia-vgpu-mgr'], universal_newlines=True)
+
+        # Nothing changed, the last status is returned:
+        check_status_notcached_mock.return_value = BlockedStatus(
+            'manual reboot required')
+        self.assertEqual(
+            charm_utils.check_status(config, services, unit_stored_state),
+            ActiveStatus('Unit is ready (1 GPU)'))
+        self.assertEqual(check_status_notcached_mock.call_count, 1)
+
+        # Any changed input leads to the status being re-computed:
+        for change in (
+                lambda: setattr(boot_id_mock, 'return_value', 'boot-2'),
+                lambda: setattr(mtime_ns_mock, 'return_value', 43),
+                lambda: setattr(check_output_mock, 'return_value',
+                                'ActiveState=failed'),
+                lambda: config.update({'vgpu-device-mappings': '{}'})):
+            change()
+            check_status_notcached_mock.reset_mock()
+            self.assertEqual(
+                charm_utils.check_status(config, services, unit_stored_state),
+                BlockedStatus('manual reboot required'))
+            self.assertEqual(check_status_notcached_mock.call_count, 1)
+
+        # The status is re-computed if its inputs can't be checked:
+        check_output_mock.side_effect = OSError
+        check_status_notcached_mock.reset_mock()
+        charm_utils.check_status(config, services, unit_stored_state)
+        self.assertEqual(check_status_notcached_mock.call_count, 1)
+
     @patch('nvidia_utils._installed_nvidia_software_packages')
     @patch('charm_utils.get_os_codename_package')
     def test_set_principal_unit_relation_data(self, release_codename_mock,
@@ -183,14 +350,114 @@ class TestCharmUtils(unittest.TestCase):
             '[["enabled_mdev_types", ""]]}}}}',
             relation_data_to_be_set['subordinate_configuration'])
 
-    @patch('charm_utils.file_hash')
-    def test_path_and_hash_nvidia_resource(self, file_hash_mock):
-        file_hash_mock.return_value = 'nvidia-software-hash'
+    @patch('nvidia_utils.expand_pci_addresses')
+    def test_vgpu_device_mappings(self, expand_pci_addresses_mock):
+        expand_pci_addresses_mock.side_effect = lambda patterns: [
+            pattern.replace('*', '0') for pattern in patterns]
+        self.assertEqual(
+            charm_utils._vgpu_device_mappings({
+                'vgpu-device-mappings': "{'nvidia-35': ['0000:84:00.*']}"}),
+            {'nvidia-35': ['0000:84:00.0']})
+        self.assertEqual(
+            charm_utils._vgpu_device_mappings({'vgpu-device-mappings': ''}),
+            {})
+
+    @patch('nvidia_utils.auto_vgpu_device_mappings')
+    def test_vgpu_device_mappings_auto(self, auto_mappings_mock):
+        auto_mappings_mock.return_value = {'nvidia-35': ['0000:84:00.0']}
+        self.assertEqual(
+            charm_utils._vgpu_device_mappings({
+                'vgpu-device-mappings': 'auto:max-instances'}),
+            {'nvidia-35': ['0000:84:00.0']})
+        auto_mappings_mock.assert_called_once_with('auto:max-instances')
+
+    @patch('nvidia_utils._installed_nvidia_software_packages')
+    @patch('charm_utils.get_os_codename_package')
+    @patch('nvidia_utils.gpu_inventory')
+    def test_set_principal_unit_relation_data_auto(
+            self, gpu_inventory_mock, release_codename_mock,
+            installed_packages_mock):
+        release_codename_mock.return_value = 'xena'
+        installed_packages_mock.return_value = []
+        vgpu_types = {'nvidia-471': {
+            'name': 'NVIDIA A40-1Q',
+            'description': 'framebuffer=1024M, max_instance=48'}}
+        gpu_inventory_mock.return_value = {'devices': [
+            {'address': '0000:41:00.0', 'physfn': None, 'vgpu_types': {}},
+        ]}
+        relation_data = {}
+        charm_config = {'vgpu-device-mappings': 'auto:max-instances'}
+        charm_utils.set_principal_unit_relation_data(
+            relation_data, charm_config, [])
+        self.assertIn('"enabled_mdev_types", ""',
+                      relation_data['subordinate_configuration'])
+
+        # The mappings are generated again once the virtual functions
+        # appear:
+        gpu_inventory_mock.return_value['devices'].append({
+            'address': '0000:41:00.4', 'physfn': '0000:41:00.0',
+            'vgpu_types': vgpu_types})
+        charm_utils.set_principal_unit_relation_data(
+            relation_data, charm_config, [])
+        self.assertIn('0000:41:00.4',
+                      relation_data['subordinate_configuration'])
+
+    def test_update_relation_data(self):
+        relation_data_to_be_set = MagicMock()
+        relation_data_to_be_set.get.side_effect = {
+            'services': '["nvidia-vgpu-mgr"]',
+        }.get
+        charm_utils._update_relation_data(relation_data_to_be_set, {
+            'services': '["nvidia-vgpu-mgr"]',
+            'subordinate_configuration': '{}',
+        })
+        relation_data_to_be_set.__setitem__.assert_called_once_with(
+            'subordinate_configuration', '{}')
+
+    def test_path_and_hash_nvidia_resource(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'nvidia-software')
+            f.flush()
+            resources = MagicMock()
+            resources.fetch.return_value = f.name
+            unit_stored_state = types.SimpleNamespace(
+                nvidia_resource_fingerprint=None, nvidia_resource_hash=None)
+
+            self.assertEqual(
+                charm_utils._path_and_hash_nvidia_resource(resources,
+                                                           unit_stored_state),
+                (f.name, hashlib.md5(b'nvidia-software').hexdigest()))
+
+            # The hash is cached as long as the file doesn't change:
+            with patch.object(charm_utils, '_file_hash') as file_hash_mock:
+                file_hash_mock.return_value = 'new-hash'
+                self.assertEqual(
+                    charm_utils._path_and_hash_nvidia_resource(
+                        resources, unit_stored_state),
+                    (f.name, hashlib.md5(b'nvidia-software').hexdigest()))
+                self.assertFalse(file_hash_mock.called)
+
+                f.write(b'-v2')
+                f.flush()
+                self.assertEqual(
+                    charm_utils._path_and_hash_nvidia_resource(
+                        resources, unit_stored_state),
+                    (f.name, 'new-hash'))
+
+    def test_path_and_hash_nvidia_resource_missing(self):
         resources = MagicMock()
-        resources.fetch.return_value = 'nvidia-software-path'
+        resources.fetch.side_effect = charm_utils.ModelError
+        self.assertEqual(
+            charm_utils._path_and_hash_nvidia_resource(resources, None),
+            (None, None))
 
-        self.assertEqual(charm_utils._path_and_hash_nvidia_resource(resources),
-                         ('nvidia-software-path', 'nvidia-software-hash'))
+    def test_file_hash(self):
+        with tempfile.NamedTemporaryFile() as f:
+            content = os.urandom(charm_utils.HASH_BUFFER_SIZE * 2 + 42)
+            f.write(content)
+            f.flush()
+            self.assertEqual(charm_utils._file_hash(f.name),
+                             hashlib.md5(content).hexdigest())
 
     @patch('charm_utils.get_os_codename_package')
     def test_nova_conf_sections(self, release_codename_mock):
@@ -251,14 +518,24 @@ class TestCharmUtils(unittest.TestCase):
             release_codename_mock.return_value = 'pike'
             charm_utils._nova_conf_sections(vgpu_device_mappings)
 
+    @patch('nvidia_utils.gpu_inventory')
     @patch.object(charm_utils, 'service')
     @patch.object(charm_utils, 'render')
     @patch.object(charm_utils.os, 'chmod')
     @patch.object(charm_utils.shutil, 'copy')
     def test_install_mdev_init_workaround(self, mock_copy, mock_chmod,
-                                          mock_render, mock_service):
+                                          mock_render, mock_service,
+                                          mock_gpu_inventory):
+        mock_gpu_inventory.return_value = {'devices': [
+            {'address': '0000:84:00.0', 'physfn': '0000:83:00.0'},
+            {'address': '0000:85:00.0', 'physfn': '0000:83:00.0'},
+            {'address': '0000:86:0a.0', 'physfn': None},
+        ]}
         charm_config = {
-            'vgpu-device-mappings': "{'nvidia-35': ['0000:84:00.0']}"
+            'vgpu-device-mappings': (
+                "{'nvidia-35': ['0000:84:00.0', '85:00.0'], "
+                "'nvidia-36': ['0000:86:0A.0']}"),
+            'mdev-remediation-timeout': 60,
         }
         charm_utils.install_mdev_init_workaround(charm_config)
         mock_copy.assert_has_calls([call('files/initialise_nova_mdevs.sh',
@@ -266,9 +543,28 @@ class TestCharmUtils(unittest.TestCase):
         mock_render.assert_has_calls([
             call('remediate_nova_mdevs.py',
                  '/opt/remediate-nova-mdevs',
-                 {'mdev_types': {
-                     'nvidia-35': ['0000:84:00.0']}},
+                 {'pci_driver_types': {
+                     '0000:84:00.0': 'nvidia-35',
+                     '0000:85:00.0': 'nvidia-35',
+                     '0000:86:0a.0': 'nvidia-36'},
+                  'sriov_pfs': ['0000:83:00.0']},
                  perms=493),
             call('systemd-mdev-workaround.service',
-                 '/etc/systemd/system/systemd-mdev-workaround.service', {},
-                 perms=420)])
+                 '/etc/systemd/system/systemd-mdev-workaround.service',
+                 {'remediation_timeout': 60},
+                 perms=420),
+            call('systemd-mdev-ledger-snapshot.service',
+                 '/etc/systemd/system/systemd-mdev-ledger-snapshot.service',
+                 {}, perms=420),
+            call('systemd-mdev-ledger-snapshot.timer',
+                 '/etc/systemd/system/systemd-mdev-ledger-snapshot.timer',
+                 {}, perms=420),
+            call('systemd-mdev-ledger-shutdown.service',
+                 '/etc/systemd/system/systemd-mdev-ledger-shutdown.service',
+                 {}, perms=420)])
+        mock_service.assert_has_calls([
+            call('enable', 'systemd-mdev-workaround'),
+            call('enable', 'systemd-mdev-ledger-snapshot.timer'),
+            call('start', 'systemd-mdev-ledger-snapshot.timer'),
+            call('enable', 'systemd-mdev-ledger-shutdown.service'),
+            call('start', 'systemd-mdev-ledger-shutdown.service')])
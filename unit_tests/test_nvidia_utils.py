@@ -12,25 +12,60 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
 import sys
+import tempfile
 import unittest
 
-from mock import MagicMock, patch
+from mock import patch
 
 sys.path.append('src')  # noqa
 
 import nvidia_utils
 
 
+def make_fake_pci_device(pci_devices_dir, pci_addr, vendor='0x10de',
+                         device_class='0x030200', subsystem_vendor='0x10de',
+                         device='0x1e30', vgpu_types=None):
+    """Create a fake sysfs PCI device directory.
+
+    :param vgpu_types: Map of vGPU type to (name, description).
+    :type vgpu_types: Dict[str, Tuple[str, str]]
+    """
+    device_dir = os.path.join(pci_devices_dir, pci_addr)
+    os.makedirs(device_dir)
+    with open(os.path.join(device_dir, 'vendor'), 'w') as f:
+        f.write(vendor + '\n')
+    with open(os.path.join(device_dir, 'class'), 'w') as f:
+        f.write(device_class + '\n')
+    with open(os.path.join(device_dir, 'subsystem_vendor'), 'w') as f:
+        f.write(subsystem_vendor + '\n')
+    with open(os.path.join(device_dir, 'device'), 'w') as f:
+        f.write(device + '\n')
+    for vgpu_type, (name, description) in (vgpu_types or {}).items():
+        vgpu_type_dir = os.path.join(device_dir, 'mdev_supported_types',
+                                     vgpu_type)
+        os.makedirs(vgpu_type_dir)
+        with open(os.path.join(vgpu_type_dir, 'name'), 'w') as f:
+            f.write(name + '\n')
+        with open(os.path.join(vgpu_type_dir, 'description'), 'w') as f:
+            f.write(description + '\n')
+    return device_dir
+
+
 class MockLspciProperty:
-    def __init__(self, name):
+    def __init__(self, name, id=None):
         self.name = name
+        self.id = id
 
 
 class MockLspciDevice:
-    def __init__(self, cls_name, vendor_name):
+    def __init__(self, cls_name, vendor_name, slot='0000:41:00.0'):
+        self.slot = slot
         self.cls = MockLspciProperty(cls_name)
         self.vendor = MockLspciProperty(vendor_name)
+        self.device = MockLspciProperty('TU102GL [Quadro RTX 6000/8000]')
 
 
 class TestNvidiaUtils(unittest.TestCase):
@@ -50,46 +85,421 @@ class TestNvidiaUtils(unittest.TestCase):
                         vendor_name='NVIDIA Corporation'),
     ]
 
-    @patch('nvidia_utils.SimpleParser')
-    def test_has_nvidia_gpu_hardware_with_hw(self, lspci_parser_mock):
-        lspci_parser_mock.return_value.run.return_value = (
-            self._PCI_DEVICES_LIST_WITH_NVIDIA_GPU)
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.pci_devices_dir = tmp_dir.name
+        pci_devices_dir_patcher = patch('nvidia_utils.PCI_DEVICES_DIR',
+                                        self.pci_devices_dir)
+        pci_devices_dir_patcher.start()
+        self.addCleanup(pci_devices_dir_patcher.stop)
+
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        self.boot_id_file = os.path.join(state_dir.name, 'boot_id')
+        self.set_boot_id('boot-1')
+        for name, value in (
+                ('BOOT_ID_FILE', self.boot_id_file),
+                ('GPU_INVENTORY_FILE',
+                 os.path.join(state_dir.name, 'state', 'inventory.json')),
+                ('DPKG_STATUS_FILE', os.path.join(state_dir.name, 'status')),
+                ('_dpkg_inventory', None)):
+            patcher = patch('nvidia_utils.{}'.format(name), value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def set_boot_id(self, boot_id):
+        with open(self.boot_id_file, 'w') as f:
+            f.write(boot_id + '\n')
+
+    def test_nvidia_gpu_device_dirs(self):
+        make_fake_pci_device(self.pci_devices_dir, '0000:c1:00.0')
+        make_fake_pci_device(self.pci_devices_dir, '0000:41:00.0')
+        # VGA compatible controller:
+        make_fake_pci_device(self.pci_devices_dir, '0000:42:00.0',
+                             device_class='0x030000')
+        # Not an NVIDIA device:
+        make_fake_pci_device(self.pci_devices_dir, '0000:43:00.0',
+                             vendor='0x8086', subsystem_vendor='0x8086')
+        # NVIDIA GPU sold by another vendor, with another programming
+        # interface, classified the same way as by detect_nvidia_gpus():
+        make_fake_pci_device(self.pci_devices_dir, '0000:44:00.0',
+                             vendor='0x10df', device_class='0x030201')
+
+        self.assertEqual(nvidia_utils.nvidia_gpu_device_dirs(), [
+            os.path.join(self.pci_devices_dir, '0000:41:00.0'),
+            os.path.join(self.pci_devices_dir, '0000:44:00.0'),
+            os.path.join(self.pci_devices_dir, '0000:c1:00.0'),
+        ])
+        self.assertEqual(
+            [device.address for device in nvidia_utils.detect_nvidia_gpus()],
+            ['0000:41:00.0', '0000:44:00.0', '0000:c1:00.0'])
+
+    def test_nvidia_gpu_device_dirs_without_pci_bus(self):
+        with patch('nvidia_utils.PCI_DEVICES_DIR', '/non/existent'):
+            self.assertEqual(nvidia_utils.nvidia_gpu_device_dirs(), [])
+
+    def test_has_nvidia_gpu_hardware_with_hw(self):
+        # This is an NVIDIA device, but not a GPU card:
+        make_fake_pci_device(self.pci_devices_dir, '0000:40:00.0',
+                             device_class='0x030000')
+        # This is an NVIDIA GPU card:
+        make_fake_pci_device(self.pci_devices_dir, '0000:41:00.0')
+        # This is an NVIDIA GPU card sold by another vendor:
+        make_fake_pci_device(self.pci_devices_dir, '0000:c1:00.0',
+                             vendor='0x10df', device_class='0x030201')
+        # This is not an NVIDIA device:
+        make_fake_pci_device(self.pci_devices_dir, '0000:c2:00.0',
+                             vendor='0x1002', subsystem_vendor='0x1002')
         self.assertEqual(
             nvidia_utils._has_nvidia_gpu_hardware_notcached(),
-            (True, 1)
+            (True, 2)
         )
+        self.assertEqual(nvidia_utils.detect_nvidia_gpus(), [
+            nvidia_utils.PciDevice(address='0000:41:00.0', vendor=0x10de,
+                                   device=0x1e30, subsystem_vendor=0x10de,
+                                   device_class=0x030200),
+            nvidia_utils.PciDevice(address='0000:c1:00.0', vendor=0x10df,
+                                   device=0x1e30, subsystem_vendor=0x10de,
+                                   device_class=0x030201),
+        ])
 
-    @patch('nvidia_utils.SimpleParser')
-    def test_has_nvidia_gpu_hardware_without_hw(self, lspci_parser_mock):
-        lspci_parser_mock.return_value.run.return_value = (
-            self._PCI_DEVICES_LIST_WITHOUT_GPU)
+    def test_has_nvidia_gpu_hardware_without_hw(self):
+        make_fake_pci_device(self.pci_devices_dir, '0000:40:00.0',
+                             device_class='0x030000')
         self.assertEqual(
             nvidia_utils._has_nvidia_gpu_hardware_notcached(),
             (False, 0)
         )
 
-    @patch('nvidia_utils.Path')
-    @patch('nvidia_utils.os.listdir')
-    @patch('nvidia_utils.os.walk')
-    def test_list_vgpu_types(self, os_walk_mock, os_listdir_mock, path_mock):
-        os_walk_mock.return_value = [
-            ('/sys/devices/pci0000:40/0000:40:03.1/0000:41:00.0',
-             ['mdev_supported_types'], []),
-            ('/sys/devices/pci0000:c0/0000:c0:03.1/0000:c1:00.0',
-             ['mdev_supported_types'], []),
-        ]
-        os_listdir_mock.side_effect = [
-            ['nvidia-301'],
-        ]
-        path_mock_obj = MagicMock()
-        path_mock.return_value = path_mock_obj
-        path_mock_obj.read_text.side_effect = [
-            '0x030000',  # causes device to not be included
-            '0x030200',
-            'GRID V100-16C',
-            ('num_heads=1, frl_config=60, framebuffer=16384M, '
-             'max_resolution=4096x2160, max_instance=1'),
-        ]
+    @patch('nvidia_utils.PCI_DEVICES_DIR', '/non/existent')
+    @patch('nvidia_utils.SimpleParser')
+    def test_detect_nvidia_gpus_with_lspci(self, lspci_parser_mock):
+        lspci_parser_mock.return_value.run.return_value = (
+            self._PCI_DEVICES_LIST_WITH_NVIDIA_GPU)
+        self.assertEqual(
+            [device.address for device in nvidia_utils.detect_nvidia_gpus()],
+            ['0000:41:00.0'])
+
+        lspci_parser_mock.return_value.run.return_value = (
+            self._PCI_DEVICES_LIST_WITHOUT_GPU)
+        self.assertEqual(nvidia_utils.detect_nvidia_gpus(), [])
+
+    def test_gpu_inventory(self):
+        make_fake_pci_device(self.pci_devices_dir, '0000:41:00.0')
+        inventory = nvidia_utils.gpu_inventory()
+        self.assertEqual(inventory['boot_id'], 'boot-1')
+        self.assertEqual(inventory['devices'], [{
+            'address': '0000:41:00.0',
+            'vendor': 0x10de,
+            'device': 0x1e30,
+            'subsystem_vendor': 0x10de,
+            'device_class': 0x030200,
+            'physfn': None,
+            'sriov_numvfs': None,
+            'sriov_totalvfs': None,
+            'vgpu_types': {},
+        }])
+
+        # The persisted inventory is used until the next reboot:
+        make_fake_pci_device(self.pci_devices_dir, '0000:c1:00.0')
+        self.assertEqual(nvidia_utils.gpu_inventory(), inventory)
+
+        self.set_boot_id('boot-2')
+        inventory = nvidia_utils.gpu_inventory()
+        self.assertEqual(inventory['boot_id'], 'boot-2')
+        self.assertEqual(len(inventory['devices']), 2)
+
+        # The hardware can be re-scanned on demand:
+        make_fake_pci_device(self.pci_devices_dir, '0000:c2:00.0')
+        self.assertEqual(len(nvidia_utils.gpu_inventory()['devices']), 2)
+        self.assertEqual(
+            len(nvidia_utils.gpu_inventory(refresh=True)['devices']), 3)
+
+    def test_gpu_inventory_sriov(self):
+        pf_dir = make_fake_pci_device(self.pci_devices_dir, '0000:41:00.0')
+        for name, value in (('sriov_numvfs', '0'), ('sriov_totalvfs', '2')):
+            with open(os.path.join(pf_dir, name), 'w') as f:
+                f.write(value + '\n')
+        self.assertEqual(len(nvidia_utils.gpu_inventory()['devices']), 1)
+
+        # Enabling virtual functions makes the inventory stale:
+        vgpu_types = {'nvidia-471': ('NVIDIA A40-1Q', 'max_instance=48')}
+        for function in ('1', '2'):
+            vf_dir = make_fake_pci_device(
+                self.pci_devices_dir, '0000:41:00.' + function,
+                vgpu_types=vgpu_types)
+            os.symlink(pf_dir, os.path.join(vf_dir, 'physfn'))
+        with open(os.path.join(pf_dir, 'sriov_numvfs'), 'w') as f:
+            f.write('2\n')
+
+        devices = nvidia_utils.gpu_inventory()['devices']
+        self.assertEqual(len(devices), 3)
+        self.assertEqual(devices[0]['sriov_numvfs'], 2)
+        self.assertEqual(devices[0]['sriov_totalvfs'], 2)
+        self.assertEqual(devices[1]['physfn'], '0000:41:00.0')
+        self.assertEqual(devices[1]['vgpu_types'], {
+            'nvidia-471': {
+                'name': 'NVIDIA A40-1Q',
+                'description': 'max_instance=48',
+            },
+        })
+
+    def test_gpu_inventory_vgpu_types_appeared(self):
+        device_dir = make_fake_pci_device(self.pci_devices_dir,
+                                          '0000:41:00.0')
+        self.assertEqual(
+            nvidia_utils.gpu_inventory()['devices'][0]['vgpu_types'], {})
+
+        os.makedirs(os.path.join(device_dir, 'mdev_supported_types',
+                                 'nvidia-256'))
+        self.assertEqual(
+            list(nvidia_utils.gpu_inventory()['devices'][0]['vgpu_types']),
+            ['nvidia-256'])
+
+    def test_expand_pci_addresses(self):
+        vgpu_types = {'nvidia-471': ('NVIDIA A40-1Q', 'max_instance=48')}
+        for function in range(7):
+            make_fake_pci_device(self.pci_devices_dir,
+                                 '0000:41:00.{}'.format(function),
+                                 vgpu_types=vgpu_types)
+        # SR-IOV physical function, presenting no vGPU type itself
+        pf_dir = make_fake_pci_device(self.pci_devices_dir, '0000:41:00.7')
+        for bus in ('42', '43'):
+            for function in range(4):
+                vf_dir = make_fake_pci_device(
+                    self.pci_devices_dir, '0000:{}:00.{}'.format(bus,
+                                                                 function),
+                    vgpu_types=vgpu_types)
+                os.symlink(pf_dir, os.path.join(vf_dir, 'physfn'))
+
+        self.assertEqual(
+            nvidia_utils.expand_pci_addresses(['0000:41:00.6-0000:42:00.1']),
+            ['0000:41:00.6', '0000:42:00.0', '0000:42:00.1'])
+        self.assertEqual(
+            nvidia_utils.expand_pci_addresses(
+                [' 0000:41:00.6 - 0000:42:00.0']),
+            ['0000:41:00.6', '0000:42:00.0'])
+        self.assertNotIn('0000:41:00.7',
+                         nvidia_utils.expand_pci_addresses(['0000:41:*.*']))
+        self.assertEqual(
+            nvidia_utils.expand_pci_addresses(['0000:43:*.[12]',
+                                               '0000:84:00.0']),
+            ['0000:43:00.1', '0000:43:00.2', '0000:84:00.0'])
+        self.assertEqual(
+            len(nvidia_utils.expand_pci_addresses(['vfs:0000:41:00.7',
+                                                   '0000:42:00.1'])),
+            8)
+        self.assertEqual(nvidia_utils.expand_pci_addresses(['0000:c1:*']),
+                         [])
+        with self.assertRaises(ValueError):
+            nvidia_utils.expand_pci_addresses(['0000:41:00.0-0000:42'])
+        self.assertEqual(
+            nvidia_utils.unmatched_pci_address_patterns(
+                ['0000:c1:*', 'vfs:0000:41:00.7', '0000:84:00.0',
+                 '0000:44:00.0-0000:44:00.7']),
+            ['0000:c1:*', '0000:44:00.0-0000:44:00.7'])
+
+    def test_gpu_inventory_fingerprint(self):
+        vgpu_types = {'nvidia-471': ('NVIDIA A40-1Q', 'max_instance=48')}
+        pf_dir = make_fake_pci_device(self.pci_devices_dir, '0000:41:00.0')
+        fingerprint = nvidia_utils.gpu_inventory_fingerprint()
+        self.assertEqual(nvidia_utils.gpu_inventory_fingerprint(),
+                         fingerprint)
+
+        # SR-IOV gets enabled:
+        vf_dir = make_fake_pci_device(self.pci_devices_dir, '0000:41:00.4',
+                                      vgpu_types=vgpu_types)
+        os.symlink(pf_dir, os.path.join(vf_dir, 'physfn'))
+        nvidia_utils.gpu_inventory(refresh=True)
+        self.assertNotEqual(nvidia_utils.gpu_inventory_fingerprint(),
+                            fingerprint)
+
+    @patch('nvidia_utils.gpu_inventory')
+    def test_expand_pci_addresses_without_pattern(self, gpu_inventory_mock):
+        self.assertEqual(
+            nvidia_utils.expand_pci_addresses(['0000:84:00.0']),
+            ['0000:84:00.0'])
+        self.assertFalse(gpu_inventory_mock.called)
+
+    def test_pci_driver_type_index(self):
+        self.assertEqual(
+            nvidia_utils.pci_driver_type_index({
+                'nvidia-35': ['0000:84:00.0', '85:00.0'],
+                'nvidia-36': ['0000:86:0A.0', '0000:84:00.0'],
+            }),
+            {'0000:84:00.0': 'nvidia-35',
+             '0000:85:00.0': 'nvidia-35',
+             '0000:86:0a.0': 'nvidia-36'})
+        self.assertEqual(nvidia_utils.pci_driver_type_index({}), {})
+
+    @patch('nvidia_utils.gpu_inventory')
+    def test_sriov_physical_functions(self, gpu_inventory_mock):
+        gpu_inventory_mock.return_value = {'devices': [
+            {'address': '0000:41:00.4', 'physfn': '0000:41:00.0'},
+            {'address': '0000:42:00.1', 'physfn': '0000:42:00.0'},
+            {'address': '0000:42:00.2', 'physfn': '0000:42:00.0'},
+            {'address': '0000:84:00.0', 'physfn': None},
+        ]}
+        self.assertEqual(
+            nvidia_utils.sriov_physical_functions(
+                ['42:00.1', '0000:42:00.2', '0000:84:00.0', '0000:41:00.4']),
+            ['0000:41:00.0', '0000:42:00.0'])
+        self.assertEqual(
+            nvidia_utils.sriov_physical_functions(['0000:84:00.0']), [])
+        self.assertIsNone(
+            nvidia_utils.sriov_physical_functions(['0000:42:00.1',
+                                                   '0000:43:00.1']))
+        self.assertIsNone(nvidia_utils.sriov_physical_functions([]))
+
+    def test_parse_vgpu_type_description(self):
+        self.assertEqual(
+            nvidia_utils.parse_vgpu_type_description(
+                'num_heads=4, frl_config=60, framebuffer=1024M, '
+                'max_resolution=5120x2880, max_instance=24'),
+            {'num_heads': '4', 'frl_config': '60', 'framebuffer': '1024M',
+             'max_resolution': '5120x2880', 'max_instance': '24'})
+        self.assertEqual(nvidia_utils.parse_vgpu_type_description(None), {})
+        self.assertEqual(nvidia_utils.parse_size_mb('1024M'), 1024)
+        self.assertEqual(nvidia_utils.parse_size_mb('16G'), 16384)
+        self.assertIsNone(nvidia_utils.parse_size_mb('lots'))
+
+    def test_auto_vgpu_device_mappings(self):
+        def vgpu_type(name, framebuffer, max_instance):
+            return (name, 'num_heads=4, frl_config=60, framebuffer={}, '
+                          'max_resolution=5120x2880, max_instance={}'.format(
+                              framebuffer, max_instance))
+
+        rtx6000_types = {
+            'nvidia-250': vgpu_type('GRID RTX6000-1B', '1024M', 24),
+            'nvidia-256': vgpu_type('GRID RTX6000-1Q', '1024M', 24),
+            'nvidia-259': vgpu_type('GRID RTX6000-4Q', '4096M', 6),
+        }
+        make_fake_pci_device(self.pci_devices_dir, '0000:41:00.0',
+                             vgpu_types=rtx6000_types)
+        device_dir = make_fake_pci_device(self.pci_devices_dir,
+                                          '0000:c1:00.0',
+                                          vgpu_types=rtx6000_types)
+        # A vGPU of type nvidia-259 already exists on this GPU:
+        os.makedirs(os.path.join(device_dir, 'mdev_supported_types',
+                                 'nvidia-259', 'devices',
+                                 'c8d2e0cd-0e5d-4ba0-b6a8-6e0e6f6f1f5a'))
+        pf_dir = make_fake_pci_device(self.pci_devices_dir, '0000:81:00.0')
+        for function in ('4', '5'):
+            vf_dir = make_fake_pci_device(
+                self.pci_devices_dir, '0000:81:00.' + function,
+                vgpu_types={
+                    'nvidia-471': vgpu_type('NVIDIA A40-1Q', '1024M', 48),
+                    'nvidia-472': vgpu_type('NVIDIA A40-2Q', '2048M', 24),
+                })
+            os.symlink(pf_dir, os.path.join(vf_dir, 'physfn'))
+
+        self.assertEqual(
+            nvidia_utils.auto_vgpu_device_mappings('auto:max-instances:Q'),
+            {'nvidia-256': ['0000:41:00.0'],
+             'nvidia-259': ['0000:c1:00.0'],
+             'nvidia-471': ['0000:81:00.4', '0000:81:00.5']})
+        self.assertEqual(
+            nvidia_utils.auto_vgpu_device_mappings('auto:framebuffer=2G'),
+            {'nvidia-259': ['0000:41:00.0', '0000:c1:00.0'],
+             'nvidia-472': ['0000:81:00.4', '0000:81:00.5']})
+        self.assertEqual(
+            nvidia_utils.auto_vgpu_device_mappings('auto:framebuffer=64G'),
+            {'nvidia-259': ['0000:c1:00.0']})
+        for policy in ('auto:', 'auto:framebuffer', 'auto:max-instances=2'):
+            with self.assertRaises(ValueError):
+                nvidia_utils.auto_vgpu_device_mappings(policy)
+
+    def test_auto_vgpu_device_mappings_malformed_description(self):
+        make_fake_pci_device(self.pci_devices_dir, '0000:41:00.0', vgpu_types={
+            'nvidia-256': ('GRID RTX6000-1Q', 'framebuffer=1024M, '
+                                              'max_instance=24'),
+            'nvidia-259': ('GRID RTX6000-4Q', 'framebuffer=4096M, '
+                                              'max_instance=six'),
+        })
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(
+                nvidia_utils.auto_vgpu_device_mappings('auto:framebuffer=2G'),
+                {})
+        self.assertIn('Skipping vGPU type nvidia-259', logs.output[0])
+        self.assertEqual(
+            nvidia_utils.auto_vgpu_device_mappings('auto:max-instances'),
+            {'nvidia-256': ['0000:41:00.0']})
+
+    _DPKG_STATUS = """Package: nvidia-vgpu-ubuntu-470
+Status: install ok installed
+Priority: optional
+Architecture: amd64
+Version: 470.68
+Description: NVIDIA vGPU driver - version 470.68
+ Long description.
+
+Package: nvidia-vgpu-ubuntu-510
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 510.47.03
+Description: NVIDIA vGPU driver - version 510.47.03
+
+Package: nova-common
+Status: hold ok installed
+Architecture: all
+Version: 3:29.0.0-0ubuntu1
+Description: OpenStack Compute - common files
+"""
+
+    def write_dpkg_status(self, content):
+        with open(nvidia_utils.DPKG_STATUS_FILE, 'w') as f:
+            f.write(content)
+
+    def test_dpkg_inventory(self):
+        self.write_dpkg_status(self._DPKG_STATUS)
+        inventory = nvidia_utils.dpkg_inventory()
+        self.assertEqual(inventory.names(),
+                         ['nova-common', 'nvidia-vgpu-ubuntu-470'])
+        self.assertEqual(inventory.packages('nvidia-vgpu-ubuntu-*'), [{
+            'name': 'nvidia-vgpu-ubuntu-470',
+            'version': '470.68',
+            'architecture': 'amd64',
+            'description': 'NVIDIA vGPU driver - version 470.68',
+        }])
+        self.assertEqual(inventory.versions('nova-*'), ['3:29.0.0-0ubuntu1'])
+        self.assertEqual(inventory.architectures('nova-*'), ['all'])
+        self.assertEqual(nvidia_utils.installed_nvidia_software_versions(),
+                         ['470.68'])
+        self.assertEqual(
+            nvidia_utils.installed_nvidia_software_package_names(),
+            ['nvidia-vgpu-ubuntu-470'])
+
+    @patch('nvidia_utils.DpkgInventory.load',
+           wraps=nvidia_utils.DpkgInventory.load)
+    def test_dpkg_inventory_cache(self, load_mock):
+        self.write_dpkg_status(self._DPKG_STATUS)
+        nvidia_utils.installed_nvidia_software_versions()
+        nvidia_utils.installed_nvidia_software_package_names()
+        self.assertEqual(load_mock.call_count, 1)
+
+        self.write_dpkg_status(self._DPKG_STATUS.replace(
+            'deinstall ok config-files', 'install ok installed'))
+        os.utime(nvidia_utils.DPKG_STATUS_FILE, ns=(0, 0))
+        self.assertEqual(nvidia_utils.installed_nvidia_software_versions(),
+                         ['470.68', '510.47.03'])
+        self.assertEqual(load_mock.call_count, 2)
+
+    def test_list_vgpu_types(self):
+        vgpu_types = {
+            'nvidia-301': (
+                'GRID V100-16C',
+                ('num_heads=1, frl_config=60, framebuffer=16384M, '
+                 'max_resolution=4096x2160, max_instance=1')),
+        }
+        # Not a 3D controller, causes device to not be included:
+        make_fake_pci_device(self.pci_devices_dir, '0000:41:00.0',
+                             device_class='0x030000', vgpu_types=vgpu_types)
+        make_fake_pci_device(self.pci_devices_dir, '0000:c1:00.0',
+                             vgpu_types=vgpu_types)
+        # NVIDIA GPU not presenting any vGPU type:
+        make_fake_pci_device(self.pci_devices_dir, '0000:c2:00.0')
 
         expected_output = '\n'.join([
             ('nvidia-301, 0000:c1:00.0, GRID V100-16C, num_heads=1, '
@@ -97,3 +507,60 @@ class TestNvidiaUtils(unittest.TestCase):
              'max_instance=1'),
         ])
         self.assertEqual(nvidia_utils.list_vgpu_types(), expected_output)
+
+    def test_list_vgpu_types_structured(self):
+        rtx6000_types = {
+            'nvidia-256': ('GRID RTX6000-1Q',
+                           'num_heads=4, frl_config=60, framebuffer=1024M, '
+                           'max_resolution=5120x2880, max_instance=24'),
+            'nvidia-259': ('GRID RTX6000-4Q',
+                           'num_heads=4, frl_config=60, framebuffer=4096M, '
+                           'max_resolution=7680x4320, max_instance=6'),
+        }
+        v100_types = {
+            'nvidia-105': ('GRID V100-1Q',
+                           'num_heads=4, frl_config=60, framebuffer=1024M, '
+                           'max_resolution=5120x2880, max_instance=16'),
+        }
+        device_dir = make_fake_pci_device(self.pci_devices_dir,
+                                          '0000:41:00.0',
+                                          vgpu_types=rtx6000_types)
+        for vgpu_type, available_instances in (('nvidia-256', '24'),
+                                               ('nvidia-259', '6')):
+            vgpu_type_dir = os.path.join(device_dir, 'mdev_supported_types',
+                                         vgpu_type)
+            with open(os.path.join(vgpu_type_dir, 'available_instances'),
+                      'w') as f:
+                f.write(available_instances + '\n')
+            with open(os.path.join(vgpu_type_dir, 'device_api'), 'w') as f:
+                f.write('vfio-pci\n')
+        make_fake_pci_device(self.pci_devices_dir, '0000:c1:00.0',
+                             vgpu_types=v100_types)
+
+        records = json.loads(nvidia_utils.list_vgpu_types(
+            output_format='json', pci_address='0000:41:*',
+            min_framebuffer=2048))
+        self.assertEqual(records, [{
+            'type': 'nvidia-259',
+            'pci_address': '0000:41:00.0',
+            'parent': None,
+            'name': 'GRID RTX6000-4Q',
+            'description': ('num_heads=4, frl_config=60, framebuffer=4096M, '
+                            'max_resolution=7680x4320, max_instance=6'),
+            'num_heads': 4,
+            'frl_config': 60,
+            'framebuffer': 4096,
+            'max_resolution': '7680x4320',
+            'max_instance': 6,
+            'available_instances': 6,
+            'device_api': 'vfio-pci',
+        }])
+
+        self.assertEqual(
+            [record['type'] for record in nvidia_utils.vgpu_types(
+                type_name='*-1Q')],
+            ['nvidia-256', 'nvidia-105'])
+        self.assertIn('type: nvidia-105', nvidia_utils.list_vgpu_types(
+            output_format='yaml', type_name='nvidia-105'))
+        with self.assertRaises(ValueError):
+            nvidia_utils.list_vgpu_types(output_format='xml')
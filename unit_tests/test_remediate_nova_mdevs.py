@@ -0,0 +1,709 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from keystoneauth1 import exceptions as ks_exceptions
+from mock import MagicMock, patch
+
+from unit_tests.remediation_utils import (
+    fake_domain_xml,
+    fake_libvirt_module,
+    load_remediation_module,
+)
+
+
+class RemediationTestCase(unittest.TestCase):
+    """Test templates/remediate_nova_mdevs.py, rendered anew for each test
+    so that its module state, e.g. its report, isn't shared."""
+
+    CONTEXT = {
+        'mdev_types': {'nvidia-610': ['0000:41:00.4', '0000:41:00.5']},
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.remediation = load_remediation_module(**self.CONTEXT)
+        self.remediation.PCI_DEVICES_DIR = os.path.join(self.tmp_dir, 'pci')
+        self.remediation.MDEV_DEVICES_DIR = os.path.join(self.tmp_dir, 'mdev')
+        os.makedirs(self.remediation.PCI_DEVICES_DIR)
+        os.makedirs(self.remediation.MDEV_DEVICES_DIR)
+
+    def make_fake_gpu(self, pf, vfs=0, mdev_types=('nvidia-610',)):
+        """Create a fake sysfs physical GPU and its VFs.
+
+        :returns: PCI addresses of the VFs, or of the GPU if it has none.
+        """
+        pf_dir = os.path.join(self.remediation.PCI_DEVICES_DIR, pf)
+        os.makedirs(pf_dir)
+        addresses = []
+        for vf in range(vfs):
+            # VFs follow the 4 functions of the PF, as on A100 GPUs
+            address = '{}.{}'.format(pf[:-2], 4 + vf)
+            vf_dir = os.path.join(self.remediation.PCI_DEVICES_DIR, address)
+            os.makedirs(vf_dir)
+            os.symlink(pf_dir, os.path.join(vf_dir, 'physfn'))
+            addresses.append(address)
+
+        for address in addresses or [pf]:
+            for mdev_type in mdev_types:
+                os.makedirs(os.path.join(self.remediation.PCI_DEVICES_DIR,
+                                         address, 'mdev_supported_types',
+                                         mdev_type))
+        return addresses or [pf]
+
+
+class TestLeanAdapter(RemediationTestCase):
+
+    def write_nova_conf(self, placement_options):
+        self.remediation.NOVA_CONF = os.path.join(self.tmp_dir, 'nova.conf')
+        with open(self.remediation.NOVA_CONF, 'w') as f:
+            f.write('[DEFAULT]\ndebug = True\n[placement]\n')
+            f.write('auth_url = http://keystone:5000/v3\n'
+                    'username = nova\npassword = secret\n'
+                    'project_name = services\n')
+            for option, value in placement_options.items():
+                f.write('{} = {}\n'.format(option, value))
+
+    def test_get_lean_adapter(self):
+        self.write_nova_conf({'certfile': '/etc/nova/cert.pem',
+                              'keyfile': '/etc/nova/key.pem',
+                              'timeout': '10',
+                              'endpoint_override': 'http://placement:8778'})
+        adapter = self.remediation.get_lean_adapter('placement')
+        self.assertEqual(adapter.session.timeout, 10.0)
+        self.assertEqual(adapter.session.cert,
+                         ('/etc/nova/cert.pem', '/etc/nova/key.pem'))
+        self.assertEqual(adapter.endpoint_override, 'http://placement:8778')
+
+    def test_get_lean_adapter_default_timeout(self):
+        self.write_nova_conf({})
+        adapter = self.remediation.get_lean_adapter('placement')
+        self.assertEqual(adapter.session.timeout,
+                         self.remediation.PLACEMENT_TIMEOUT)
+        self.assertIsNone(adapter.session.cert)
+
+    def test_get_lean_adapter_unsupported_options(self):
+        self.write_nova_conf({'auth_section': 'keystone_authtoken'})
+        self.assertIsNone(self.remediation.get_lean_adapter('placement'))
+
+        self.write_nova_conf({'timeout': 'never'})
+        self.assertIsNone(self.remediation.get_lean_adapter('placement'))
+
+
+class TestRetryPolicy(RemediationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Fake clock, advanced by sleeping
+        self.now = 0.0
+        self.remediation.monotonic = lambda: self.now
+        self.remediation.sleep = self.sleep
+
+    def sleep(self, delay):
+        self.now += delay
+
+    @staticmethod
+    def discovery_failure():
+        try:
+            raise ks_exceptions.ConnectFailure("connection refused")
+        except ks_exceptions.ConnectFailure:
+            try:
+                raise ks_exceptions.DiscoveryFailure(
+                    "could not find versioned identity endpoints")
+            except ks_exceptions.DiscoveryFailure as exc:
+                return exc
+
+    def test_is_transient_error(self):
+        is_transient_error = self.remediation.is_transient_error
+        self.assertTrue(is_transient_error(ConnectionRefusedError()))
+        self.assertTrue(is_transient_error(
+            ks_exceptions.ConnectFailure("connection refused")))
+        self.assertTrue(is_transient_error(self.discovery_failure()))
+        self.assertFalse(is_transient_error(
+            ks_exceptions.DiscoveryFailure("no endpoint")))
+        self.assertTrue(is_transient_error(
+            ks_exceptions.ServiceUnavailable()))
+        self.assertFalse(is_transient_error(ks_exceptions.Unauthorized()))
+        self.assertFalse(is_transient_error(ks_exceptions.Forbidden()))
+        self.assertFalse(is_transient_error(
+            ks_exceptions.SSLError("certificate verify failed")))
+        self.assertFalse(is_transient_error(KeyError('resource_providers')))
+
+    def test_call_retries_transient_errors(self):
+        func = MagicMock(side_effect=[self.discovery_failure(),
+                                      MagicMock(status_code=503),
+                                      MagicMock(status_code=200)])
+        policy = self.remediation.RetryPolicy(deadline=60, base_delay=1,
+                                              max_delay=4)
+        self.assertEqual(policy.call('GET /traits', func).status_code, 200)
+        self.assertEqual(func.call_count, 3)
+        self.assertGreater(self.now, 0)
+
+    def test_call_permanent_errors(self):
+        policy = self.remediation.RetryPolicy(deadline=60)
+        func = MagicMock(side_effect=ks_exceptions.Unauthorized())
+        with self.assertRaises(ks_exceptions.Unauthorized):
+            policy.call('GET /traits', func)
+        self.assertEqual(func.call_count, 1)
+
+        for status in (401, 403):
+            func = MagicMock(return_value=MagicMock(status_code=status))
+            self.assertEqual(policy.call('GET /traits', func).status_code,
+                             status)
+            self.assertEqual(func.call_count, 1)
+        self.assertEqual(self.now, 0)
+
+    def test_call_deadline(self):
+        policy = self.remediation.RetryPolicy(deadline=30, base_delay=1,
+                                              max_delay=4)
+        func = MagicMock(side_effect=self.discovery_failure())
+        with self.assertRaises(ks_exceptions.DiscoveryFailure):
+            policy.call('GET /traits', func)
+        self.assertGreater(func.call_count, 5)
+        self.assertEqual(self.now, 30)
+
+        self.now = 0.0
+        func = MagicMock(return_value=MagicMock(status_code=503))
+        self.assertEqual(policy.call('GET /traits', func).status_code, 503)
+        self.assertEqual(self.now, 30)
+
+
+class TestLibvirtHelper(RemediationTestCase):
+
+    def test_find_missing_mdevs_failed_domains(self):
+        domain_xmls = {
+            'a1b2c3d4-0000-4000-8000-000000000001': fake_domain_xml(
+                ['4b20d080-1b54-4048-85b3-a6a62d165c01'], disks=1, vcpus=1),
+            'a1b2c3d4-0000-4000-8000-000000000002':
+                "<domain><devices><hostdev type='mdev'>",
+        }
+        self.remediation.libvirt = fake_libvirt_module(domain_xmls)
+        lm = self.remediation.LibvirtHelper()
+        # The last domain is undefined after being listed
+        lm.domains = [self.remediation.Domain(domain_uuid, 'instance')
+                      for domain_uuid in list(domain_xmls) +
+                      ['a1b2c3d4-0000-4000-8000-000000000003']]
+
+        missing, failed = self.remediation.find_missing_mdevs(lm)
+        self.assertEqual(missing, [('a1b2c3d4-0000-4000-8000-000000000001',
+                                    '4b20d080-1b54-4048-85b3-a6a62d165c01')])
+        self.assertTrue(failed)
+        self.assertEqual(sorted(domain.uuid for domain in lm.failed_domains),
+                         ['a1b2c3d4-0000-4000-8000-000000000002',
+                          'a1b2c3d4-0000-4000-8000-000000000003'])
+        self.assertEqual(self.remediation.REPORT.counts['failed'], 2)
+
+    def test_snapshot_keeps_entries_of_failed_domains(self):
+        self.remediation.MDEV_LEDGER_FILE = os.path.join(self.tmp_dir,
+                                                         'ledger.json')
+        entry = {'parent': '0000:41:00.4', 'type': 'nvidia-610',
+                 'domain': 'a1b2c3d4-0000-4000-8000-000000000002'}
+        self.remediation.MdevLedger({
+            '4b20d080-1b54-4048-85b3-a6a62d165c02': entry,
+            '4b20d080-1b54-4048-85b3-a6a62d165c09': dict(
+                entry, domain='a1b2c3d4-0000-4000-8000-000000000009'),
+        }).save()
+        self.remediation.libvirt = fake_libvirt_module({
+            'a1b2c3d4-0000-4000-8000-000000000002':
+                "<domain><devices><hostdev type='mdev'>",
+        })
+
+        self.remediation.snapshot()
+        self.assertEqual(self.remediation.MdevLedger.load().entries,
+                         {'4b20d080-1b54-4048-85b3-a6a62d165c02': entry})
+
+
+class TestCreateMdevs(RemediationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.in_flight = collections.Counter()
+        self.max_in_flight = collections.Counter()
+        self.created = []
+        self.lock = threading.Lock()
+        self.slow_uuids = set()
+        self.remediation._write_sysfs = self.write_sysfs
+
+    def write_sysfs(self, path, value):
+        gpu = self.remediation._parent_gpu(path.split(os.sep)[-4])
+        with self.lock:
+            self.in_flight[gpu] += 1
+            self.max_in_flight[gpu] = max(self.max_in_flight[gpu],
+                                          self.in_flight[gpu])
+        time.sleep(1 if value in self.slow_uuids else 0.01)
+        with self.lock:
+            self.in_flight[gpu] -= 1
+            self.created.append(value)
+
+    def creates(self, addresses, count):
+        return [self.remediation.MdevCreate(
+            addresses[i % len(addresses)], 'nvidia-610',
+            '4b20d080-1b54-4048-85b3-a6a62d16{:04x}'.format(i), None)
+            for i in range(count)]
+
+    def test_create_mdevs(self):
+        addresses = (self.make_fake_gpu('0000:41:00.0', vfs=4) +
+                     self.make_fake_gpu('0000:42:00.0', vfs=4) +
+                     self.make_fake_gpu('0000:84:00.0'))
+        creates = self.creates(addresses, 18)
+
+        self.assertEqual(self.remediation.create_mdevs(creates), 0)
+        self.assertEqual(sorted(self.created),
+                         sorted(create.uuid for create in creates))
+        # VFs are grouped under their physical GPU, each GPU creating one
+        # mdev at a time
+        self.assertEqual(sorted(self.max_in_flight),
+                         ['0000:41:00.0', '0000:42:00.0', '0000:84:00.0'])
+        self.assertEqual(set(self.max_in_flight.values()), {1})
+        self.assertEqual(self.remediation.REPORT.counts['remediated'], 18)
+
+    def test_create_mdevs_timeout(self):
+        self.remediation.MDEV_CREATE_TIMEOUT = 0.1
+        addresses = (self.make_fake_gpu('0000:41:00.0', vfs=1) +
+                     self.make_fake_gpu('0000:42:00.0', vfs=1))
+        creates = self.creates(addresses, 8)
+        # The second mdev of the first GPU gets stuck
+        self.slow_uuids.add(creates[2].uuid)
+
+        self.assertEqual(self.remediation.create_mdevs(creates), 3)
+        self.assertNotIn(creates[4].uuid, self.created)
+        self.assertNotIn(creates[6].uuid, self.created)
+        self.assertEqual(len(self.created), 5)
+        self.assertEqual(self.remediation.REPORT.counts['failed'], 3)
+        self.assertEqual(self.remediation.REPORT.counts['remediated'], 5)
+
+    def test_create_mdevs_dry_run(self):
+        creates = self.creates(self.make_fake_gpu('0000:84:00.0'), 2)
+        self.assertEqual(self.remediation.create_mdevs(creates,
+                                                       dry_run=True), 0)
+        self.assertEqual(self.created, [])
+
+
+class TestMdevLedger(RemediationTestCase):
+
+    DOMAIN = 'a1b2c3d4-0000-4000-8000-000000000001'
+    MDEV = '4b20d080-1b54-4048-85b3-a6a62d165c01'
+
+    def setUp(self):
+        super().setUp()
+        self.remediation.MDEV_LEDGER_FILE = os.path.join(self.tmp_dir,
+                                                         'ledger.json')
+
+    def make_fake_mdev(self, pci_addr, mdev_type, uuid):
+        device_dir = os.path.join(self.remediation.PCI_DEVICES_DIR, pci_addr)
+        mdev_dir = os.path.join(device_dir, uuid)
+        os.makedirs(mdev_dir)
+        os.symlink(os.path.join(device_dir, 'mdev_supported_types',
+                                mdev_type),
+                   os.path.join(mdev_dir, 'mdev_type'))
+        os.symlink(mdev_dir,
+                   os.path.join(self.remediation.MDEV_DEVICES_DIR, uuid))
+
+    def test_record(self):
+        self.make_fake_gpu('0000:41:00.0', vfs=1)
+        self.make_fake_mdev('0000:41:00.4', 'nvidia-610', self.MDEV)
+        ledger = self.remediation.MdevLedger()
+        self.assertTrue(ledger.record(self.DOMAIN, self.MDEV))
+        self.assertFalse(ledger.record(
+            self.DOMAIN, '4b20d080-1b54-4048-85b3-a6a62d165c02'))
+        self.assertEqual(ledger.entries, {self.MDEV: {
+            'parent': '0000:41:00.4', 'type': 'nvidia-610',
+            'domain': self.DOMAIN}})
+
+    def test_plan_mdev_create(self):
+        self.make_fake_gpu('0000:41:00.0', vfs=1)
+        entry = {'parent': '0000:41:00.4', 'type': 'nvidia-610',
+                 'domain': self.DOMAIN}
+        ledger = self.remediation.MdevLedger({self.MDEV: entry})
+        self.assertEqual(
+            ledger.plan_mdev_create(self.DOMAIN, self.MDEV),
+            self.remediation.MdevCreate('0000:41:00.4', 'nvidia-610',
+                                        self.MDEV, self.DOMAIN))
+        self.assertIsNone(ledger.plan_mdev_create(
+            self.DOMAIN, '4b20d080-1b54-4048-85b3-a6a62d165c02'))
+
+        # The mdev belonged to another domain
+        self.assertIsNone(ledger.plan_mdev_create(
+            'a1b2c3d4-0000-4000-8000-000000000002', self.MDEV))
+
+        # The GPU is now mapped to another type
+        ledger.entries[self.MDEV] = dict(entry, type='nvidia-611')
+        self.assertIsNone(ledger.plan_mdev_create(self.DOMAIN, self.MDEV))
+
+        # The GPU doesn't support the type anymore, e.g. its VFs aren't
+        # enabled
+        ledger.entries[self.MDEV] = dict(entry, parent='0000:41:00.5')
+        self.assertIsNone(ledger.plan_mdev_create(self.DOMAIN, self.MDEV))
+
+    def test_plan_mdev_creates(self):
+        self.make_fake_gpu('0000:41:00.0', vfs=1)
+        ledger = self.remediation.MdevLedger({self.MDEV: {
+            'parent': '0000:41:00.4', 'type': 'nvidia-610',
+            'domain': self.DOMAIN}})
+        unknown = (self.DOMAIN, '4b20d080-1b54-4048-85b3-a6a62d165c02')
+        creates, unresolved = ledger.plan_mdev_creates(
+            [(self.DOMAIN, self.MDEV), unknown])
+        self.assertEqual([create.uuid for create in creates], [self.MDEV])
+        self.assertEqual(unresolved, [unknown])
+
+    def test_load_save(self):
+        self.assertEqual(self.remediation.MdevLedger.load().entries, {})
+
+        entries = {self.MDEV: {'parent': '0000:41:00.4',
+                               'type': 'nvidia-610', 'domain': self.DOMAIN}}
+        self.remediation.MdevLedger(entries).save()
+        self.assertEqual(self.remediation.MdevLedger.load().entries, entries)
+
+        for content in ('{"mdevs": ', '[]', '{"mdevs": 1}'):
+            with open(self.remediation.MDEV_LEDGER_FILE, 'w') as f:
+                f.write(content)
+            self.assertEqual(self.remediation.MdevLedger.load().entries, {})
+
+    def test_snapshot(self):
+        self.make_fake_gpu('0000:41:00.0', vfs=2)
+        running_mdev = '4b20d080-1b54-4048-85b3-a6a62d165c03'
+        self.make_fake_mdev('0000:41:00.5', 'nvidia-610', running_mdev)
+        entry = {'parent': '0000:41:00.4', 'type': 'nvidia-610',
+                 'domain': self.DOMAIN}
+        self.remediation.MdevLedger({
+            # mdev lost, e.g. on a previous reboot, still used by its domain
+            self.MDEV: entry,
+            # mdev of a domain deleted since
+            '4b20d080-1b54-4048-85b3-a6a62d165c09': dict(
+                entry, domain='a1b2c3d4-0000-4000-8000-000000000009'),
+        }).save()
+        self.remediation.libvirt = fake_libvirt_module({
+            self.DOMAIN: fake_domain_xml([self.MDEV], disks=1, vcpus=1),
+            'a1b2c3d4-0000-4000-8000-000000000003': fake_domain_xml(
+                [running_mdev], disks=1, vcpus=1),
+        })
+
+        self.remediation.snapshot()
+        self.assertEqual(self.remediation.MdevLedger.load().entries, {
+            self.MDEV: entry,
+            running_mdev: {'parent': '0000:41:00.5', 'type': 'nvidia-610',
+                           'domain': 'a1b2c3d4-0000-4000-8000-000000000003'},
+        })
+
+
+class TestBudget(RemediationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.remediation.REMEDIATION_RESULT_FILE = os.path.join(
+            self.tmp_dir, 'remediation-result.json')
+
+    def load_result(self):
+        with open(self.remediation.REMEDIATION_RESULT_FILE) as f:
+            return json.load(f)
+
+    def test_budget(self):
+        budget = self.remediation.Budget(timeout=1)
+        self.assertEqual(budget.run('scan', lambda: 'done'), 'done')
+        with self.assertRaises(self.remediation.DeadlineExceededError):
+            budget.run('scan', time.sleep, 5)
+
+        self.assertEqual(self.remediation.Budget(timeout=0).deadlines, {})
+
+    @patch('subprocess.run')
+    def test_start_continuation(self, run_mock):
+        with patch.dict(os.environ, {'MDEV_INIT_DRY_RUN': 'True',
+                                     'MDEV_INIT_TIMEOUT': '120'}):
+            self.assertTrue(self.remediation.start_continuation())
+
+        cmd = run_mock.call_args[0][0]
+        self.assertEqual(cmd[:4], ['systemd-run', '--no-block', '--collect',
+                                   '--unit=mdev-workaround-continuation'])
+        self.assertIn('--setenv=MDEV_INIT_DRY_RUN=True', cmd)
+        self.assertIn('--setenv=MDEV_INIT_TIMEOUT=0', cmd)
+        self.assertIn('--setenv=MDEV_INIT_CONTINUATION=1', cmd)
+        self.assertNotIn('--setenv=MDEV_INIT_TIMEOUT=120', cmd)
+
+        with patch.dict(os.environ, {'MDEV_INIT_DRY_RUN': 'True'}):
+            self.assertTrue(self.remediation.start_continuation(
+                traits_only=True))
+
+        cmd = run_mock.call_args[0][0]
+        self.assertEqual(cmd[3], '--unit=mdev-workaround-traits')
+        self.assertIn('--setenv=MDEV_INIT_DRY_RUN=True', cmd)
+        self.assertIn('--setenv=MDEV_INIT_TRAITS_ONLY=1', cmd)
+        self.assertNotIn('--setenv=MDEV_INIT_CONTINUATION=1', cmd)
+
+        run_mock.side_effect = OSError("systemd-run not found")
+        self.assertFalse(self.remediation.start_continuation())
+
+    def test_main_deferred(self):
+        self.remediation.REMEDIATION_TIMEOUT = 1
+
+        def remediate(budget, dry_run):
+            return budget.run('scan', time.sleep, 5)
+
+        self.remediation._remediate = remediate
+        self.remediation.start_continuation = MagicMock(return_value=True)
+        self.assertTrue(self.remediation.main())
+        self.assertTrue(self.remediation.start_continuation.called)
+        result = self.load_result()
+        self.assertEqual(result['status'], 'deferred')
+        self.assertEqual(result['timings']['phase_scan']['count'], 1)
+
+        self.remediation.start_continuation.return_value = False
+        with self.assertRaises(self.remediation.PlacementError):
+            self.remediation.main()
+        self.assertEqual(self.load_result()['status'], 'failed')
+
+
+class TestMain(RemediationTestCase):
+
+    DOMAIN = 'a1b2c3d4-0000-4000-8000-000000000001'
+    MDEV = '4b20d080-1b54-4048-85b3-a6a62d165c01'
+
+    def setUp(self):
+        super().setUp()
+        self.remediation.REMEDIATION_RESULT_FILE = os.path.join(
+            self.tmp_dir, 'remediation-result.json')
+        self.remediation.MDEV_LEDGER_FILE = os.path.join(self.tmp_dir,
+                                                         'ledger.json')
+        self.remediation.SRIOV_PFS = []
+        self.remediation.libvirt = fake_libvirt_module({
+            self.DOMAIN: fake_domain_xml([self.MDEV], disks=1, vcpus=1)})
+        self.make_fake_gpu('0000:41:00.0', vfs=1)
+        self.remediation.MdevLedger({self.MDEV: {
+            'parent': '0000:41:00.4', 'type': 'nvidia-610',
+            'domain': self.DOMAIN}}).save()
+        self.pm = MagicMock(local_compute_rps=[])
+        self.remediation._start_placement_helper = lambda: self.pm
+        self.remediation.start_continuation = MagicMock(return_value=True)
+
+    def load_result(self, path=None):
+        with open(path or self.remediation.REMEDIATION_RESULT_FILE) as f:
+            return json.load(f)
+
+    def test_main(self):
+        self.remediation._write_sysfs = MagicMock()
+        self.assertFalse(self.remediation.main())
+        self.remediation._write_sysfs.assert_called_once_with(
+            os.path.join(self.remediation.PCI_DEVICES_DIR, '0000:41:00.4',
+                         'mdev_supported_types', 'nvidia-610', 'create'),
+            self.MDEV)
+        result = self.load_result()
+        self.assertEqual(result['status'], 'ok')
+        self.assertEqual(result['counts']['remediated'], 1)
+        # The traits are reconciled in the background
+        self.remediation.start_continuation.assert_called_once_with(
+            traits_only=True)
+
+    def test_main_nothing_to_fix_without_placement(self):
+        self.remediation.REMEDIATION_TIMEOUT = 5
+        self.remediation._write_sysfs = MagicMock()
+        keystone_down = threading.Event()
+        self.addCleanup(keystone_down.set)
+
+        def start_placement_helper():
+            keystone_down.wait()
+            return self.pm
+
+        self.remediation._start_placement_helper = start_placement_helper
+        start = time.monotonic()
+        self.assertFalse(self.remediation.main())
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.load_result()['status'], 'ok')
+        self.assertNotIn('phase_placement', self.load_result()['timings'])
+
+    def test_main_traits_hand_off_failed(self):
+        self.remediation._write_sysfs = MagicMock()
+        self.remediation.start_continuation.return_value = False
+        with self.assertRaises(self.remediation.PlacementError):
+            self.remediation.main()
+        self.assertEqual(self.load_result()['status'], 'failed')
+
+    def test_main_traits_only(self):
+        self.remediation.TRAITS_ONLY = True
+        self.remediation.TRAITS_RESULT_FILE = os.path.join(
+            self.tmp_dir, 'traits-result.json')
+        self.remediation._write_sysfs = MagicMock()
+        self.pm.local_compute_rps = [{'uuid': 'rp-1'}]
+        self.pm.update_all_gpu_traits.return_value = {'rp-1': 'failed'}
+        with self.assertRaises(self.remediation.PlacementError):
+            self.remediation.main()
+        self.pm.update_all_gpu_traits.assert_called_once_with(False)
+        # No mdev is remediated, and the last remediation result is kept
+        self.assertFalse(self.remediation._write_sysfs.called)
+        self.assertFalse(
+            os.path.exists(self.remediation.REMEDIATION_RESULT_FILE))
+        self.assertEqual(
+            self.load_result(self.remediation.TRAITS_RESULT_FILE)['status'],
+            'failed')
+
+    def test_main_continuation_updates_traits(self):
+        self.remediation.CONTINUATION = True
+        self.remediation._write_sysfs = MagicMock()
+        self.pm.local_compute_rps = [{'uuid': 'rp-1'}]
+        self.pm.update_all_gpu_traits.return_value = {'rp-1': 'updated'}
+        self.assertFalse(self.remediation.main())
+        self.pm.update_all_gpu_traits.assert_called_once_with(False)
+        self.assertFalse(self.remediation.start_continuation.called)
+
+    def test_main_failed_without_local_rps(self):
+        self.remediation._write_sysfs = MagicMock(
+            side_effect=OSError("write error"))
+        with self.assertRaises(self.remediation.RemediationFailedError):
+            self.remediation.main()
+        result = self.load_result()
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['counts']['failed'], 1)
+        self.assertEqual(result['counts']['remediated'], 0)
+
+    def test_main_deferred_waits_for_sriov(self):
+        self.remediation.REMEDIATION_TIMEOUT = 0.5
+        self.remediation.libvirt = fake_libvirt_module({}, latency=1)
+        sriov_enabled = threading.Event()
+
+        def enable_sriov():
+            time.sleep(0.5)
+            sriov_enabled.set()
+            return 0
+
+        self.remediation.enable_sriov = enable_sriov
+        # The continuation is only started once SR-IOV is enabled
+        self.remediation.start_continuation = sriov_enabled.is_set
+        self.assertTrue(self.remediation.main())
+        self.assertEqual(self.load_result()['status'], 'deferred')
+
+    def test_main_deferred_stops_creates(self):
+        self.remediation.REMEDIATION_TIMEOUT = 0.5
+        mdevs = ['4b20d080-1b54-4048-85b3-a6a62d1650{:02x}'.format(i)
+                 for i in range(4)]
+        self.remediation.libvirt = fake_libvirt_module({
+            self.DOMAIN: fake_domain_xml(mdevs, disks=1, vcpus=1)})
+        self.remediation.MdevLedger({mdev: {
+            'parent': '0000:41:00.4', 'type': 'nvidia-610',
+            'domain': self.DOMAIN} for mdev in mdevs}).save()
+        started, created = [], []
+
+        def write_sysfs(path, value):
+            started.append(value)
+            time.sleep(0.3)
+            created.append(value)
+
+        def start_continuation():
+            # No mdev is being created when the continuation takes over
+            self.assertEqual(started, created)
+            return True
+
+        self.remediation._write_sysfs = write_sysfs
+        self.remediation.start_continuation = start_continuation
+        self.assertTrue(self.remediation.main())
+        self.assertEqual(len(created), 2)
+        time.sleep(0.5)
+        self.assertEqual(len(started), 2)
+        result = self.load_result()
+        self.assertEqual(result['status'], 'deferred')
+        self.assertEqual(result['counts']['cancelled'], 2)
+
+
+class TestEnableSriov(RemediationTestCase):
+
+    FAKE_SRIOV_MANAGE = """#!/bin/sh
+case "$2" in
+    0000:42:00.0) echo "GPU busy" >&2; exit 1;;
+    0000:43:00.0) exec sleep 10;;
+esac
+echo "$2" >> {devices_dir}/enabled
+cat {devices_dir}/$2/sriov_totalvfs > {devices_dir}/$2/sriov_numvfs
+"""
+
+    def setUp(self):
+        super().setUp()
+        devices_dir = self.remediation.PCI_DEVICES_DIR
+        self.remediation.SRIOV_MANAGE = os.path.join(self.tmp_dir,
+                                                     'sriov-manage')
+        with open(self.remediation.SRIOV_MANAGE, 'w') as f:
+            f.write(self.FAKE_SRIOV_MANAGE.format(devices_dir=devices_dir))
+        os.chmod(self.remediation.SRIOV_MANAGE, 0o755)
+        self.remediation.SRIOV_ENABLE_TIMEOUT = 0.5
+
+    def make_fake_pf(self, pci_addr, numvfs=0, totalvfs=4, vendor='0x10de'):
+        device_dir = os.path.join(self.remediation.PCI_DEVICES_DIR, pci_addr)
+        os.makedirs(device_dir)
+        for attribute, value in (('vendor', vendor),
+                                 ('sriov_numvfs', numvfs),
+                                 ('sriov_totalvfs', totalvfs)):
+            with open(os.path.join(device_dir, attribute), 'w') as f:
+                f.write('{}\n'.format(value))
+
+    def enabled(self):
+        try:
+            with open(os.path.join(self.remediation.PCI_DEVICES_DIR,
+                                   'enabled')) as f:
+                return f.read().split()
+        except FileNotFoundError:
+            return []
+
+    def test_enable_sriov(self):
+        self.make_fake_pf('0000:41:00.0')
+        self.make_fake_pf('0000:42:00.0')
+        self.make_fake_pf('0000:43:00.0')
+        self.make_fake_pf('0000:44:00.0', numvfs=4)
+        self.remediation.SRIOV_PFS = ['0000:41:00.0', '0000:42:00.0',
+                                      '0000:43:00.0', '0000:44:00.0',
+                                      '0000:45:00.0']
+
+        with self.assertLogs(self.remediation.LOG, 'ERROR') as logs:
+            self.assertEqual(self.remediation.enable_sriov(), 3)
+
+        self.assertEqual(self.enabled(), ['0000:41:00.0'])
+        self.assertEqual(len(logs.output), 3)
+        errors = {pf: ' '.join(error for error in logs.output if pf in error)
+                  for pf in ('0000:42:00.0', '0000:43:00.0', '0000:45:00.0')}
+        self.assertIn('failed to enable SR-IOV on gpu 0000:42:00.0',
+                      errors['0000:42:00.0'])
+        self.assertIn('GPU busy', errors['0000:42:00.0'])
+        self.assertIn('timed out after 0.5s enabling SR-IOV on gpu',
+                      errors['0000:43:00.0'])
+        self.assertIn('failed to read SR-IOV state of gpu',
+                      errors['0000:45:00.0'])
+        counts = self.remediation.REPORT.counts
+        self.assertEqual((counts['sriov_enabled'], counts['sriov_skipped'],
+                          counts['failed']), (1, 1, 3))
+
+        # VFs already enabled aren't enabled again
+        self.remediation.SRIOV_PFS = ['0000:41:00.0', '0000:44:00.0']
+        self.assertEqual(self.remediation.enable_sriov(), 0)
+        self.assertEqual(self.enabled(), ['0000:41:00.0'])
+        self.assertEqual(counts['sriov_skipped'], 3)
+
+    def test_enable_sriov_all_gpus(self):
+        self.make_fake_pf('0000:41:00.0')
+        self.make_fake_pf('0000:44:00.0', numvfs=4)
+        self.make_fake_pf('0000:81:00.0', vendor='0x8086')
+        self.make_fake_pf('0000:84:00.0', totalvfs=0)
+        # VF, without SR-IOV attributes
+        os.makedirs(os.path.join(self.remediation.PCI_DEVICES_DIR,
+                                 '0000:41:00.4'))
+        self.remediation.SRIOV_PFS = None
+
+        self.assertEqual(self.remediation.sriov_capable_gpus(),
+                         ['0000:41:00.0', '0000:44:00.0'])
+        self.assertEqual(self.remediation.enable_sriov(), 0)
+        self.assertEqual(self.enabled(), ['0000:41:00.0'])